@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""Microbenchmarks for the distributed prompt cache.
+
+`index` compares lookup/insert latency and Python heap usage of the radix-tree
+`LRUPromptCache` against the per-token dict trie it replaced (still shipped
+as `mlx_lm.server.LRUPromptCache`).
+
+`cow` measures what a cache hit costs before the first new token: fetching a
+shared entry (exact hit held by two requests, and a trimmed longer match)
+plus the first cache write, comparing the old `copy.deepcopy` + trim path
+against copy-on-write sharing. Reports wall time and MLX peak memory above
+the stored entries.
+
+`cold` measures quantized cold storage: bytes held per entry at full
+precision vs 8/4-bit, and the latency a hit adds to dequantize it.
+"""
+from __future__ import annotations
+
+import argparse
+import random
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Callable, List
+
+
+def _repo_root() -> Path:
+    return Path(__file__).resolve().parents[1]
+
+
+sys.path.insert(0, str(_repo_root() / "src"))
+
+
+def _timeit(fn: Callable[[], None], repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def _bench_index_one(name: str, impl: type, n: int, entries: int, repeat: int) -> dict:
+    rng = random.Random(n)
+    base = [rng.randrange(150_000) for _ in range(n)]
+    # Agent-style keys: a shared prefix with per-conversation tails.
+    keys = [base[: n // 2] + [rng.randrange(150_000) for _ in range(n - n // 2)] for _ in range(entries)]
+
+    tracemalloc.start()
+    store = impl(max_size=entries + 2)
+    for key in keys:
+        store.insert_cache("m", key, [])
+    heap = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    # Hold extra references so prefix-hit lookups copy instead of extracting.
+    for _ in range(repeat + 1):
+        store.insert_cache("m", keys[0], [])
+
+    prefix_query = keys[0] + [1, 2, 3]
+    longer_query = keys[1][: n - n // 4] + [7]
+    fresh = base[: n // 2] + [rng.randrange(150_000) for _ in range(n - n // 2)]
+
+    def insert_fresh() -> None:
+        store.insert_cache("m", fresh, [])
+
+    return {
+        "impl": name,
+        "tokens": n,
+        "lookup_prefix_ms": 1e3 * _timeit(lambda: store.fetch_nearest_cache("m", prefix_query), repeat),
+        "lookup_longer_ms": 1e3 * _timeit(lambda: store.fetch_nearest_cache("m", longer_query), repeat),
+        "insert_ms": 1e3 * _timeit(insert_fresh, 1),
+        "heap_mb": heap / 1e6,
+    }
+
+
+def _bench_index(args: argparse.Namespace) -> None:
+    from mlx_lm.server import LRUPromptCache as DictTriePromptCache
+
+    from kooka_server.distributed_server.prompt_cache import LRUPromptCache
+
+    print(
+        f"{'impl':<14}{'tokens':>8}{'lookup_prefix_ms':>18}{'lookup_longer_ms':>18}"
+        f"{'insert_ms':>12}{'heap_mb':>10}"
+    )
+    for n in args.sizes:
+        for name, impl in (("dict-trie", DictTriePromptCache), ("radix", LRUPromptCache)):
+            row = _bench_index_one(name, impl, n, args.entries, args.repeat)
+            print(
+                f"{row['impl']:<14}{row['tokens']:>8}{row['lookup_prefix_ms']:>18.3f}"
+                f"{row['lookup_longer_ms']:>18.3f}{row['insert_ms']:>12.3f}{row['heap_mb']:>10.1f}"
+            )
+
+
+def _filled_prompt_cache(layers: int, n: int, heads: int, head_dim: int) -> list:
+    import mlx.core as mx
+    from mlx_lm.models.cache import KVCache
+
+    prompt_cache = []
+    for _ in range(layers):
+        c = KVCache()
+        # Prefill in one shot, then decode a few tokens to leave step slack.
+        kv = mx.zeros((1, heads, n - 3, head_dim), dtype=mx.float16)
+        c.update_and_fetch(kv, kv)
+        for _ in range(3):
+            one = mx.zeros((1, heads, 1, head_dim), dtype=mx.float16)
+            c.update_and_fetch(one, one)
+        prompt_cache.append(c)
+    mx.eval([c.state for c in prompt_cache])
+    return prompt_cache
+
+
+def _bench_cow_one(mode: str, case: str, prompt_cache: list, n: int) -> dict:
+    import copy
+
+    import mlx.core as mx
+    from mlx_lm.models.cache import trim_prompt_cache
+
+    from kooka_server.distributed_server.prompt_cache import share_prompt_cache
+
+    num_to_trim = n // 2 if case == "longer" else 0
+    heads, head_dim = prompt_cache[0].keys.shape[1], prompt_cache[0].keys.shape[3]
+    mx.synchronize()
+    mx.clear_cache()
+    base = mx.get_active_memory()
+    mx.reset_peak_memory()
+
+    t0 = time.perf_counter()
+    if mode == "deepcopy":
+        working = copy.deepcopy(prompt_cache)
+        trim_prompt_cache(working, num_to_trim)
+    else:
+        working = share_prompt_cache(prompt_cache, num_to_trim)
+    one = mx.zeros((1, heads, 1, head_dim), dtype=mx.float16)
+    for c in working:
+        c.update_and_fetch(one, one)
+    mx.eval([(c.keys, c.values) for c in working])
+    elapsed = time.perf_counter() - t0
+
+    peak = mx.get_peak_memory() - base
+    del working
+    return {"mode": mode, "case": case, "tokens": n, "ms": 1e3 * elapsed, "peak_mb": peak / 1e6}
+
+
+def _bench_cow(args: argparse.Namespace) -> None:
+    import mlx.core as mx
+
+    print(f"{'mode':<10}{'case':<8}{'tokens':>8}{'first_write_ms':>16}{'peak_mb':>10}")
+    for n in args.sizes:
+        prompt_cache = _filled_prompt_cache(args.layers, n, args.kv_heads, args.head_dim)
+        stored_mb = sum(c.keys.nbytes + c.values.nbytes for c in prompt_cache) / 1e6
+        for case in ("shared", "longer"):
+            for mode in ("deepcopy", "cow"):
+                rows = [_bench_cow_one(mode, case, prompt_cache, n) for _ in range(args.repeat)]
+                best = min(rows, key=lambda r: r["ms"])
+                print(
+                    f"{best['mode']:<10}{best['case']:<8}{best['tokens']:>8}"
+                    f"{best['ms']:>16.2f}{max(r['peak_mb'] for r in rows):>10.1f}"
+                )
+        print(f"  stored entry: {stored_mb:.1f} MB")
+        del prompt_cache
+        mx.clear_cache()
+
+
+def _bench_cold(args: argparse.Namespace) -> None:
+    import mlx.core as mx
+
+    from kooka_server.distributed_server.prompt_cache import LRUPromptCache
+
+    print(f"{'bits':>6}{'tokens':>8}{'entry_mb':>10}{'saved_mb':>10}{'ratio':>7}{'hit_ms':>9}{'added_ms':>10}")
+    for n in args.sizes:
+        for bits in (16, 8, 4):
+            hit_ms = []
+            for _ in range(args.repeat):
+                prompt_cache = _filled_prompt_cache(args.layers, n, args.kv_heads, args.head_dim)
+                store = LRUPromptCache(max_size=4, cold_after=0.0 if bits < 16 else None, cold_bits=min(bits, 8))
+                store.insert_cache("m", list(range(n)), prompt_cache)
+                del prompt_cache
+                entry_mb = store.nbytes / 1e6
+                saved_mb = store.cold_saved_bytes / 1e6
+
+                t0 = time.perf_counter()
+                hit, _ = store.fetch_nearest_cache("m", list(range(n)) + [1])
+                mx.eval([(c.keys, c.values) for c in hit])
+                hit_ms.append(1e3 * (time.perf_counter() - t0))
+                del hit, store
+                mx.clear_cache()
+            best = min(hit_ms)
+            if bits == 16:
+                base_ms = best
+            full_mb = entry_mb + saved_mb
+            print(
+                f"{bits:>6}{n:>8}{entry_mb:>10.1f}{saved_mb:>10.1f}{full_mb / entry_mb:>7.2f}"
+                f"{best:>9.2f}{best - base_ms:>10.2f}"
+            )
+
+
+def _parse_sizes(value: str) -> List[int]:
+    return [int(x) for x in value.split(",") if x.strip()]
+
+
+def main(argv: List[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    index_p = sub.add_parser("index", help="Radix tree vs dict trie: lookup/insert latency and heap usage")
+    index_p.add_argument("--sizes", type=_parse_sizes, default=[1024, 32768, 131072], help="Key lengths (tokens)")
+    index_p.add_argument("--entries", type=int, default=4, help="Cached conversations per run")
+    index_p.add_argument("--repeat", type=int, default=5)
+    index_p.set_defaults(func=_bench_index)
+
+    cow_p = sub.add_parser("cow", help="Cache-hit first-write latency and peak memory: deepcopy vs copy-on-write")
+    cow_p.add_argument("--sizes", type=_parse_sizes, default=[8192, 32768], help="Cached prompt lengths (tokens)")
+    cow_p.add_argument("--layers", type=int, default=16)
+    cow_p.add_argument("--kv-heads", type=int, default=8)
+    cow_p.add_argument("--head-dim", type=int, default=128)
+    cow_p.add_argument("--repeat", type=int, default=3)
+    cow_p.set_defaults(func=_bench_cow)
+
+    cold_p = sub.add_parser("cold", help="Quantized cold entries: memory saved vs added hit latency")
+    cold_p.add_argument("--sizes", type=_parse_sizes, default=[8192, 32768], help="Cached prompt lengths (tokens)")
+    cold_p.add_argument("--layers", type=int, default=16)
+    cold_p.add_argument("--kv-heads", type=int, default=8)
+    cold_p.add_argument("--head-dim", type=int, default=128)
+    cold_p.add_argument("--repeat", type=int, default=3)
+    cold_p.set_defaults(func=_bench_cold)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
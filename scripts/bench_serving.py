@@ -0,0 +1,471 @@
+#!/usr/bin/env python3
+"""Microbenchmarks for the distributed server's rank-0 request path.
+
+`jitter` measures how request ingestion disturbs decoding. A stand-in decode
+loop runs fixed-size steps on one thread (Python bookkeeping plus a small MLX
+op, like the generation loop) while client threads keep rendering and
+encoding large chat prompts. It reports the decode step interval (p50/p99/
+max) with no ingestion, with ingestion on the calling threads (the default),
+and with a `--tokenizer-workers` process pool.
+
+`control` measures the per-tick control-plane exchange between ranks: the
+packed control frame against the previous pattern of one collective per
+request field plus a separate cancel check. Run it under `mlx.launch -n 2`
+(or more); with a single process the frame skips collectives entirely.
+
+`idle` runs the control loop with sparse requests, once with the previous
+fixed 5 ms poll and once with the idle backoff, and reports control frames
+per second, CPU time and request pickup latency. Also meant for mlx.launch.
+
+`stops` times the per-decode-step stop-sequence bookkeeping on rank 0 for a
+range of batch sizes: per-request, per-sequence KMP in Python (the previous
+implementation) against the cached Aho-Corasick automata.
+
+`delivery` runs a stand-in generation loop that hands one token per step to
+each of `--streams` concurrent streams, with one consumer thread per stream
+writing SSE chunks to a null socket. It compares per-token delivery (one
+wakeup and one write per token, as before) against the coalesced channel
+and reports wakeups and socket writes per token, CPU time and step lag.
+"""
+from __future__ import annotations
+
+import argparse
+import statistics
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Any, List
+
+
+def _repo_root() -> Path:
+    return Path(__file__).resolve().parents[1]
+
+
+sys.path.insert(0, str(_repo_root() / "src"))
+
+
+def _toy_tokenizer() -> Any:
+    """A small byte-level BPE with a ChatML template (no download needed)."""
+    from mlx_lm.tokenizer_utils import TokenizerWrapper
+    from tokenizers import Tokenizer, models, pre_tokenizers, trainers
+    from transformers import PreTrainedTokenizerFast
+
+    tok = Tokenizer(models.BPE(unk_token="<unk>"))
+    tok.pre_tokenizer = pre_tokenizers.ByteLevel()
+    corpus = ["the quick brown fox jumps over the lazy dog; def f(x): return x * 2\n" * 50]
+    tok.train_from_iterator(
+        corpus,
+        trainers.BpeTrainer(
+            vocab_size=2000,
+            special_tokens=["<unk>", "<|im_start|>", "<|im_end|>"],
+            initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+        ),
+    )
+    hf = PreTrainedTokenizerFast(
+        tokenizer_object=tok, unk_token="<unk>", additional_special_tokens=["<|im_start|>", "<|im_end|>"]
+    )
+    hf.chat_template = (
+        "{% for m in messages %}<|im_start|>{{ m.role }}\n{{ m.content }}<|im_end|>\n{% endfor %}"
+        "{% if add_generation_prompt %}<|im_start|>assistant\n{% endif %}"
+    )
+    return TokenizerWrapper(hf)
+
+
+def _load_tokenizer(path: str) -> Any:
+    if not path:
+        return _toy_tokenizer()
+    from mlx_lm.tokenizer_utils import TokenizerWrapper
+    from transformers import AutoTokenizer
+
+    return TokenizerWrapper(AutoTokenizer.from_pretrained(path))
+
+
+def _decode_steps(stop: threading.Event, intervals: List[float]) -> None:
+    import mlx.core as mx
+
+    x = mx.ones((256, 256))
+    history: List[int] = []
+    last = time.perf_counter()
+    while not stop.is_set():
+        y = (x @ x).sum()
+        mx.eval(y)
+        # Per-token Python work: stop-sequence scan, detokenizer bookkeeping.
+        history.append(len(history) % 50_000)
+        _ = sum(history[-64:])
+        now = time.perf_counter()
+        intervals.append(now - last)
+        last = now
+
+
+def _ingest(tokenizer: Any, messages: List[dict], stop: threading.Event, count: List[int]) -> None:
+    while not stop.is_set():
+        prompt = tokenizer.apply_chat_template(messages, add_generation_prompt=True, tokenize=False)
+        tokenizer.encode(prompt)
+        count[0] += 1
+
+
+def _run_jitter(tokenizer: Any, messages: List[dict], clients: int, seconds: float) -> dict:
+    stop = threading.Event()
+    intervals: List[float] = []
+    counts = [[0] for _ in range(clients)]
+    decoder = threading.Thread(target=_decode_steps, args=(stop, intervals))
+    ingest = [threading.Thread(target=_ingest, args=(tokenizer, messages, stop, c)) for c in counts]
+    decoder.start()
+    for t in ingest:
+        t.start()
+    time.sleep(seconds)
+    stop.set()
+    for t in [decoder, *ingest]:
+        t.join()
+    ms = sorted(1000.0 * i for i in intervals[10:])
+    return {
+        "steps": len(ms),
+        "p50": statistics.median(ms),
+        "p99": ms[int(0.99 * (len(ms) - 1))],
+        "max": ms[-1],
+        "prompts": sum(c[0] for c in counts),
+    }
+
+
+def _bench_jitter(args: argparse.Namespace) -> None:
+    from kooka_server.distributed_server.tokenizer_pool import make_tokenizer_pool
+
+    tokenizer = _load_tokenizer(args.tokenizer)
+    turn = "the quick brown fox jumps over the lazy dog " * (args.message_chars // 44 + 1)
+    messages = [
+        {"role": "user" if i % 2 == 0 else "assistant", "content": turn[: args.message_chars]}
+        for i in range(args.messages)
+    ]
+    prompt = tokenizer.apply_chat_template(messages, add_generation_prompt=True, tokenize=False)
+    print(f"prompt: {len(messages)} messages, {len(tokenizer.encode(prompt))} tokens; {args.clients} clients")
+    print(f"{'mode':<12}{'steps':>8}{'p50_ms':>9}{'p99_ms':>9}{'max_ms':>9}{'prompts':>9}")
+
+    rows = [("idle", _run_jitter(tokenizer, messages, 0, args.seconds))]
+    rows.append(("inline", _run_jitter(tokenizer, messages, args.clients, args.seconds)))
+    pool = make_tokenizer_pool(tokenizer, args.workers)
+    if pool is not None:
+        rows.append((f"pool x{args.workers}", _run_jitter(pool, messages, args.clients, args.seconds)))
+        pool.shutdown()
+    for mode, r in rows:
+        print(f"{mode:<12}{r['steps']:>8}{r['p50']:>9.2f}{r['p99']:>9.2f}{r['max']:>9.2f}{r['prompts']:>9}")
+
+
+def _legacy_exchange(rank: int, request: dict | None, stop_len: int) -> None:
+    """One tick of the old control plane: meta, then floats/tokens/stops, then cancels."""
+    import mlx.core as mx
+
+    def all_sum(values: List[int], dtype: Any = mx.int32) -> list:
+        out = mx.distributed.all_sum(mx.array(values if rank == 0 else [0] * len(values), dtype=dtype), stream=mx.cpu)
+        mx.eval(out)
+        return out.tolist()
+
+    mx.synchronize()
+    length = len(request["prompt_tokens"]) if request else 0
+    stop_count = len(request["stop_token_sequences"]) if request else 0
+    meta = all_sum([length, 16, 0, 0, stop_count, 20, 0, 0, 0, 0])
+    if meta[0]:
+        all_sum([0.7, 0.9, 1.0], mx.float32)
+        all_sum(request["prompt_tokens"] if rank == 0 else [0] * meta[0])
+        all_sum([stop_len] * meta[4])
+        all_sum([1] * (meta[4] * 256))
+    all_sum([0])  # canceled uid count
+
+
+def _bench_control(args: argparse.Namespace) -> None:
+    import mlx.core as mx
+
+    from kooka_server.distributed_server.state import DistributedState
+
+    group = mx.distributed.init()
+    state = DistributedState(group)
+    request = {
+        "prompt_tokens": list(range(args.prompt_tokens)),
+        "max_tokens": 16,
+        "temperature": 0.7,
+        "top_p": 0.9,
+        "stop_token_sequences": [[1, 2, 3]],
+    }
+    candidates = [(i, f"req-{i}") for i in range(args.active)]
+
+    def legacy(has_request: bool) -> None:
+        _legacy_exchange(state.rank, request if has_request else None, 3)
+
+    def framed(has_request: bool) -> None:
+        if has_request and state.rank == 0:
+            state.request_queue.put(dict(request))
+        state.sync_control(max_requests=1, cancel_candidates=candidates)
+
+    rows = []
+    for mode, tick in (("legacy", legacy), ("frame", framed)):
+        idle: List[float] = []
+        busy: List[float] = []
+        for i in range(args.ticks):
+            has_request = args.request_every > 0 and i % args.request_every == 0
+            t0 = time.perf_counter()
+            tick(has_request)
+            (busy if has_request else idle).append(1000.0 * (time.perf_counter() - t0))
+        rows.append((mode, sorted(idle), sorted(busy)))
+
+    if state.rank != 0:
+        return
+    print(f"world_size={state.world_size} prompt_tokens={args.prompt_tokens} active={args.active} ticks={args.ticks}")
+    print(f"{'mode':<8}{'idle_p50':>10}{'idle_p99':>10}{'req_p50':>10}{'req_p99':>10}")
+    for mode, idle, busy in rows:
+        cols = []
+        for ms in (idle, busy):
+            cols += [statistics.median(ms), ms[int(0.99 * (len(ms) - 1))]] if ms else [0.0, 0.0]
+        print(f"{mode:<8}" + "".join(f"{c:>10.3f}" for c in cols))
+    print(f"frame collectives: {state.control_plane_stats()}")
+
+
+def _run_idle(mode: str, args: argparse.Namespace) -> dict:
+    import random
+
+    import mlx.core as mx
+
+    from kooka_server.distributed_server.control import IdleBackoff
+    from kooka_server.distributed_server.state import DistributedState
+
+    state = DistributedState(mx.distributed.init())
+    backoff = IdleBackoff(max_wait=args.idle_max_ms / 1000.0)
+    stop = threading.Event()
+
+    def produce() -> None:
+        rng = random.Random(0)
+        while not stop.wait(rng.uniform(0.5, 1.5) * args.interval):
+            state.request_queue.put({"prompt_tokens": [1, 2, 3], "max_tokens": 1})
+        state.request_shutdown()
+
+    if state.rank == 0:
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        threading.Timer(args.seconds, stop.set).start()
+    cpu0, t0 = time.process_time(), time.perf_counter()
+    while True:
+        if mode == "poll":
+            frame = state.sync_control(max_requests=1)
+            if not frame.requests and not frame.shutdown:
+                time.sleep(0.005)
+        else:
+            frame = state.sync_control(max_requests=1, idle_wait=backoff.next())
+            if frame.requests:
+                backoff.reset()
+        if frame.shutdown:
+            break
+    elapsed = time.perf_counter() - t0
+    stats = state.control_plane_stats()
+    return {
+        "frames_per_s": stats["frames"] / elapsed,
+        "cpu_pct": 100.0 * (time.process_time() - cpu0) / elapsed,
+        "pickup_avg": stats["pickup_avg_ms"],
+        "pickup_max": stats["pickup_max_ms"],
+        "requests": stats["requests"],
+        "rank": state.rank,
+        "world_size": state.world_size,
+    }
+
+
+def _bench_idle(args: argparse.Namespace) -> None:
+    rows = [(mode, _run_idle(mode, args)) for mode in ("poll", "backoff")]
+    if rows[0][1]["rank"] != 0:
+        return
+    print(f"world_size={rows[0][1]['world_size']} seconds={args.seconds} request_interval={args.interval}s")
+    print(f"{'mode':<9}{'frames/s':>10}{'cpu%':>8}{'pickup_avg_ms':>15}{'pickup_max_ms':>15}{'requests':>10}")
+    for mode, r in rows:
+        print(
+            f"{mode:<9}{r['frames_per_s']:>10.1f}{r['cpu_pct']:>8.1f}"
+            f"{r['pickup_avg']:>15.3f}{r['pickup_max']:>15.3f}{r['requests']:>10}"
+        )
+
+
+def _kmp_lps(pattern: List[int]) -> List[int]:
+    lps = [0] * len(pattern)
+    length, i = 0, 1
+    while i < len(pattern):
+        if pattern[i] == pattern[length]:
+            length += 1
+            lps[i] = length
+            i += 1
+        elif length:
+            length = lps[length - 1]
+        else:
+            i += 1
+    return lps
+
+
+def _kmp_step(stops: List[List[int]], lps: List[List[int]], match: List[int], token: int) -> tuple:
+    holdback = trim = 0
+    for i, seq in enumerate(stops):
+        l = match[i]
+        while l > 0 and (l == len(seq) or seq[l] != token):
+            l = lps[i][l - 1]
+        if seq[l] == token:
+            l += 1
+        holdback = max(holdback, l)
+        if l == len(seq):
+            trim = max(trim, l)
+        match[i] = l
+    return holdback, trim
+
+
+def _bench_stops(args: argparse.Namespace) -> None:
+    import random
+
+    from kooka_server.distributed_server.stop_matcher import BatchStopMatcher, compile_stop_sequences
+
+    rng = random.Random(0)
+    vocab = 150_000
+    stops = [[rng.randrange(vocab) for _ in range(rng.randint(1, 6))] for _ in range(args.stop_sequences)]
+    lps = [_kmp_lps(s) for s in stops]
+    print(f"stop_sequences={len(stops)} steps={args.steps}")
+    print(f"{'batch':>6}{'kmp_us':>10}{'ac_us':>10}{'speedup':>9}")
+    for batch in args.batch_sizes:
+        tokens = [[rng.randrange(vocab) for _ in range(batch)] for _ in range(args.steps)]
+
+        matches = [[0] * len(stops) for _ in range(batch)]
+        t0 = time.perf_counter()
+        for step in tokens:
+            for b, token in enumerate(step):
+                _kmp_step(stops, lps, matches[b], token)
+        kmp = (time.perf_counter() - t0) / args.steps
+
+        matcher = BatchStopMatcher()
+        uids = list(range(batch))
+        for uid in uids:
+            # Distinct list objects, same stop set: compiled once.
+            matcher.add(uid, compile_stop_sequences([list(s) for s in stops]))
+        t0 = time.perf_counter()
+        for step in tokens:
+            matcher.step(uids, step)
+        ac = (time.perf_counter() - t0) / args.steps
+        print(f"{batch:>6}{1e6 * kmp:>10.1f}{1e6 * ac:>10.1f}{kmp / ac:>8.1f}x")
+
+
+class _NullSocket:
+    def __init__(self) -> None:
+        self.writes = 0
+
+    def write(self, data: bytes) -> None:
+        self.writes += 1
+
+    def flush(self) -> None:
+        pass
+
+
+def _consume(stream: Any, sock: _NullSocket, per_token: bool) -> None:
+    import json
+
+    text = ""
+    while True:
+        item = stream.get(timeout=10)
+        if item is None:
+            break
+        text += item["text"]
+        if not per_token and stream.ready():
+            continue
+        sock.write(f"data: {json.dumps({'choices': [{'delta': {'content': text}}]})}\n\n".encode())
+        text = ""
+
+
+def _run_delivery(args: argparse.Namespace, tokenizer: Any, flush_tokens: int, flush_ms: float) -> dict:
+    from kooka_server.distributed_server.token_stream import TokenChannel, TokenDeliveryStats, TokenStream
+
+    stats = TokenDeliveryStats()
+    channels = [TokenChannel(flush_tokens, flush_ms) for _ in range(args.streams)]
+    sockets = [_NullSocket() for _ in channels]
+    per_token = flush_tokens == 1 and flush_ms == 0
+    consumers = [
+        threading.Thread(target=_consume, args=(TokenStream(c, tokenizer, stats=stats), sock, per_token))
+        for c, sock in zip(channels, sockets)
+    ]
+    for t in consumers:
+        t.start()
+
+    step_s = 1.0 / args.tokens_per_second
+    steps = int(args.seconds * args.tokens_per_second)
+    lag = []
+    cpu0 = time.process_time()
+    start = time.perf_counter()
+    for step in range(steps):
+        due = start + step * step_s
+        now = time.perf_counter()
+        if now < due:
+            time.sleep(due - now)
+        lag.append(time.perf_counter() - due)
+        for channel in channels:
+            channel.put((97 + step % 26, None))
+    for channel in channels:
+        channel.put(None)
+    for t in consumers:
+        t.join()
+    cpu = time.process_time() - cpu0
+    snapshot = stats.snapshot()
+    writes = sum(sock.writes for sock in sockets)
+    return {
+        "wakeups_per_token": snapshot["wakeups_per_token"],
+        "writes_per_token": writes / max(1, snapshot["tokens"]),
+        "cpu_s": cpu,
+        "lag_p99_ms": 1000.0 * sorted(lag)[int(0.99 * (len(lag) - 1))],
+    }
+
+
+def _bench_delivery(args: argparse.Namespace) -> None:
+    print(f"streams={args.streams} tokens_per_second={args.tokens_per_second} seconds={args.seconds}")
+    print(f"{'mode':>22}{'wakeups/tok':>13}{'writes/tok':>12}{'cpu_s':>8}{'lag_p99_ms':>12}")
+    tokenizer = _toy_tokenizer()
+    modes = [("per-token", 1, 0.0), (f"coalesced {args.flush_tokens}/{args.flush_ms:g}ms", args.flush_tokens, args.flush_ms)]
+    for name, flush_tokens, flush_ms in modes:
+        r = _run_delivery(args, tokenizer, flush_tokens, flush_ms)
+        print(
+            f"{name:>22}{r['wakeups_per_token']:>13.3f}{r['writes_per_token']:>12.3f}"
+            f"{r['cpu_s']:>8.2f}{r['lag_p99_ms']:>12.2f}"
+        )
+
+
+def main(argv: List[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    jitter_p = sub.add_parser("jitter", help="Decode step jitter under concurrent large-prompt ingestion")
+    jitter_p.add_argument("--tokenizer", default="", help="HF tokenizer path or repo (default: built-in toy BPE)")
+    jitter_p.add_argument("--messages", type=int, default=200)
+    jitter_p.add_argument("--message-chars", type=int, default=2000)
+    jitter_p.add_argument("--clients", type=int, default=4)
+    jitter_p.add_argument("--workers", type=int, default=2)
+    jitter_p.add_argument("--seconds", type=float, default=5.0)
+    jitter_p.set_defaults(func=_bench_jitter)
+
+    control_p = sub.add_parser("control", help="Per-tick control-plane latency across ranks (run under mlx.launch)")
+    control_p.add_argument("--ticks", type=int, default=2000)
+    control_p.add_argument("--request-every", type=int, default=10, help="Queue a request every N ticks (0: never)")
+    control_p.add_argument("--prompt-tokens", type=int, default=128)
+    control_p.add_argument("--active", type=int, default=4, help="Active requests checked for cancellation")
+    control_p.set_defaults(func=_bench_control)
+
+    idle_p = sub.add_parser("idle", help="Idle control-frame rate and request pickup latency (run under mlx.launch)")
+    idle_p.add_argument("--seconds", type=float, default=10.0)
+    idle_p.add_argument("--interval", type=float, default=0.5, help="Mean seconds between requests")
+    idle_p.add_argument("--idle-max-ms", type=int, default=100)
+    idle_p.set_defaults(func=_bench_idle)
+
+    stops_p = sub.add_parser("stops", help="Per-step stop-sequence bookkeeping cost against batch size")
+    stops_p.add_argument("--stop-sequences", type=int, default=8)
+    stops_p.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4, 16, 64])
+    stops_p.add_argument("--steps", type=int, default=2000)
+    stops_p.set_defaults(func=_bench_stops)
+
+    delivery_p = sub.add_parser("delivery", help="Token delivery wakeups and socket writes per generated token")
+    delivery_p.add_argument("--streams", type=int, default=16)
+    delivery_p.add_argument("--tokens-per-second", type=float, default=40.0, help="Per stream")
+    delivery_p.add_argument("--seconds", type=float, default=5.0)
+    delivery_p.add_argument("--flush-tokens", type=int, default=4)
+    delivery_p.add_argument("--flush-ms", type=float, default=50.0)
+    delivery_p.set_defaults(func=_bench_delivery)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
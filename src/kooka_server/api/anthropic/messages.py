@@ -1,7 +1,8 @@
 from __future__ import annotations
 
 import json
-from typing import Any, Optional
+import logging
+from typing import Any, Callable, Optional
 
 
 def convert_anthropic_to_openai_messages(body: dict) -> list[dict]:
@@ -130,3 +131,103 @@ def process_message_content(messages: list[dict]) -> None:
                             func["arguments"] = "{}"
                 elif args is not None:
                     func["arguments"] = json.dumps(args, ensure_ascii=False)
+
+
+# Anthropic accepts at most four cache_control breakpoints per request.
+MAX_CACHE_BREAKPOINTS = 4
+_CACHE_TTLS = {"5m": 300, "1h": 3600}
+
+
+def _cache_ttl(block: Any) -> Optional[int]:
+    if not isinstance(block, dict):
+        return None
+    control = block.get("cache_control")
+    if not isinstance(control, dict) or control.get("type", "ephemeral") != "ephemeral":
+        return None
+    return _CACHE_TTLS.get(control.get("ttl", "5m"), _CACHE_TTLS["5m"])
+
+
+def cache_control_prefixes(body: dict) -> list[tuple[dict, int]]:
+    """Return (prefix body, ttl seconds) for each cache_control breakpoint.
+
+    Each prefix body keeps everything up to and including the marked block,
+    in Anthropic's cache order: tools, then system, then messages. Only the
+    last MAX_CACHE_BREAKPOINTS are kept.
+    """
+    prefixes: list[tuple[dict, int]] = []
+
+    tools = body.get("tools")
+    if isinstance(tools, list):
+        for i, tool in enumerate(tools):
+            ttl = _cache_ttl(tool)
+            if ttl is not None:
+                prefixes.append(({"tools": tools[: i + 1]}, ttl))
+
+    head = {"tools": tools} if tools else {}
+    system = body.get("system")
+    if isinstance(system, list):
+        for i, block in enumerate(system):
+            ttl = _cache_ttl(block)
+            if ttl is not None:
+                prefixes.append(({**head, "system": system[: i + 1]}, ttl))
+    if system:
+        head["system"] = system
+
+    messages = body.get("messages")
+    if isinstance(messages, list):
+        for i, msg in enumerate(messages):
+            content = msg.get("content") if isinstance(msg, dict) else None
+            if not isinstance(content, list):
+                continue
+            for j, block in enumerate(content):
+                ttl = _cache_ttl(block)
+                if ttl is not None:
+                    truncated = messages[:i] + [{**msg, "content": content[: j + 1]}]
+                    prefixes.append(({**head, "messages": truncated}, ttl))
+
+    return prefixes[-MAX_CACHE_BREAKPOINTS:]
+
+
+def cache_control_offsets(
+    body: dict,
+    prompt_tokens: list[int],
+    render: Callable[[list[dict], Optional[list[dict]]], list[int]],
+) -> list[tuple[int, int]]:
+    """Map cache_control breakpoints to (token offset, ttl seconds) in `prompt_tokens`.
+
+    `render(messages, tools)` tokenizes a converted prefix without a
+    generation prompt. The offset is where that rendering stops agreeing with
+    the full prompt, so template tokens that close a truncated turn are never
+    counted. Breakpoints that fail to render are skipped.
+    """
+    offsets: dict[int, int] = {}
+    for prefix, ttl in cache_control_prefixes(body):
+        messages = convert_anthropic_to_openai_messages(prefix)
+        process_message_content(messages)
+        try:
+            tokens = render(messages, convert_anthropic_tools(prefix.get("tools")))
+        except Exception:
+            logging.debug("Failed to render cache_control prefix", exc_info=True)
+            continue
+        n = 0
+        limit = min(len(tokens), len(prompt_tokens) - 1)
+        while n < limit and tokens[n] == prompt_tokens[n]:
+            n += 1
+        if n > 0:
+            offsets[n] = max(ttl, offsets.get(n, 0))
+    return sorted(offsets.items())
+
+
+def anthropic_usage(
+    prompt_tokens: int,
+    output_tokens: int,
+    cache_read_tokens: int = 0,
+    cache_creation_tokens: int = 0,
+) -> dict:
+    """Anthropic usage block; `input_tokens` excludes cache reads and writes."""
+    return {
+        "input_tokens": max(0, prompt_tokens - cache_read_tokens - cache_creation_tokens),
+        "output_tokens": output_tokens,
+        "cache_creation_input_tokens": cache_creation_tokens,
+        "cache_read_input_tokens": cache_read_tokens,
+    }
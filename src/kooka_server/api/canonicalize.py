@@ -0,0 +1,163 @@
+"""Request canonicalization ahead of the chat template.
+
+Clients often send the same conversation with cosmetic differences: tools in
+a different order, schema keys in a different order, CRLF line endings or
+trailing whitespace. Each of those changes the rendered prompt early and
+turns a prompt-cache hit into a full re-prefill. Canonicalizing the messages
+and tools first makes equivalent requests render to the same tokens.
+"""
+from __future__ import annotations
+
+import datetime
+import json
+import logging
+from dataclasses import dataclass, field
+from threading import Lock
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+
+@dataclass
+class CanonicalizationStats:
+    """Running totals across requests (read by stats endpoints and logs)."""
+
+    requests: int = 0
+    changed: int = 0
+    tokens_saved: int = 0
+    _lock: Lock = field(default_factory=Lock, repr=False)
+
+    def record(self, changes: Sequence[str]) -> None:
+        with self._lock:
+            self.requests += 1
+            self.changed += int(bool(changes))
+
+    def add_saved(self, tokens_saved: int) -> None:
+        with self._lock:
+            self.tokens_saved += tokens_saved
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return {"requests": self.requests, "changed": self.changed, "tokens_saved": self.tokens_saved}
+
+
+def _tool_name(tool: Any) -> str:
+    if not isinstance(tool, dict):
+        return ""
+    func = tool.get("function")
+    name = func.get("name") if isinstance(func, dict) else tool.get("name")
+    return name if isinstance(name, str) else ""
+
+
+def _sort_keys(value: Any) -> Any:
+    """Recursively sort dict keys; list order is kept (it can be meaningful)."""
+    if isinstance(value, dict):
+        return {k: _sort_keys(value[k]) for k in sorted(value, key=str)}
+    if isinstance(value, list):
+        return [_sort_keys(v) for v in value]
+    return value
+
+
+def canonicalize_tools(tools: Any) -> Tuple[Any, List[str]]:
+    """Sort tools by name and their schemas' keys. Returns (tools, changes)."""
+    if not isinstance(tools, list) or not tools:
+        return tools, []
+    changes = []
+    ordered = sorted(tools, key=_tool_name)
+    if [_tool_name(t) for t in ordered] != [_tool_name(t) for t in tools]:
+        changes.append("tool_order")
+    canonical = [_sort_keys(t) for t in ordered]
+    if json.dumps(canonical, default=str) != json.dumps(ordered, default=str):
+        changes.append("schema_keys")
+    return canonical, changes
+
+
+def _normalize_text(text: str) -> str:
+    return text.replace("\r\n", "\n").rstrip()
+
+
+def canonicalize_messages(messages: List[Any]) -> Tuple[List[Any], List[str]]:
+    """Normalize line endings and trailing whitespace of text content.
+
+    Only the end of each text block is stripped; indentation and inner
+    whitespace are left alone since they can be meaningful (code, markdown).
+    Assistant turns are kept verbatim: they echo generated tokens, which the
+    prompt cache already holds as generated. Messages are copied when
+    changed, never mutated.
+    """
+    out = []
+    changed = False
+    for message in messages:
+        if not isinstance(message, dict) or message.get("role") == "assistant":
+            out.append(message)
+            continue
+        content = message.get("content")
+        if isinstance(content, str):
+            new_content: Any = _normalize_text(content)
+        elif isinstance(content, list):
+            new_content = [
+                {**part, "text": _normalize_text(part["text"])}
+                if isinstance(part, dict) and isinstance(part.get("text"), str)
+                else part
+                for part in content
+            ]
+        else:
+            new_content = content
+        if new_content != content:
+            changed = True
+            message = {**message, "content": new_content}
+        out.append(message)
+    return out, ["whitespace"] if changed else []
+
+
+def canonicalize_request(messages: List[Any], tools: Any) -> Tuple[List[Any], Any, List[str]]:
+    """Canonicalize a chat request. Returns (messages, tools, changes)."""
+    tools, tool_changes = canonicalize_tools(tools)
+    messages, message_changes = canonicalize_messages(messages)
+    return messages, tools, tool_changes + message_changes
+
+
+def pinned_template_vars(template_vars: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """Chat-template kwargs that pin per-call values such as the current date.
+
+    Plain values are passed through (e.g. Llama's `date_string`). A string
+    `strftime_now` is parsed as an ISO date/time and replaces the template
+    helper of that name, so templates that format "today" render the same
+    text on every request.
+    """
+    pinned = dict(template_vars or {})
+    now = pinned.get("strftime_now")
+    if isinstance(now, str):
+        fixed = datetime.datetime.fromisoformat(now)
+        pinned["strftime_now"] = fixed.strftime
+    return pinned
+
+
+def common_prefix_len(a: Sequence[int], b: Sequence[int]) -> int:
+    n = min(len(a), len(b))
+    for i in range(n):
+        if a[i] != b[i]:
+            return i
+    return n
+
+
+def log_canonicalization(changes: Sequence[str], tokens_saved: int, stats: CanonicalizationStats) -> None:
+    if not changes:
+        return
+    totals = stats.snapshot()
+    logging.info(
+        "Canonicalized prompt (%s): saved %d prefill tokens (total %d over %d requests)",
+        ",".join(changes),
+        tokens_saved,
+        totals["tokens_saved"],
+        totals["requests"],
+    )
+
+
+__all__ = [
+    "CanonicalizationStats",
+    "canonicalize_messages",
+    "canonicalize_request",
+    "canonicalize_tools",
+    "common_prefix_len",
+    "log_canonicalization",
+    "pinned_template_vars",
+]
@@ -28,6 +28,18 @@ def main() -> None:
         default="{}",
         help='JSON args for apply_chat_template, e.g. \'{"enable_thinking": false}\'',
     )
+    serve_p.add_argument(
+        "--canonicalize-prompts",
+        action="store_true",
+        help="Sort tools and tool-schema keys and normalize message whitespace before applying the chat template.",
+    )
+    serve_p.add_argument(
+        "--pin-template-vars",
+        type=json.loads,
+        default="{}",
+        help='JSON variables passed to the chat template on every request, e.g. \'{"date_string": "01 Jan 2026"}\'. '
+        'A "strftime_now" ISO date pins templates that format the current date.',
+    )
     serve_p.add_argument("--temp", type=float, default=0.0)
     serve_p.add_argument("--top-p", type=float, default=1.0)
     serve_p.add_argument("--top-k", type=int, default=0)
@@ -54,6 +66,78 @@ def main() -> None:
         default=2,
         help="Maximum number of prompt-cache entries to keep (LRU). Set to 0 to disable.",
     )
+    dist_p.add_argument(
+        "--prompt-cache-bytes",
+        type=int,
+        default=0,
+        help="Per-rank byte budget for prompt-cache KV arrays (0 disables). Enables cost-aware eviction.",
+    )
+    dist_p.add_argument(
+        "--prompt-cache-memory-fraction",
+        type=float,
+        default=0.0,
+        help="Per-rank prompt-cache budget as a fraction of device working-set memory (0 disables).",
+    )
+    dist_p.add_argument(
+        "--prompt-cache-dir",
+        type=str,
+        default="",
+        help="Directory for a persistent on-disk prompt-cache tier (evicted entries, and all entries at shutdown).",
+    )
+    dist_p.add_argument(
+        "--prompt-cache-disk-bytes",
+        type=int,
+        default=0,
+        help="Per-rank byte budget for the on-disk prompt-cache tier (0 = unlimited).",
+    )
+    dist_p.add_argument(
+        "--prompt-cache-checkpoint-turns",
+        type=int,
+        default=0,
+        help="Also snapshot non-trimmable caches at the last N assistant-turn starts in each prompt (prompt ends always are).",
+    )
+    dist_p.add_argument(
+        "--prompt-cache-turn-marker",
+        type=str,
+        default="",
+        help="Text that opens an assistant turn (default: derived from the chat template's generation prompt).",
+    )
+    dist_p.add_argument(
+        "--prompt-cache-checkpoint-interval",
+        type=int,
+        default=0,
+        help="Snapshot non-trimmable (recurrent) caches every N prompt tokens during prefill (0 disables).",
+    )
+    dist_p.add_argument(
+        "--prompt-cache-checkpoint-max",
+        type=int,
+        default=4,
+        help="Keep at most this many periodic snapshots per prompt (the ones closest to the prompt end).",
+    )
+    dist_p.add_argument(
+        "--prompt-cache-cold-after",
+        type=float,
+        default=0.0,
+        help="Quantize prompt-cache entries idle for this many seconds; dequantized on a hit (0 disables).",
+    )
+    dist_p.add_argument(
+        "--prompt-cache-cold-bits",
+        type=int,
+        default=8,
+        choices=[4, 8],
+        help="Bits for quantized (cold) prompt-cache entries.",
+    )
+    dist_p.add_argument(
+        "--prompt-cache-cold-group-size",
+        type=int,
+        default=64,
+        help="Quantization group size for cold prompt-cache entries.",
+    )
+    dist_p.add_argument(
+        "--prompt-cache-compact",
+        action="store_true",
+        help="Copy KV buffers down to their used length when inserting into the prompt cache (drops step slack).",
+    )
     dist_p.add_argument(
         "--batch",
         action="store_true",
@@ -83,12 +167,91 @@ def main() -> None:
         default=1,
         help="Number of batch decode steps to run between request polls.",
     )
+    dist_p.add_argument(
+        "--batch-tick-token-budget",
+        type=int,
+        default=2048,
+        help="Tokens per batch tick: new prompts are prefilled in chunks with what decoding the active batch leaves.",
+    )
     dist_p.add_argument(
         "--batch-wait-ms",
         type=int,
         default=10,
         help="When starting a new batch, wait up to this long to gather more requests.",
     )
+    dist_p.add_argument(
+        "--idle-poll-max-ms",
+        type=int,
+        default=100,
+        help="Longest gap between control frames while idle; rank 0 still sends one as soon as a request arrives.",
+    )
+    dist_p.add_argument(
+        "--stream-flush-tokens",
+        type=int,
+        default=4,
+        help="Wake a streaming response for every this many tokens (the first token is always sent at once).",
+    )
+    dist_p.add_argument(
+        "--stream-flush-ms",
+        type=float,
+        default=50.0,
+        help="Longest a generated token waits before a streaming response is woken to send it.",
+    )
+    dist_p.add_argument(
+        "--priority-classes",
+        type=json.loads,
+        default='{"interactive": 16, "batch": 1}',
+        help="JSON priority classes and their admission weights; the first is the default. Requests pick one "
+        "with an X-Priority header or a \"priority\" body field.",
+    )
+    dist_p.add_argument(
+        "--priority-api-keys",
+        type=json.loads,
+        default="{}",
+        help='JSON map of API key to priority class, e.g. \'{"sk-summarizer": "batch"}\'; overrides the request\'s own choice.',
+    )
+    dist_p.add_argument(
+        "--priority-max-wait-s",
+        type=float,
+        default=30.0,
+        help="A request queued longer than this is admitted next whatever its class (starvation guard).",
+    )
+    dist_p.add_argument(
+        "--max-queued-requests",
+        type=int,
+        default=0,
+        help="Answer new requests with 429 and a Retry-After once this many are queued (0 = unbounded).",
+    )
+    dist_p.add_argument(
+        "--max-context-tokens",
+        type=int,
+        default=0,
+        help="Reject prompts this long or longer before queueing them (0 = the model config's max_position_embeddings).",
+    )
+    dist_p.add_argument(
+        "--canonicalize-prompts",
+        action="store_true",
+        help="Sort tools and tool-schema keys and normalize message whitespace before applying the chat template.",
+    )
+    dist_p.add_argument(
+        "--pin-template-vars",
+        type=json.loads,
+        default="{}",
+        help='JSON variables passed to the chat template on every request, e.g. \'{"date_string": "01 Jan 2026"}\'. '
+        'A "strftime_now" ISO date pins templates that format the current date.',
+    )
+    dist_p.add_argument(
+        "--prompt-token-cache-size",
+        type=int,
+        default=32,
+        help="Conversations whose tokenized prompt prefix is kept so the next turn only encodes its new tail (0 disables).",
+    )
+    dist_p.add_argument(
+        "--tokenizer-workers",
+        type=int,
+        default=0,
+        help="Processes for chat templating, prompt/stop encoding and decoding on rank 0 (0 = on the HTTP threads).",
+    )
 
     args = parser.parse_args()
 
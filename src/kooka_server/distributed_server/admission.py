@@ -0,0 +1,215 @@
+"""Rank 0's request queue: priority classes and weighted-fair admission.
+
+Requests only leave this queue when the generation loop has room for them
+(`sync_control` asks for at most the free `max_inflight` slots), so the
+order `get` hands them out in is the admission order. The other ranks just
+apply requests in the order the control frame carries them.
+
+Each request names a priority class (`"priority"`) and a client
+(`"client"`). Classes share admissions in proportion to their weights
+(stride scheduling): the non-empty class with the smallest virtual time
+goes next and advances it by 1/weight. A class that was idle starts from
+the current virtual time, so it can't bank credit while it has nothing
+queued. Within a class, clients take turns, so one client's burst doesn't
+hold back the others. A request that has waited longer than `max_wait`
+seconds is admitted next whatever its class, so low-weight work is never
+starved outright.
+
+While requests are queued, every admission waited for a slot to free up, so
+the gaps between those admissions measure the loop's service rate.
+`backlog` turns that into a lower bound on a new request's queue wait, which
+the HTTP handlers compare with its deadline.
+"""
+from __future__ import annotations
+
+import math
+import time
+from collections import OrderedDict, deque
+from queue import Empty
+from threading import Condition
+from typing import Any, Deque, Dict, Mapping, Optional, Tuple
+
+# The first class is the default for requests that don't name one.
+DEFAULT_PRIORITY_CLASSES: Dict[str, float] = {"interactive": 16.0, "batch": 1.0}
+DEFAULT_MAX_WAIT = 30.0
+# Recent queue waits kept per class for the percentiles.
+_WAIT_WINDOW = 1024
+# Recent gaps between admissions made while requests were queued.
+_SERVICE_WINDOW = 64
+
+
+def _percentile_ms(values: list, q: float) -> float:
+    return 1000.0 * values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+
+def deadline_error(retry_after: float) -> dict:
+    """Response item for a request dropped because it can no longer meet its deadline."""
+    return {
+        "text": "Error: request deadline exceeded before generation started",
+        "finish_reason": "error",
+        "status": 503,
+        "retry_after": max(1, math.ceil(retry_after)),
+    }
+
+
+class _ClassStats:
+    def __init__(self) -> None:
+        self.admitted = 0
+        self.promoted = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.waits: Deque[float] = deque(maxlen=_WAIT_WINDOW)
+
+    def record(self, wait: float, promoted: bool) -> None:
+        self.admitted += 1
+        self.promoted += int(promoted)
+        self.wait_seconds += wait
+        self.max_wait_seconds = max(self.max_wait_seconds, wait)
+        self.waits.append(wait)
+
+
+class AdmissionQueue:
+    """Queue-compatible (`put`, `get`, `get_nowait`) weighted-fair request queue."""
+
+    def __init__(self, classes: Optional[Mapping[str, float]] = None, max_wait: float = DEFAULT_MAX_WAIT):
+        self._cond = Condition()
+        # class -> client -> that client's requests, in arrival order.
+        self._lanes: Dict[str, "OrderedDict[str, Deque[dict]]"] = {}
+        self._vtime: Dict[str, float] = {}
+        self._now = 0.0  # Virtual time of the last admission
+        self._size = 0
+        self._queued_tokens: Dict[str, int] = {}
+        self._stats: Dict[str, _ClassStats] = {}
+        self._backlogged_since: Optional[float] = None
+        self._service_gaps: Deque[float] = deque(maxlen=_SERVICE_WINDOW)
+        self.configure(classes or DEFAULT_PRIORITY_CLASSES, max_wait)
+
+    def configure(self, classes: Mapping[str, float], max_wait: float = DEFAULT_MAX_WAIT) -> None:
+        weights = {str(name): float(weight) for name, weight in classes.items()}
+        if not weights:
+            raise ValueError("At least one priority class is required")
+        for name, weight in weights.items():
+            if weight <= 0:
+                raise ValueError(f"Priority class {name!r} needs a positive weight, got {weight}")
+        with self._cond:
+            self._weights = weights
+            self.default_priority = next(iter(weights))
+            self.max_wait = float(max_wait)
+            for name in weights:
+                self._stats.setdefault(name, _ClassStats())
+
+    @property
+    def classes(self) -> Dict[str, float]:
+        return dict(self._weights)
+
+    def put(self, item: dict, block: bool = True, timeout: Optional[float] = None) -> None:
+        item.setdefault("enqueued_at", time.perf_counter())
+        priority = item.get("priority")
+        if priority not in self._weights:
+            priority = self.default_priority
+        item["priority"] = priority
+        with self._cond:
+            lane = self._lanes.setdefault(priority, OrderedDict())
+            if not lane:
+                self._vtime[priority] = max(self._vtime.get(priority, 0.0), self._now)
+            lane.setdefault(str(item.get("client") or ""), deque()).append(item)
+            self._size += 1
+            self._queued_tokens[priority] = self._queued_tokens.get(priority, 0) + len(item.get("prompt_tokens") or ())
+            self._cond.notify()
+
+    def get(self, block: bool = True, timeout: Optional[float] = None) -> dict:
+        with self._cond:
+            if block:
+                if not self._cond.wait_for(lambda: self._size > 0, timeout):
+                    raise Empty
+            elif self._size == 0:
+                raise Empty
+            return self._pop()
+
+    def get_nowait(self) -> dict:
+        return self.get(block=False)
+
+    def qsize(self) -> int:
+        return self._size
+
+    def empty(self) -> bool:
+        return self._size == 0
+
+    def backlog(self, priority: str) -> Tuple[float, float, Optional[float]]:
+        """(requests, prompt tokens, admissions/s) standing between a new `priority` request and a slot.
+
+        Other classes are admitted alongside it in proportion to their
+        weights, so what is queued in its own class counts scaled up by the
+        class's share. The rate is None until enough admissions were seen.
+        """
+        with self._cond:
+            active = {name for name, lane in self._lanes.items() if lane} | {priority}
+            share = self._weights.get(priority, 1.0) / sum(self._weights.get(name, 1.0) for name in active)
+            queued = sum(len(q) for q in self._lanes.get(priority, {}).values())
+            tokens = self._queued_tokens.get(priority, 0)
+            gaps = list(self._service_gaps)
+        rate = len(gaps) / sum(gaps) if len(gaps) >= 4 and sum(gaps) > 0 else None
+        return queued / share, tokens / share, rate
+
+    def _pop(self) -> dict:
+        now = time.perf_counter()
+        # Starvation guard: the oldest request overall, if it has waited too long.
+        priority, client, oldest = None, None, None
+        for name, lane in self._lanes.items():
+            for who, queue in lane.items():
+                if oldest is None or queue[0]["enqueued_at"] < oldest:
+                    priority, client, oldest = name, who, queue[0]["enqueued_at"]
+        promoted = oldest is not None and now - oldest > self.max_wait
+        if not promoted:
+            order = list(self._weights)
+            priority = min(
+                (name for name, lane in self._lanes.items() if lane),
+                key=lambda name: (self._vtime[name], order.index(name) if name in order else len(order)),
+            )
+            client = next(iter(self._lanes[priority]))
+
+        lane = self._lanes[priority]
+        queue = lane[client]
+        item = queue.popleft()
+        if queue:
+            lane.move_to_end(client)
+        else:
+            del lane[client]
+        self._size -= 1
+        self._queued_tokens[priority] -= len(item.get("prompt_tokens") or ())
+        if self._backlogged_since is not None:
+            self._service_gaps.append(now - self._backlogged_since)
+        self._backlogged_since = now if self._size else None
+        self._now = max(self._now, self._vtime[priority])
+        self._vtime[priority] += 1.0 / self._weights.get(priority, 1.0)
+        self._stats.setdefault(priority, _ClassStats()).record(now - item["enqueued_at"], promoted)
+        return item
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            queued = {name: sum(len(q) for q in lane.values()) for name, lane in self._lanes.items()}
+            snapshot = {name: (s.admitted, s.promoted, s.wait_seconds, s.max_wait_seconds, sorted(s.waits))
+                        for name, s in self._stats.items()}
+        classes = {}
+        for name, (admitted, promoted, total, longest, waits) in snapshot.items():
+            classes[name] = {
+                "weight": self._weights.get(name),
+                "queued": queued.get(name, 0),
+                "admitted": admitted,
+                # Admitted ahead of their turn by the starvation guard.
+                "promoted": promoted,
+                "wait_avg_ms": 1000.0 * total / admitted if admitted else 0.0,
+                # Over the last _WAIT_WINDOW admissions.
+                "wait_p50_ms": _percentile_ms(waits, 0.5),
+                "wait_p99_ms": _percentile_ms(waits, 0.99),
+                "wait_max_ms": 1000.0 * longest,
+            }
+        return {
+            "default_priority": self.default_priority,
+            "max_wait_s": self.max_wait,
+            "classes": classes,
+            "admissions_per_s": self.backlog(self.default_priority)[2],
+        }
+
+
+__all__ = ["AdmissionQueue", "DEFAULT_MAX_WAIT", "DEFAULT_PRIORITY_CLASSES", "deadline_error"]
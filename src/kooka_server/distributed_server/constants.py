@@ -4,17 +4,35 @@ from __future__ import annotations
 DEFAULT_REPETITION_PENALTY = 0.0
 DEFAULT_REPETITION_CONTEXT_SIZE = 20
 
-# Maximum prompt length for broadcasting (in tokens).
+# Maximum prefix/session length for cache admin ops (in tokens). Longer
+# generation prompts are sent to the other ranks in chunks of this size.
 MAX_PROMPT_LENGTH = 131072
 
 # Stop sequence broadcast limits.
 MAX_STOP_SEQUENCES = 8
 MAX_STOP_SEQUENCE_LENGTH = 256
 
+# Prompt-cache breakpoints per request (Anthropic `cache_control` allows four).
+MAX_CACHE_BREAKPOINTS = 4
+
+# Broadcast request kinds: generate, or prompt-cache admin operations that
+# every rank must apply at the same point in the loop.
+REQUEST_OP_GENERATE = 0
+REQUEST_OP_PIN_PREFIX = 1
+REQUEST_OP_UNPIN_PREFIX = 2
+REQUEST_OP_EXPORT_SESSION = 3
+REQUEST_OP_IMPORT_SESSION = 4
+
 __all__ = [
     "DEFAULT_REPETITION_PENALTY",
     "DEFAULT_REPETITION_CONTEXT_SIZE",
     "MAX_PROMPT_LENGTH",
     "MAX_STOP_SEQUENCES",
     "MAX_STOP_SEQUENCE_LENGTH",
+    "MAX_CACHE_BREAKPOINTS",
+    "REQUEST_OP_GENERATE",
+    "REQUEST_OP_PIN_PREFIX",
+    "REQUEST_OP_UNPIN_PREFIX",
+    "REQUEST_OP_EXPORT_SESSION",
+    "REQUEST_OP_IMPORT_SESSION",
 ]
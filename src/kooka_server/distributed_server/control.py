@@ -0,0 +1,374 @@
+"""Control frame broadcast by rank 0 once per generation-loop tick.
+
+Every rank has to apply the same requests, cancellations and shutdown at the
+same point of the loop. Instead of one collective per field (metadata,
+floats, tokens, stop sequences, cancel flags), rank 0 packs them into a
+single int32 frame:
+
+    header: [version, shutdown, clock, request_count, cancel_count, payload_words]
+    payload: canceled request seqs, then one record per request
+
+A request record is
+
+    [seq, op, length, max_tokens, seed, seed_is_user, top_k,
+     repetition_context_size, temperature, top_p, repetition_penalty,
+     stop_count, breakpoint_count, base_id, base_len,
+     (stop_len, stop tokens...) * stop_count,
+     (offset, ttl) * breakpoint_count,
+     prompt tokens[base_len:]...]
+
+with floats stored as their float32 bit patterns. The frame is all-summed
+with the other ranks' zeros, so every rank also adds its own `version`
+(a mismatch shows up as a sum that is not `version * world_size`) and may
+raise `shutdown`. Frames longer than `CONTROL_FRAME_WORDS` spill into
+follow-up collectives of at most `MAX_PROMPT_LENGTH` words each, sized from
+the header, so long prompts are never truncated.
+
+Multi-turn prompts mostly repeat the previous turn, so prompts are sent as a
+delta: `base_id` names an entry of the `PromptHistory` every rank keeps in
+lockstep (recent prompts and finished generations), and only the tokens
+after its first `base_len` are on the wire.
+"""
+from __future__ import annotations
+
+import struct
+from array import array
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from .constants import (
+    DEFAULT_REPETITION_CONTEXT_SIZE,
+    DEFAULT_REPETITION_PENALTY,
+    MAX_CACHE_BREAKPOINTS,
+    MAX_STOP_SEQUENCES,
+    MAX_STOP_SEQUENCE_LENGTH,
+    REQUEST_OP_GENERATE,
+)
+
+CONTROL_FRAME_VERSION = 1
+
+# Inline frame size (int32 words): room for cancellations and short prompts,
+# so most ticks need exactly one collective.
+CONTROL_FRAME_WORDS = 512
+
+_HEADER_WORDS = 6
+_RECORD_WORDS = 15
+
+# A history entry is only worth referencing when it saves at least this much.
+_MIN_DELTA_TOKENS = 64
+
+
+@dataclass
+class ControlRequest:
+    """A request as every rank sees it. `request` is rank 0's original dict."""
+
+    seq: int
+    prompt_tokens: List[int]
+    max_tokens: int
+    seed: int
+    seed_is_user: bool
+    temperature: float
+    top_p: float
+    top_k: int
+    repetition_penalty: float
+    repetition_context_size: int
+    stop_token_sequences: List[List[int]] = field(default_factory=list)
+    op: int = REQUEST_OP_GENERATE
+    # (token offset, retain_until) on the request clock.
+    cache_breakpoints: List[Tuple[int, int]] = field(default_factory=list)
+    request: Optional[Dict[str, Any]] = None
+
+    @property
+    def request_id(self) -> Optional[str]:
+        return self.request.get("request_id") if self.request else None
+
+    @property
+    def response_queue(self) -> Any:
+        return self.request.get("response_queue") if self.request else None
+
+
+@dataclass
+class ControlFrame:
+    requests: List[ControlRequest] = field(default_factory=list)
+    canceled: List[int] = field(default_factory=list)
+    shutdown: bool = False
+    clock: int = 0
+
+
+def _shared_prefix(a: array, b: array) -> int:
+    """Length of the common prefix of two token arrays (slice compares run in C)."""
+    n = min(len(a), len(b))
+    if n == 0 or a[0] != b[0]:
+        return 0
+    # Gallop to the first mismatching power of two, then bisect.
+    lo, hi = 1, 2
+    while hi <= n and a[:hi] == b[:hi]:
+        lo, hi = hi, hi * 2
+    hi = min(hi, n + 1)
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if a[:mid] == b[:mid]:
+            lo = mid
+        else:
+            hi = mid
+    return lo
+
+
+class PromptHistory:
+    """Recent token sequences, identical on every rank.
+
+    Every rank must call `remember` with the same sequences in the same order
+    (decoded prompts, finished generations); ids are assigned by a counter,
+    so they then agree too. Bounded by entry count and total tokens.
+    """
+
+    def __init__(self, max_entries: int = 32, max_tokens: int = 1 << 22):
+        self.max_entries = max_entries
+        self.max_tokens = max_tokens
+        self._entries: "OrderedDict[int, array]" = OrderedDict()
+        self._tokens = 0
+        self._next_id = 1
+        self.sent_tokens = 0
+        self.reused_tokens = 0
+
+    def remember(self, tokens: Sequence[int]) -> None:
+        if len(tokens) < _MIN_DELTA_TOKENS or len(tokens) > self.max_tokens:
+            return
+        self._entries[self._next_id] = array("i", tokens)
+        self._next_id += 1
+        self._tokens += len(tokens)
+        while len(self._entries) > self.max_entries or self._tokens > self.max_tokens:
+            _, dropped = self._entries.popitem(last=False)
+            self._tokens -= len(dropped)
+
+    def best_base(self, tokens: Sequence[int]) -> Tuple[int, int]:
+        """(entry id, shared prefix length) of the best base for `tokens`, or (0, 0)."""
+        target = array("i", tokens)
+        best_id, best_len = 0, 0
+        for entry_id, entry in self._entries.items():
+            n = _shared_prefix(entry, target)
+            if n > best_len:
+                best_id, best_len = entry_id, n
+        if best_len < _MIN_DELTA_TOKENS:
+            return 0, 0
+        return best_id, best_len
+
+    def resolve(self, base_id: int, base_len: int, suffix: Sequence[int]) -> List[int]:
+        if base_id == 0:
+            return list(suffix)
+        entry = self._entries.get(base_id)
+        if entry is None or len(entry) < base_len:
+            raise RuntimeError(
+                f"Prompt history diverged across ranks (entry {base_id} missing); "
+                "every rank must record the same prompts"
+            )
+        self._entries.move_to_end(base_id)
+        return entry[:base_len].tolist() + list(suffix)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._entries),
+            "tokens": self._tokens,
+            "sent_tokens": self.sent_tokens,
+            "reused_tokens": self.reused_tokens,
+        }
+
+
+class IdleBackoff:
+    """How long rank 0 waits for work before sending an empty control frame.
+
+    Doubles from `min_wait` to `max_wait` while the loop stays idle and
+    resets as soon as a frame carries anything. The other ranks simply block
+    in the frame's collective, so idle ranks stop polling too.
+    """
+
+    def __init__(self, max_wait: float, min_wait: float = 0.005):
+        self.min_wait = min_wait
+        self.max_wait = max(min_wait, max_wait)
+        self._wait = min_wait
+
+    def next(self) -> float:
+        wait = self._wait
+        self._wait = min(self.max_wait, wait * 2)
+        return wait
+
+    def reset(self) -> None:
+        self._wait = self.min_wait
+
+
+def _f32(x: float) -> float:
+    return struct.unpack("<f", struct.pack("<f", x))[0]
+
+
+def _f32_bits(x: float) -> int:
+    return struct.unpack("<i", struct.pack("<f", x))[0]
+
+
+def _bits_f32(i: int) -> float:
+    return struct.unpack("<f", struct.pack("<i", i))[0]
+
+
+def request_from_dict(request: Dict[str, Any], seq: int, clock: int, seed: int) -> ControlRequest:
+    """Normalize an HTTP request dict exactly as the other ranks will decode it."""
+    prompt_tokens = [int(t) for t in (request.get("prompt_tokens") or [])]
+    rp = request.get("repetition_penalty")
+    rcs = request.get("repetition_context_size")
+    seed_raw = request.get("seed")
+    stops = [
+        [int(t) for t in s[:MAX_STOP_SEQUENCE_LENGTH]]
+        for s in (request.get("stop_token_sequences") or [])[:MAX_STOP_SEQUENCES]
+        if s
+    ]
+    breakpoints = [
+        (int(offset), clock + int(ttl))
+        for offset, ttl in list(request.get("cache_breakpoints") or [])[-MAX_CACHE_BREAKPOINTS:]
+        if 0 < int(offset) < len(prompt_tokens)
+    ]
+    return ControlRequest(
+        seq=seq,
+        prompt_tokens=prompt_tokens,
+        max_tokens=int(request.get("max_tokens") or 0),
+        seed=seed if seed_raw is None else int(seed_raw),
+        seed_is_user=bool(request.get("seed_is_user")),
+        temperature=_f32(float(request.get("temperature") or 0.0)),
+        top_p=_f32(float(request.get("top_p") or 0.0)),
+        top_k=int(request.get("top_k") or 0),
+        repetition_penalty=_f32(float(DEFAULT_REPETITION_PENALTY if rp is None else rp)),
+        repetition_context_size=int(DEFAULT_REPETITION_CONTEXT_SIZE if rcs is None else rcs),
+        stop_token_sequences=stops,
+        op=int(request.get("op", REQUEST_OP_GENERATE)),
+        cache_breakpoints=breakpoints,
+        request=request,
+    )
+
+
+def encode_frame(frame: ControlFrame, history: Optional[PromptHistory] = None) -> List[int]:
+    """Pack `frame`; with `history`, prompts are sent relative to a shared entry."""
+    payload: List[int] = list(frame.canceled)
+    for r in frame.requests:
+        base_id, base_len = history.best_base(r.prompt_tokens) if history is not None else (0, 0)
+        if history is not None:
+            history.sent_tokens += len(r.prompt_tokens) - base_len
+            history.reused_tokens += base_len
+        payload += [
+            r.seq,
+            r.op,
+            len(r.prompt_tokens),
+            r.max_tokens,
+            r.seed,
+            int(r.seed_is_user),
+            r.top_k,
+            r.repetition_context_size,
+            _f32_bits(r.temperature),
+            _f32_bits(r.top_p),
+            _f32_bits(r.repetition_penalty),
+            len(r.stop_token_sequences),
+            len(r.cache_breakpoints),
+            base_id,
+            base_len,
+        ]
+        for s in r.stop_token_sequences:
+            payload.append(len(s))
+            payload += s
+        for offset, retain_until in r.cache_breakpoints:
+            payload += [offset, retain_until - frame.clock]
+        payload += r.prompt_tokens[base_len:]
+    header = [
+        CONTROL_FRAME_VERSION,
+        int(frame.shutdown),
+        frame.clock,
+        len(frame.requests),
+        len(frame.canceled),
+        len(payload),
+    ]
+    return header + payload
+
+
+def decode_header(words: Sequence[int], world_size: int) -> Tuple[int, bool, int, int, int, int]:
+    version, shutdown, clock, request_count, cancel_count, payload_words = (int(w) for w in words[:_HEADER_WORDS])
+    if version != CONTROL_FRAME_VERSION * world_size:
+        raise RuntimeError(
+            f"Control frame version mismatch across ranks (sum {version}, expected "
+            f"{CONTROL_FRAME_VERSION} x {world_size}); run the same kooka-server build on every rank"
+        )
+    return version, shutdown > 0, clock, request_count, cancel_count, payload_words
+
+
+def frame_length(words: Sequence[int], world_size: int) -> int:
+    """Total frame size in words, from a (summed) header."""
+    return _HEADER_WORDS + decode_header(words, world_size)[5]
+
+
+def decode_frame(words: Sequence[int], world_size: int, history: Optional[PromptHistory] = None) -> ControlFrame:
+    _, shutdown, clock, request_count, cancel_count, _ = decode_header(words, world_size)
+    pos = _HEADER_WORDS
+    canceled = [int(w) for w in words[pos : pos + cancel_count]]
+    pos += cancel_count
+    requests = []
+    for _ in range(request_count):
+        (
+            seq,
+            op,
+            length,
+            max_tokens,
+            seed,
+            seed_is_user,
+            top_k,
+            repetition_context_size,
+            temperature,
+            top_p,
+            repetition_penalty,
+            stop_count,
+            breakpoint_count,
+            base_id,
+            base_len,
+        ) = (int(w) for w in words[pos : pos + _RECORD_WORDS])
+        pos += _RECORD_WORDS
+        stops = []
+        for _ in range(stop_count):
+            n = int(words[pos])
+            stops.append([int(w) for w in words[pos + 1 : pos + 1 + n]])
+            pos += 1 + n
+        breakpoints = []
+        for _ in range(breakpoint_count):
+            breakpoints.append((int(words[pos]), clock + int(words[pos + 1])))
+            pos += 2
+        suffix = [int(w) for w in words[pos : pos + length - base_len]]
+        pos += length - base_len
+        if base_id and history is None:
+            raise RuntimeError("Control frame references the prompt history, but none was given")
+        prompt_tokens = history.resolve(base_id, base_len, suffix) if base_id else suffix
+        requests.append(
+            ControlRequest(
+                seq=seq,
+                prompt_tokens=prompt_tokens,
+                max_tokens=max_tokens,
+                seed=seed,
+                seed_is_user=bool(seed_is_user),
+                temperature=_bits_f32(temperature),
+                top_p=_bits_f32(top_p),
+                top_k=top_k,
+                repetition_penalty=_bits_f32(repetition_penalty),
+                repetition_context_size=repetition_context_size,
+                stop_token_sequences=stops,
+                op=op,
+                cache_breakpoints=breakpoints,
+            )
+        )
+    return ControlFrame(requests=requests, canceled=canceled, shutdown=shutdown, clock=clock)
+
+
+__all__ = [
+    "CONTROL_FRAME_VERSION",
+    "CONTROL_FRAME_WORDS",
+    "ControlFrame",
+    "ControlRequest",
+    "IdleBackoff",
+    "PromptHistory",
+    "decode_frame",
+    "decode_header",
+    "encode_frame",
+    "frame_length",
+    "request_from_dict",
+]
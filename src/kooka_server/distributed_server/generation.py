@@ -1,12 +1,13 @@
 from __future__ import annotations
 
+from array import array
 from collections import deque
 from dataclasses import dataclass
 import logging
 import os
 from queue import Queue
 import time
-from typing import Any, Deque, Dict, List, Optional, Tuple
+from typing import Any, Callable, Deque, Dict, List, Optional, Sequence, Tuple
 
 import mlx.core as mx
 
@@ -14,33 +15,33 @@ from mlx_lm import stream_generate
 from mlx_lm.generate import BatchGenerator
 from mlx_lm.models.cache import (
     ArraysCache,
-    can_trim_prompt_cache,
+    CacheList,
     KVCache,
     make_prompt_cache,
     MambaCache,
     RotatingKVCache,
     trim_prompt_cache,
 )
-from mlx_lm.sample_utils import make_logits_processors, make_sampler
-
-from .prompt_cache import LRUPromptCache
-
-def build_kmp_lps(pattern: List[int]) -> List[int]:
-    """Build KMP LPS table for token stop-sequence matching."""
-    lps = [0] * len(pattern)
-    length = 0
-    i = 1
-    while i < len(pattern):
-        if pattern[i] == pattern[length]:
-            length += 1
-            lps[i] = length
-            i += 1
-        elif length != 0:
-            length = lps[length - 1]
-        else:
-            lps[i] = 0
-            i += 1
-    return lps
+from mlx_lm.sample_utils import apply_top_k, apply_top_p, make_logits_processors, make_sampler
+
+from .control import ControlFrame, ControlRequest, IdleBackoff
+from .constants import (
+    REQUEST_OP_EXPORT_SESSION,
+    REQUEST_OP_GENERATE,
+    REQUEST_OP_IMPORT_SESSION,
+    REQUEST_OP_UNPIN_PREFIX,
+)
+from .admission import deadline_error
+from .prompt_cache import LRUPromptCache, compact_prompt_cache, prefix_id, share_prompt_cache
+from .prompt_cache_disk import DiskPromptCache, cache_identity
+from .session_snapshot import export_session, import_session
+from .stop_matcher import BatchStopMatcher, compile_stop_sequences
+from .token_stream import PrefillProgress, RequestUsage
+
+# Prefill chunk for sequential requests; a cancel check runs between chunks.
+_SEQUENTIAL_PREFILL_STEP = 2048
+# No trim limit; the largest value `sync_max` can exchange (int32).
+_NO_TRIM_LIMIT = 2**31 - 1
 
 
 @dataclass(frozen=True)
@@ -57,24 +58,403 @@ class _PendingRequest:
     stop_token_sequences: List[List[int]]
     request_id: Optional[str]
     response_queue: Optional[Queue]
-
-    @property
-    def batchable(self) -> bool:
-        return not self.seed_is_user
+    cache_breakpoints: Tuple[Tuple[int, int], ...] = ()
+    seq: int = 0  # Control-frame sequence number, identical on every rank
+    # Rank 0 only (perf_counter time): drop the request if prefill can't start by then.
+    deadline: Optional[float] = None
 
 
 @dataclass
 class _ActiveRequest:
-    prompt_len: int
     cache_key: List[int]
-    detokenizer: Any
-    stop_sequences: List[List[int]]
-    stop_lps: List[List[int]]
-    stop_match: List[int]
-    pending_items: Optional[Deque[dict]]
-    generation_tokens: int
     request_id: Optional[str]
     response_queue: Optional[Queue]
+    cache_breakpoints: Tuple[Tuple[int, int], ...] = ()
+    seq: int = 0
+    # Rank 0: response_queue.put, for raw (token, finish_reason) events.
+    emit: Optional[Callable[[Any], None]] = None
+
+
+@dataclass
+class _PrefillJob:
+    """A prompt prefilled in resumable chunks.
+
+    `pos` prompt tokens are in `prompt_cache`. Prefill stops at `end`; the
+    rest goes to the decoder (BatchGenerator on insert, or stream_generate):
+    at least the last token, which yields the first sample, and the
+    repetition-penalty context. The batched loop keeps its request in `req`.
+    """
+
+    prompt_tokens: List[int]
+    prompt_cache: List[Any]
+    pos: int
+    end: int
+    reused_len: int
+    # Non-trimmable caches: ascending snapshot offsets and their retain deadlines.
+    checkpoints: List[int]
+    retain: Dict[int, int]
+    req: Optional[_PendingRequest] = None
+
+    @property
+    def remaining(self) -> int:
+        return self.end - self.pos
+
+
+@dataclass(frozen=True)
+class _CheckpointPolicy:
+    """Where to snapshot non-trimmable caches during prefill.
+
+    The end of the prompt is always a checkpoint; `turns` > 0 adds the last
+    `turns` assistant-turn starts (occurrences of `turn_marker`) in the prompt,
+    and `interval` > 0 adds the last `max_periodic` multiples of `interval`.
+    Offsets are absolute, so requests sharing a prefix produce the same keys.
+    """
+
+    turns: int = 0
+    turn_marker: Tuple[int, ...] = ()
+    interval: int = 0
+    max_periodic: int = 0
+
+
+def _assistant_turn_marker(tokenizer: Any, args: Any) -> Tuple[int, ...]:
+    text = str(getattr(args, "prompt_cache_turn_marker", "") or "")
+    if not text:
+        # The generation prompt (first line) opens an assistant turn.
+        try:
+            messages = [{"role": "user", "content": "x"}]
+            with_prompt = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+            without = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=False)
+        except Exception:
+            logging.debug("Failed to derive assistant-turn marker", exc_info=True)
+            return ()
+        if not with_prompt.startswith(without):
+            return ()
+        text = with_prompt[len(without) :].strip().split("\n", 1)[0]
+    if not text:
+        return ()
+    return tuple(int(t) for t in tokenizer.encode(text, add_special_tokens=False))
+
+
+def _make_checkpoint_policy(tokenizer: Any, args: Any) -> _CheckpointPolicy:
+    turns = max(0, int(getattr(args, "prompt_cache_checkpoint_turns", 0) or 0))
+    marker = _assistant_turn_marker(tokenizer, args) if turns else ()
+    if turns and not marker:
+        logging.warning("No assistant-turn marker available; skipping turn checkpoints")
+    interval = max(0, int(getattr(args, "prompt_cache_checkpoint_interval", 0) or 0))
+    max_periodic = max(0, int(getattr(args, "prompt_cache_checkpoint_max", 0) or 0))
+    if interval and max_periodic:
+        logging.info(
+            "Prompt cache checkpoints for non-trimmable caches: every %d tokens (last %d per prompt)",
+            interval,
+            max_periodic,
+        )
+    return _CheckpointPolicy(turns=turns, turn_marker=marker, interval=interval, max_periodic=max_periodic)
+
+
+def _checkpoint_offsets(prompt_tokens: List[int], start: int, policy: _CheckpointPolicy) -> List[int]:
+    """Prompt offsets after `start` at which to snapshot the cache."""
+    end = len(prompt_tokens) - 1
+    offsets: List[int] = []
+    marker = policy.turn_marker
+    if policy.turns and marker:
+        haystack = array("i", prompt_tokens[start:end]).tobytes()
+        needle = array("i", marker).tobytes()
+        found = []
+        i = haystack.find(needle)
+        while i >= 0:
+            if i % 4 == 0:
+                found.append(start + i // 4)
+            i = haystack.find(needle, i + 1)
+        offsets = [o for o in found if o > max(start, 1)][-policy.turns :]
+    if policy.interval and policy.max_periodic:
+        first = max(start, 1) // policy.interval + 1
+        last = (end - 1) // policy.interval
+        first = max(first, last - policy.max_periodic + 1)
+        offsets.extend(k * policy.interval for k in range(first, last + 1))
+    if end > max(start, 1):
+        offsets.append(end)
+    return sorted(set(offsets))
+
+
+def _prefill_tokens(model: Any, prompt_cache: List[Any], tokens: List[int], prefill_step_size: int) -> None:
+    """Run `tokens` through the model in chunks, only to fill `prompt_cache`."""
+    for pos in range(0, len(tokens), prefill_step_size):
+        chunk = tokens[pos : pos + prefill_step_size]
+        model(mx.array(chunk, dtype=mx.int32)[None], cache=prompt_cache)
+        mx.eval([c.state for c in prompt_cache])
+
+
+def _run_prefix_op(
+    *,
+    dist_state: Any,
+    model: Any,
+    prompt_cache_store: LRUPromptCache,
+    model_key: str,
+    op: int,
+    prompt_tokens: List[int],
+    response_queue: Optional[Queue],
+    prefill_step_size: int,
+    request: Any = None,
+) -> None:
+    """Apply a prompt-cache admin op on every rank.
+
+    Pins (prefilling if needed) or unpins a prompt prefix, or exports/imports
+    a KV session snapshot to/from the file named by rank 0's `request["path"]`.
+    Runs at the same point of the loop on all ranks, like a generate request,
+    so the prompt-cache index stays identical. Rank 0 reports the result on
+    the request's response queue.
+    """
+    rank = dist_state.rank
+    world_size = getattr(dist_state, "world_size", 1)
+    key = prefix_id(model_key, prompt_tokens)
+    path = request.get("path") if isinstance(request, dict) else None
+    t0 = time.perf_counter()
+    try:
+        if op == REQUEST_OP_UNPIN_PREFIX:
+            result: Dict[str, Any] = {"id": key, "deleted": prompt_cache_store.unpin(model_key, prompt_tokens)}
+        elif op in (REQUEST_OP_EXPORT_SESSION, REQUEST_OP_IMPORT_SESSION):
+            layers = _model_layer_slice(model)
+            identity = cache_identity(str(model_key), rank, world_size, layers)
+            if op == REQUEST_OP_EXPORT_SESSION:
+                covered = export_session(
+                    dist_state, prompt_cache_store, model_key, prompt_tokens, identity, layers, path
+                )
+                result = {"id": prefix_id(model_key, prompt_tokens[:covered]), "tokens": covered}
+            else:
+                error = import_session(
+                    dist_state,
+                    prompt_cache_store,
+                    model_key,
+                    prompt_tokens,
+                    identity,
+                    lambda: make_prompt_cache(model),
+                    dist_state.sync_max if world_size > 1 else (lambda v: v),
+                    path,
+                )
+                result = {"id": key, "error": error} if error else {"id": key, "tokens": len(prompt_tokens)}
+            if rank == 0:
+                logging.info(
+                    "KV session %s %s: tokens=%d (%.2fs)",
+                    "export" if op == REQUEST_OP_EXPORT_SESSION else "import",
+                    result["id"],
+                    result.get("tokens", 0),
+                    time.perf_counter() - t0,
+                )
+        else:
+            prefilled = 0
+            if prompt_cache_store.pin(model_key, prompt_tokens) is None:
+                prompt_cache, rest = prompt_cache_store.fetch_nearest_cache(model_key, prompt_tokens)
+                if prompt_cache is None:
+                    prompt_cache = make_prompt_cache(model)
+                _prefill_tokens(model, prompt_cache, rest, prefill_step_size)
+                prefilled = len(rest)
+                prompt_cache_store.insert_cache(model_key, prompt_tokens, prompt_cache, pinned=True)
+                mx.clear_cache()
+            stats = prompt_cache_store.stats()["pinned"]
+            result = {
+                "id": key,
+                "tokens": len(prompt_tokens),
+                "prefilled_tokens": prefilled,
+                "pinned_entries": stats["entries"],
+                "pinned_bytes": stats["bytes"],
+            }
+            if rank == 0:
+                logging.info(
+                    "Pinned prompt prefix %s: tokens=%d prefilled=%d pinned_bytes=%d (%.2fs)",
+                    key,
+                    len(prompt_tokens),
+                    prefilled,
+                    stats["bytes"],
+                    time.perf_counter() - t0,
+                )
+    except Exception as e:
+        logging.error("Prompt prefix operation failed: %s", e, exc_info=True)
+        result = {"id": key, "error": str(e)}
+    if rank == 0 and response_queue is not None:
+        response_queue.put(result)
+
+
+def _checkpoint_plan(
+    *,
+    prompt_cache: List[Any],
+    prompt_cache_store: LRUPromptCache,
+    model_key: str,
+    prompt_tokens: List[int],
+    start: int,
+    policy: _CheckpointPolicy,
+    breakpoints: Sequence[Tuple[int, int]] = (),
+) -> Tuple[List[int], Dict[int, int]]:
+    """Offsets after `start` at which prefill stores a copy-on-write snapshot.
+
+    Chat templates that drop earlier reasoning make the next turn diverge
+    inside this request's output, and a non-trimmable cache cannot be cut
+    back to the divergence point. Snapshots at the prompt end (and optionally
+    at assistant-turn starts) give later turns a prefix entry to resume from.
+    Periodic snapshots let a request that diverges late resume close to the
+    divergence instead of at token 0. Trimmable caches skip this: their full
+    entry is trimmed on reuse.
+
+    `breakpoints` are (offset, retain_until) pairs from client cache
+    markers; snapshots there are retained until the deadline, returned by
+    offset. Trimmable caches get theirs from the finished cache instead (see
+    `_insert_breakpoint_entries`).
+    """
+    if prompt_cache_store.can_trim(prompt_cache, len(prompt_tokens)):
+        return [], {}
+    retain = {
+        offset: until
+        for offset, until in breakpoints
+        if offset > start and not prompt_cache_store.retain(model_key, prompt_tokens[:offset], until)
+    }
+    return sorted(set(_checkpoint_offsets(prompt_tokens, start, policy)).union(retain)), retain
+
+
+def _insert_breakpoint_entries(
+    *,
+    prompt_cache_store: LRUPromptCache,
+    model_key: str,
+    prompt_tokens: List[int],
+    prompt_cache: List[Any],
+    breakpoints: Sequence[Tuple[int, int]],
+) -> None:
+    """Store retained prefix entries of a finished, trimmable cache at each breakpoint.
+
+    Runs after generation so the working cache is never shared while it is
+    still being written; each entry is a compact copy of its prefix.
+    """
+    if not breakpoints:
+        return
+    length = getattr(prompt_cache[0], "offset", 0)
+    if not prompt_cache_store.can_trim(prompt_cache, length):
+        return
+    for offset, until in breakpoints:
+        if offset > length or prompt_cache_store.retain(model_key, prompt_tokens[:offset], until):
+            continue
+        prompt_cache_store.insert_cache(
+            model_key,
+            prompt_tokens[:offset],
+            compact_prompt_cache(share_prompt_cache(prompt_cache, length - offset)),
+            checkpoint=True,
+            retain_until=until,
+        )
+
+
+def _cache_creation_tokens(breakpoints: Sequence[Tuple[int, int]], reused_len: int) -> int:
+    """Prompt tokens newly written to retained cache entries by this request."""
+    return max([0] + [offset - reused_len for offset, _ in breakpoints])
+
+
+def _device_memory_bytes() -> Optional[int]:
+    try:
+        metal = getattr(mx, "metal", None)
+        if metal is None or not metal.is_available():
+            return None
+        info = metal.device_info()
+        size = info.get("max_recommended_working_set_size") or info.get("memory_size")
+        return int(size) if size else None
+    except Exception:
+        logging.debug("Failed to query device memory", exc_info=True)
+        return None
+
+
+def _prompt_cache_max_bytes(args: Any) -> Optional[int]:
+    budgets = []
+    max_bytes = int(getattr(args, "prompt_cache_bytes", 0) or 0)
+    if max_bytes > 0:
+        budgets.append(max_bytes)
+    fraction = float(getattr(args, "prompt_cache_memory_fraction", 0.0) or 0.0)
+    if fraction > 0:
+        device_bytes = _device_memory_bytes()
+        if device_bytes is None:
+            logging.warning("--prompt-cache-memory-fraction ignored: device memory size unavailable")
+        else:
+            budgets.append(int(device_bytes * fraction))
+    return min(budgets) if budgets else None
+
+
+def _model_layer_slice(model: Any) -> Tuple[int, int]:
+    inner = getattr(model, "model", model)
+    num_layers = len(getattr(inner, "layers", None) or getattr(model, "layers", []))
+    start = int(getattr(inner, "start_idx", 0) or 0)
+    end = getattr(inner, "end_idx", None)
+    return start, int(end) if end is not None else num_layers
+
+
+def _make_disk_prompt_cache(dist_state: Any, args: Any, model: Any) -> Optional[DiskPromptCache]:
+    directory = str(getattr(args, "prompt_cache_dir", "") or "")
+    if not directory:
+        return None
+    world_size = getattr(dist_state, "world_size", 1)
+    max_bytes = int(getattr(args, "prompt_cache_disk_bytes", 0) or 0) or None
+    disk = DiskPromptCache(
+        directory,
+        cache_identity(str(args.model), dist_state.rank, world_size, _model_layer_slice(model)),
+        make_cache=lambda: make_prompt_cache(model),
+        max_bytes=max_bytes,
+        sync_max=dist_state.sync_max if world_size > 1 else None,
+    )
+    if dist_state.rank == 0:
+        logging.info(
+            "Prompt cache disk tier: %s (budget %s)",
+            directory,
+            f"{max_bytes / 2**30:.2f} GiB per rank" if max_bytes else "unlimited",
+        )
+    return disk
+
+
+def _trim_limit(layers: Sequence[Any]) -> int:
+    """Longest cache (in tokens) that `layers` can be trimmed at, 0 if never."""
+    limit = _NO_TRIM_LIMIT
+    for layer in layers:
+        if isinstance(layer, CacheList):
+            limit = min(limit, _trim_limit(layer.caches))
+        elif not layer.is_trimmable():
+            return 0
+        elif isinstance(layer, RotatingKVCache):
+            # Trimmable until the window wraps.
+            limit = min(limit, layer.max_size)
+    return limit
+
+
+def _prompt_cache_trim_limit(dist_state: Any, model: Any) -> int:
+    """`_trim_limit` of a fresh cache, agreed across ranks (the minimum).
+
+    Each pipeline rank only holds its own slice of layers, so for a hybrid
+    model one rank can see a trimmable cache where another does not. Ranks
+    then have to make the same trimming decisions from this shared limit,
+    or they take different cache paths and their collectives mismatch.
+    """
+    return -dist_state.sync_max(-_trim_limit(make_prompt_cache(model)))
+
+
+def _make_prompt_cache_store(dist_state: Any, args: Any, model: Any = None) -> LRUPromptCache:
+    max_bytes = _prompt_cache_max_bytes(args)
+    sync_evictions = None
+    trim_limit = None
+    if getattr(dist_state, "world_size", 1) > 1:
+        if max_bytes is not None:
+            # Ranks hold different layer slices, so byte usage differs; agree on
+            # the eviction count to keep the cache index identical on every rank.
+            sync_evictions = dist_state.sync_max
+        if model is not None:
+            trim_limit = _prompt_cache_trim_limit(dist_state, model)
+    if dist_state.rank == 0 and max_bytes is not None:
+        logging.info("Prompt cache byte budget: %.2f GiB per rank", max_bytes / 2**30)
+    cold_after = float(getattr(args, "prompt_cache_cold_after", 0.0) or 0.0)
+    cold_bits = int(getattr(args, "prompt_cache_cold_bits", 8) or 8)
+    if dist_state.rank == 0 and cold_after > 0:
+        logging.info("Prompt cache cold storage: %d-bit after %.0fs idle", cold_bits, cold_after)
+    return LRUPromptCache(
+        max_size=max(0, int(args.prompt_cache_size)),
+        max_bytes=max_bytes,
+        sync_evictions=sync_evictions,
+        disk=_make_disk_prompt_cache(dist_state, args, model) if model is not None else None,
+        cold_after=cold_after if cold_after > 0 else None,
+        cold_bits=cold_bits,
+        cold_group_size=int(getattr(args, "prompt_cache_cold_group_size", 64) or 64),
+        compact=bool(getattr(args, "prompt_cache_compact", False)),
+        trim_limit=trim_limit,
+    )
 
 
 def _is_model_batchable_for_distributed(model: Any) -> bool:
@@ -102,7 +482,7 @@ def _prepare_prompt_cache_and_suffix(
             return None, []
 
         prompt_cache = cached_prompt_cache
-        if prompt_cache is not None and can_trim_prompt_cache(prompt_cache):
+        if prompt_cache is not None and prompt_cache_store.can_trim(prompt_cache, len(prompt_tokens)):
             try:
                 trim_prompt_cache(prompt_cache, 1)
                 tokens_to_process = [prompt_tokens[-1]]
@@ -153,38 +533,170 @@ def _prime_empty_prompt_cache(
     return tokens_to_process[1:]
 
 
-def _sync_canceled_uids(dist_state: Any, active: Dict[int, _ActiveRequest], *, rank: int) -> List[int]:
-    if rank == 0:
-        local = [
-            uid
-            for uid, state in active.items()
-            if state.request_id and dist_state.is_request_canceled(state.request_id)
-        ]
-    else:
-        local = []
+def _pending_request(req: ControlRequest) -> _PendingRequest:
+    return _PendingRequest(
+        prompt_tokens=req.prompt_tokens,
+        max_tokens=req.max_tokens,
+        seed=req.seed,
+        seed_is_user=req.seed_is_user,
+        temperature=req.temperature,
+        top_p=req.top_p,
+        top_k=req.top_k,
+        repetition_penalty=req.repetition_penalty,
+        repetition_context_size=req.repetition_context_size,
+        stop_token_sequences=req.stop_token_sequences,
+        request_id=req.request_id,
+        response_queue=req.response_queue,
+        cache_breakpoints=tuple(req.cache_breakpoints),
+        seq=req.seq,
+        deadline=req.request.get("deadline") if req.request else None,
+    )
 
-    if getattr(dist_state, "world_size", 1) == 1:
-        return [int(x) for x in local]
 
-    if rank == 0:
-        meta = mx.array([len(local)], dtype=mx.int32)
-    else:
-        meta = mx.zeros((1,), dtype=mx.int32)
-    meta = mx.distributed.all_sum(meta, stream=mx.cpu)
-    mx.eval(meta)
+def _start_prefill(
+    *,
+    model: Any,
+    prompt_cache_store: LRUPromptCache,
+    model_key: str,
+    req: _PendingRequest,
+    policy: _CheckpointPolicy,
+    rank: int,
+) -> Optional[_PrefillJob]:
+    """Look up the cached prefix and plan the prefill; None for an empty prompt."""
+    prompt_cache, tokens_to_process = _prepare_prompt_cache_and_suffix(
+        model=model,
+        prompt_cache_store=prompt_cache_store,
+        model_key=model_key,
+        prompt_tokens=req.prompt_tokens,
+        rank=rank,
+    )
+    if not tokens_to_process:
+        return None
+    if prompt_cache is None:
+        prompt_cache = make_prompt_cache(model)
+    return _plan_prefill(
+        prompt_cache=prompt_cache,
+        prompt_cache_store=prompt_cache_store,
+        model_key=model_key,
+        prompt_tokens=req.prompt_tokens,
+        pos=len(req.prompt_tokens) - len(tokens_to_process),
+        policy=policy,
+        breakpoints=req.cache_breakpoints,
+        repetition_penalty=req.repetition_penalty,
+        repetition_context_size=req.repetition_context_size,
+        req=req,
+    )
 
-    count = int(meta[0].item())
-    if count <= 0:
-        return []
 
-    if rank == 0:
-        payload = mx.array(local, dtype=mx.int32)
-    else:
-        payload = mx.zeros((count,), dtype=mx.int32)
-    payload = mx.distributed.all_sum(payload, stream=mx.cpu)
-    mx.eval(payload)
+def _plan_prefill(
+    *,
+    prompt_cache: List[Any],
+    prompt_cache_store: LRUPromptCache,
+    model_key: str,
+    prompt_tokens: List[int],
+    pos: int,
+    policy: _CheckpointPolicy,
+    breakpoints: Sequence[Tuple[int, int]],
+    repetition_penalty: float,
+    repetition_context_size: int,
+    req: Optional[_PendingRequest] = None,
+) -> _PrefillJob:
+    checkpoints, retain = _checkpoint_plan(
+        prompt_cache=prompt_cache,
+        prompt_cache_store=prompt_cache_store,
+        model_key=model_key,
+        prompt_tokens=prompt_tokens,
+        start=pos,
+        policy=policy,
+        breakpoints=breakpoints,
+    )
+    tail = 1
+    if repetition_penalty and repetition_penalty != 0.0:
+        # Logits processors only see the tokens the decoder was given.
+        tail = max(1, int(repetition_context_size))
+    end = max(pos, len(prompt_tokens) - tail, checkpoints[-1] if checkpoints else 0)
+    return _PrefillJob(
+        prompt_tokens=prompt_tokens,
+        prompt_cache=prompt_cache,
+        pos=pos,
+        end=end,
+        reused_len=pos,
+        checkpoints=checkpoints,
+        retain=retain,
+        req=req,
+    )
+
+
+def _advance_prefill(
+    *,
+    job: _PrefillJob,
+    model: Any,
+    prompt_cache_store: LRUPromptCache,
+    model_key: str,
+    budget: int,
+    prefill_step_size: int,
+) -> int:
+    """Prefill up to `budget` tokens of `job` in chunks; returns how many ran.
+
+    Chunks stop at checkpoint offsets so the snapshot there is exact.
+    """
+    done = 0
+    tokens = job.prompt_tokens
+    while job.pos < job.end and done < budget:
+        stop = min(job.end, job.pos + prefill_step_size, job.pos + budget - done)
+        if job.checkpoints and job.checkpoints[0] < stop:
+            stop = job.checkpoints[0]
+        model(mx.array(tokens[job.pos : stop], dtype=mx.int32)[None], cache=job.prompt_cache)
+        mx.eval([c.state for c in job.prompt_cache])
+        done += stop - job.pos
+        job.pos = stop
+        if job.checkpoints and job.checkpoints[0] == stop:
+            job.checkpoints.pop(0)
+            prompt_cache_store.insert_cache(
+                model_key,
+                tokens[:stop],
+                share_prompt_cache(job.prompt_cache),
+                checkpoint=True,
+                retain_until=job.retain.get(stop, 0),
+            )
+    return done
 
-    return [int(x) for x in payload.tolist()[:count]]
+
+def _keep_partial_prefill(*, job: _PrefillJob, prompt_cache_store: LRUPromptCache, model_key: str) -> None:
+    """Cache what an abandoned prefill got through, so a retry resumes from there."""
+    if job.pos > job.reused_len:
+        prompt_cache_store.insert_cache(model_key, job.prompt_tokens[: job.pos], job.prompt_cache)
+
+
+def _shed_missed_deadlines(
+    *, dist_state: Any, pending: Sequence[_PendingRequest], prefilling: Sequence[_PrefillJob]
+) -> None:
+    """Rank 0: cancel queued requests that can no longer start generating by their deadline.
+
+    Runs before the control frame, so the cancellation reaches every rank in
+    that frame and none of the request's prefill runs. A prefilling job is
+    dropped when the prefill queued ahead of it, plus its own, can't finish
+    in time at the measured prefill rate.
+    """
+    now = time.perf_counter()
+    tps = dist_state.prefill_tps
+    ahead = 0
+    late = []
+    for job in prefilling:
+        ahead += job.remaining
+        if job.pos == job.reused_len and job.req.deadline is not None:
+            eta = now + (ahead / tps if tps else 0.0)
+            if eta >= job.req.deadline:
+                late.append((job.req, eta - now))
+    late += [(req, 0.0) for req in pending if req.deadline is not None and now >= req.deadline]
+    for req, wait in late:
+        if not req.request_id or dist_state.is_request_canceled(req.request_id):
+            continue
+        logging.info("Dropping request before prefill: deadline can't be met (id=%s)", req.request_id)
+        dist_state.shed_stats["missed_before_prefill"] += 1
+        if req.response_queue is not None:
+            req.response_queue.put(deadline_error(wait))
+        dist_state.cancel_request(req.request_id)
 
 
 def _finalize_active_request(
@@ -196,20 +708,48 @@ def _finalize_active_request(
     prompt_cache_store: LRUPromptCache,
     prompt_cache: Optional[List[Any]],
 ) -> None:
+    # The next turn usually starts with this prompt and its completion.
+    dist_state.remember_tokens(state.cache_key)
     if prompt_cache is not None:
+        _insert_breakpoint_entries(
+            prompt_cache_store=prompt_cache_store,
+            model_key=model_key,
+            prompt_tokens=state.cache_key,
+            prompt_cache=prompt_cache,
+            breakpoints=state.cache_breakpoints,
+        )
         prompt_cache_store.insert_cache(model_key, state.cache_key, prompt_cache)
 
     if rank == 0 and state.response_queue is not None:
-        if state.pending_items is not None:
-            while state.pending_items:
-                state.response_queue.put(state.pending_items.popleft())
-
         state.response_queue.put(None)
 
         if state.request_id:
             dist_state.clear_request_canceled(state.request_id)
 
 
+def _request_sampler(*, seed: int, temperature: float, top_p: float, top_k: int) -> Callable[[mx.array], mx.array]:
+    """`make_sampler` with the request's own RNG key instead of the global one.
+
+    Each call splits the key, so a request's n-th sample depends only on its
+    seed and logits, not on which other sequences sampled before it in the
+    batch. Every rank derives the same key from the frame's seed.
+    """
+    if temperature == 0:
+        return make_sampler(temp=0.0)
+    key = mx.random.key(int(seed) & 0xFFFFFFFF)
+
+    def sampler(logprobs: mx.array) -> mx.array:
+        nonlocal key
+        if 0 < top_p < 1.0:
+            logprobs = apply_top_p(logprobs, top_p)
+        if top_k > 0:
+            logprobs = apply_top_k(logprobs, top_k)
+        key, sub = mx.random.split(key)
+        return mx.random.categorical(logprobs * (1 / temperature), key=sub)
+
+    return sampler
+
+
 def _serve_one_request_sequential(
     *,
     dist_state: Any,
@@ -228,6 +768,8 @@ def _serve_one_request_sequential(
     stop_token_sequences: List[List[int]],
     response_queue: Optional[Queue],
     request_id: Optional[str],
+    checkpoint_policy: _CheckpointPolicy = _CheckpointPolicy(),
+    cache_breakpoints: Sequence[Tuple[int, int]] = (),
 ) -> None:
     rank = dist_state.rank
 
@@ -240,13 +782,7 @@ def _serve_one_request_sequential(
             dist_state.clear_request_canceled(request_id)
         return
 
-    mx.random.seed(int(seed))
-
-    sampler = make_sampler(
-        temp=temperature,
-        top_p=top_p,
-        top_k=top_k,
-    )
+    sampler = _request_sampler(seed=seed, temperature=temperature, top_p=top_p, top_k=top_k)
     logits_processors = None
     if repetition_penalty and repetition_penalty != 0.0:
         logits_processors = make_logits_processors(
@@ -278,9 +814,10 @@ def _serve_one_request_sequential(
             response_queue.put(None)
         return
 
+    reused_len = max(0, full_prompt_len - len(tokens_to_process))
+    cache_creation_tokens = _cache_creation_tokens(cache_breakpoints, reused_len)
     if rank == 0:
         cache_hit = cached_prompt_cache is not None
-        reused_len = max(0, full_prompt_len - len(tokens_to_process))
         logging.info(
             "Starting generation: prompt_len=%d cache_hit=%s reused_len=%d to_process_len=%d max_tokens=%s",
             full_prompt_len,
@@ -295,15 +832,62 @@ def _serve_one_request_sequential(
         gen_start_t = None
         first_token_dt = None
 
-    prompt = mx.array(tokens_to_process, dtype=mx.int32)
+    # Prefill in chunks with a cancel check (and a progress event) after
+    # each, instead of inside stream_generate where it can't be stopped.
+    job = _plan_prefill(
+        prompt_cache=prompt_cache,
+        prompt_cache_store=prompt_cache_store,
+        model_key=args.model,
+        prompt_tokens=prompt_tokens,
+        pos=reused_len,
+        policy=checkpoint_policy,
+        breakpoints=cache_breakpoints,
+        repetition_penalty=repetition_penalty,
+        repetition_context_size=repetition_context_size,
+    )
+    while job.remaining > 0:
+        t0 = time.perf_counter()
+        done = _advance_prefill(
+            job=job,
+            model=model,
+            prompt_cache_store=prompt_cache_store,
+            model_key=args.model,
+            budget=_SEQUENTIAL_PREFILL_STEP,
+            prefill_step_size=_SEQUENTIAL_PREFILL_STEP,
+        )
+        dist_state.record_prefill(done, job.remaining, time.perf_counter() - t0)
+        if rank == 0 and response_queue is not None:
+            response_queue.put(PrefillProgress(job.pos, full_prompt_len))
+        if job.remaining > 0 and dist_state.sync_should_cancel(request_id):
+            _keep_partial_prefill(job=job, prompt_cache_store=prompt_cache_store, model_key=args.model)
+            if rank == 0:
+                logging.info(
+                    "Request canceled during prefill (id=%s): %d/%d prompt tokens",
+                    request_id,
+                    job.pos,
+                    full_prompt_len,
+                )
+                if response_queue is not None:
+                    response_queue.put(None)
+                dist_state.clear_request_canceled(request_id)
+            mx.synchronize()
+            return
+    if job.pos > job.reused_len:
+        mx.clear_cache()
+    prompt = mx.array(prompt_tokens[job.pos :], dtype=mx.int32)
     cache_key = prompt_tokens[:]
 
-    # Stop-sequence buffering (rank 0 only) to avoid emitting partial stop strings.
-    pending_items = deque() if rank == 0 and response_queue is not None else None
+    # Raw tokens go to the request's TokenStream (HTTP thread), which
+    # detokenizes and holds back partial stop sequences.
+    emit = response_queue.put if rank == 0 and response_queue is not None else None
+    if emit is not None:
+        # stream_generate reports prompt_tokens as the length of the prompt it
+        # was called with (possibly only the non-cached suffix); usage reports
+        # the full prompt length.
+        emit(RequestUsage(full_prompt_len, reused_len, cache_creation_tokens))
 
-    stop_sequences = [s for s in (stop_token_sequences or []) if s]
-    stop_lps = [build_kmp_lps(s) for s in stop_sequences]
-    stop_match = [0] * len(stop_sequences)
+    stop_automaton = compile_stop_sequences(stop_token_sequences or [])
+    stop_state = 0
 
     last_response = None
     try:
@@ -336,47 +920,14 @@ def _serve_one_request_sequential(
                     prompt_tps,
                 )
 
-            holdback = 0
-            stop_trim = 0
-            if stop_sequences:
-                tok = int(response.token)
-                for i, seq in enumerate(stop_sequences):
-                    l = stop_match[i]
-                    while l > 0 and seq[l] != tok:
-                        l = stop_lps[i][l - 1]
-                    if l < len(seq) and seq[l] == tok:
-                        l += 1
-                    if l > holdback:
-                        holdback = l
-                    if l == len(seq) and len(seq) > stop_trim:
-                        stop_trim = len(seq)
-                    stop_match[i] = l
-
-            if rank == 0 and response_queue is not None:
-                item = {
-                    "text": response.text,
-                    "finish_reason": response.finish_reason,
-                    # stream_generate reports prompt_tokens as the length of the prompt
-                    # it was called with (which may be only the non-cached suffix).
-                    # For OpenAI usage, report the full prompt length.
-                    "prompt_tokens": full_prompt_len,
-                    "generation_tokens": response.generation_tokens,
-                    "token": response.token,
-                }
-                pending_items.append(item)
-
-            # Stop early if we hit a stop sequence (discard the stop sequence tokens).
-            if stop_trim > 0:
-                if pending_items is not None:
-                    for _ in range(min(stop_trim, len(pending_items))):
-                        pending_items.pop()
-                break
+            if emit is not None:
+                emit((int(response.token), response.finish_reason))
 
-            # Flush buffered items except the current stop-prefix holdback.
-            if pending_items is not None and holdback >= 0:
-                flush_count = len(pending_items) - holdback
-                for _ in range(max(0, flush_count)):
-                    response_queue.put(pending_items.popleft())
+            # Stop early if we hit a stop sequence (the consumer drops its tokens).
+            if stop_automaton is not None:
+                stop_state, _, stop_trim = stop_automaton.step(stop_state, int(response.token))
+                if stop_trim > 0:
+                    break
 
             cancel_step += 1
             if (
@@ -391,13 +942,8 @@ def _serve_one_request_sequential(
                     )
                 break
 
-        # Flush anything left (e.g. overlap prefixes when generation ended).
-        if pending_items is not None:
-            while pending_items:
-                response_queue.put(pending_items.popleft())
-
-        if rank == 0 and response_queue is not None:
-            response_queue.put(None)
+        if emit is not None:
+            emit(None)
 
         if rank == 0:
             total_dt = time.perf_counter() - gen_start_t
@@ -414,12 +960,23 @@ def _serve_one_request_sequential(
             )
 
         # Save full cache (prompt + generated tokens).
+        dist_state.remember_tokens(cache_key)
+        _insert_breakpoint_entries(
+            prompt_cache_store=prompt_cache_store,
+            model_key=args.model,
+            prompt_tokens=cache_key,
+            prompt_cache=prompt_cache,
+            breakpoints=cache_breakpoints,
+        )
         prompt_cache_store.insert_cache(args.model, cache_key, prompt_cache)
         if rank == 0:
             logging.info(
-                "Saved prompt cache: key_len=%d cache_items=%d",
+                "Saved prompt cache: key_len=%d cache_items=%d entries=%d cache_bytes=%d checkpoint_bytes=%d",
                 len(cache_key),
                 len(prompt_cache) if prompt_cache is not None else 0,
+                len(prompt_cache_store),
+                prompt_cache_store.nbytes,
+                prompt_cache_store.checkpoint_bytes,
             )
 
         if rank == 0:
@@ -444,19 +1001,17 @@ def _generation_loop_batched(
     tokenizer: Any,
     args: Any,
     prompt_cache_store: LRUPromptCache,
+    checkpoint_policy: _CheckpointPolicy = _CheckpointPolicy(),
 ) -> None:
     rank = dist_state.rank
-    mx.synchronize()
-    if rank == 0:
-        init_seed = int(time.time_ns() & 0x7FFFFFFF)
-        seed_arr = mx.array([init_seed], dtype=mx.int32)
-    else:
-        init_seed = 0
-        seed_arr = mx.zeros((1,), dtype=mx.int32)
-    seed_arr = mx.distributed.all_sum(seed_arr, stream=mx.cpu)
-    mx.eval(seed_arr)
-    mx.synchronize()
-    init_seed = int(seed_arr[0].item())
+    init_seed = int(time.time_ns() & 0x7FFFFFFF)
+    if dist_state.world_size > 1:
+        mx.synchronize()
+        seed_arr = mx.array([init_seed if rank == 0 else 0], dtype=mx.int32)
+        seed_arr = mx.distributed.all_sum(seed_arr, stream=mx.cpu)
+        mx.eval(seed_arr)
+        mx.synchronize()
+        init_seed = int(seed_arr[0].item())
     mx.random.seed(init_seed)
 
     max_inflight = max(2, int(getattr(args, "batch_max_inflight", 4)))
@@ -464,7 +1019,9 @@ def _generation_loop_batched(
     prefill_batch_size = min(prefill_batch_size, max_inflight)
     prefill_step_size = max(1, int(getattr(args, "batch_prefill_step_size", 2048)))
     steps_per_tick = max(1, int(getattr(args, "batch_steps_per_tick", 1)))
+    tick_token_budget = max(1, int(getattr(args, "batch_tick_token_budget", 2048)))
     batch_wait_ms = max(0, int(getattr(args, "batch_wait_ms", 0)))
+    idle_poll_max_ms = max(5, int(getattr(args, "idle_poll_max_ms", 100)))
     wait_steps = max(0, (batch_wait_ms + 4) // 5)
 
     batch_generator = BatchGenerator(
@@ -474,273 +1031,272 @@ def _generation_loop_batched(
         prefill_batch_size=prefill_batch_size,
         prefill_step_size=prefill_step_size,
     )
+    stop_matcher = BatchStopMatcher()
 
     if rank == 0:
         logging.info(
-            "Distributed batching enabled: max_inflight=%d prefill_batch_size=%d prefill_step_size=%d steps_per_tick=%d init_seed=%d",
+            "Distributed batching enabled: max_inflight=%d prefill_batch_size=%d prefill_step_size=%d steps_per_tick=%d tick_token_budget=%d init_seed=%d",
             max_inflight,
             prefill_batch_size,
             prefill_step_size,
             steps_per_tick,
+            tick_token_budget,
             init_seed,
         )
 
     pending: Deque[_PendingRequest] = deque()
+    # Admitted requests whose prompts are being prefilled, oldest first.
+    prefilling: Deque[_PrefillJob] = deque()
     active: Dict[int, _ActiveRequest] = {}
+    last_step_at: Optional[float] = None
 
-    cancel_check_every = max(
-        1, int(os.environ.get("DISTRIBUTED_CANCEL_CHECK_EVERY", "8"))
-    )
-    tick = 0
+    idle = IdleBackoff(max_wait=idle_poll_max_ms / 1000.0)
 
-    while True:
-        # Ensure pipeline comms from the previous decode step finish before
-        # running any control collectives (broadcast/cancel).
-        mx.synchronize()
+    def control_tick(idle_wait: float = 0.0) -> ControlFrame:
+        """Exchange one control frame: queue its requests, apply its cancellations."""
+        if rank == 0:
+            _shed_missed_deadlines(dist_state=dist_state, pending=pending, prefilling=prefilling)
+        candidates = [(state.seq, state.request_id) for state in active.values()]
+        candidates += [(req.seq, req.request_id) for req in pending]
+        candidates += [(job.req.seq, job.req.request_id) for job in prefilling]
+        frame = dist_state.sync_control(
+            max_requests=max(0, max_inflight - len(active) - len(pending) - len(prefilling)),
+            cancel_candidates=candidates,
+            idle_wait=idle_wait,
+        )
 
-        if active and tick % cancel_check_every == 0:
-            canceled_uids = _sync_canceled_uids(dist_state, active, rank=rank)
+        for req in frame.requests:
+            prompt_cache_store.retention_clock = frame.clock
+            if req.op != REQUEST_OP_GENERATE:
+                _run_prefix_op(
+                    dist_state=dist_state,
+                    model=model,
+                    prompt_cache_store=prompt_cache_store,
+                    model_key=args.model,
+                    op=req.op,
+                    prompt_tokens=req.prompt_tokens,
+                    response_queue=req.response_queue,
+                    prefill_step_size=prefill_step_size,
+                    request=req.request,
+                )
+                continue
+            pending.append(_pending_request(req))
+
+        if frame.canceled:
+            canceled = set(frame.canceled)
+            canceled_uids = [uid for uid, state in active.items() if state.seq in canceled]
             if canceled_uids:
                 if rank == 0:
                     logging.info("Canceling %d active requests", len(canceled_uids))
                 batch_generator.remove(canceled_uids)
-                for uid in canceled_uids:
-                    state = active.pop(uid, None)
-                    if state is None:
-                        continue
-                    _finalize_active_request(
-                        dist_state=dist_state,
-                        state=state,
-                        rank=rank,
-                        model_key=args.model,
-                        prompt_cache_store=prompt_cache_store,
-                        prompt_cache=None,
+            for uid in canceled_uids:
+                stop_matcher.remove(uid)
+                _finalize_active_request(
+                    dist_state=dist_state,
+                    state=active.pop(uid),
+                    rank=rank,
+                    model_key=args.model,
+                    prompt_cache_store=prompt_cache_store,
+                    prompt_cache=None,
+                )
+            for job in [job for job in prefilling if job.req.seq in canceled]:
+                prefilling.remove(job)
+                _keep_partial_prefill(job=job, prompt_cache_store=prompt_cache_store, model_key=args.model)
+                if rank == 0:
+                    logging.info(
+                        "Request canceled during prefill (id=%s): %d/%d prompt tokens",
+                        job.req.request_id,
+                        job.pos,
+                        len(job.req.prompt_tokens),
                     )
+                    if job.req.response_queue is not None:
+                        job.req.response_queue.put(None)
+                    dist_state.clear_request_canceled(job.req.request_id)
+            for req in [req for req in pending if req.seq in canceled]:
+                pending.remove(req)
+                if rank == 0:
+                    logging.info("Request canceled before start (id=%s)", req.request_id)
+                    if req.response_queue is not None:
+                        req.response_queue.put(None)
+                    dist_state.clear_request_canceled(req.request_id)
+        return frame
 
-        # Ingest new requests (bounded) so we don't grow detokenizers/queues without bound.
-        while len(active) + len(pending) < max_inflight:
-            (
-                prompt_tokens,
-                max_tokens,
-                seed,
-                temperature,
-                top_p,
-                top_k,
-                seed_is_user,
-                repetition_penalty,
-                repetition_context_size,
-                stop_token_sequences,
-                response_queue,
-                request,
-            ) = dist_state.broadcast_request()
-
-            if prompt_tokens is None:
-                break
-
-            request_id = None
-            if rank == 0 and isinstance(request, dict):
-                request_id = request.get("request_id")
-
-            pending.append(
-                _PendingRequest(
-                    prompt_tokens=prompt_tokens,
-                    max_tokens=max_tokens,
-                    seed=seed,
-                    seed_is_user=bool(seed_is_user),
-                    temperature=temperature,
-                    top_p=top_p,
-                    top_k=top_k,
-                    repetition_penalty=repetition_penalty,
-                    repetition_context_size=repetition_context_size,
-                    stop_token_sequences=stop_token_sequences or [],
-                    request_id=request_id,
-                    response_queue=response_queue,
-                )
+    def shutdown() -> None:
+        if rank == 0:
+            logging.info("Shutting down: ending %d active and %d pending requests", len(active), len(pending))
+        if active:
+            batch_generator.remove(list(active))
+        for state in active.values():
+            _finalize_active_request(
+                dist_state=dist_state,
+                state=state,
+                rank=rank,
+                model_key=args.model,
+                prompt_cache_store=prompt_cache_store,
+                prompt_cache=None,
             )
+        if rank == 0:
+            for req in [job.req for job in prefilling] + list(pending):
+                if req.response_queue is not None:
+                    req.response_queue.put(None)
 
-            # Optional "gather" window when starting from an empty batch.
-            if not active and wait_steps > 0 and len(active) + len(pending) < max_inflight:
-                for _ in range(wait_steps):
-                    if len(active) + len(pending) >= max_inflight:
-                        break
-                    (
-                        prompt_tokens2,
-                        max_tokens2,
-                        seed2,
-                        temperature2,
-                        top_p2,
-                        top_k2,
-                        seed_is_user2,
-                        repetition_penalty2,
-                        repetition_context_size2,
-                        stop_token_sequences2,
-                        response_queue2,
-                        request2,
-                    ) = dist_state.broadcast_request()
-                    if prompt_tokens2 is None:
-                        time.sleep(0.005)
-                        continue
-                    request_id2 = None
-                    if rank == 0 and isinstance(request2, dict):
-                        request_id2 = request2.get("request_id")
-                    pending.append(
-                        _PendingRequest(
-                            prompt_tokens=prompt_tokens2,
-                            max_tokens=max_tokens2,
-                            seed=seed2,
-                            seed_is_user=bool(seed_is_user2),
-                            temperature=temperature2,
-                            top_p=top_p2,
-                            top_k=top_k2,
-                            repetition_penalty=repetition_penalty2,
-                            repetition_context_size=repetition_context_size2,
-                            stop_token_sequences=stop_token_sequences2 or [],
-                            request_id=request_id2,
-                            response_queue=response_queue2,
-                        )
-                    )
-
-        drain_batch = bool(active) and bool(pending) and not pending[0].batchable
+    while True:
+        # Ensure pipeline comms from the previous decode step finish before
+        # exchanging the control frame.
+        mx.synchronize()
 
-        # If the next request is not batchable, serve it sequentially once the
-        # active batch drains.
-        if not active and pending and not pending[0].batchable:
+        # One collective per tick carries new requests (bounded, so we don't
+        # grow detokenizers/queues without bound), cancellations and shutdown.
+        # With nothing to decode, rank 0 holds the frame until work arrives
+        # (or the idle backoff expires) instead of polling every few ms.
+        frame = control_tick(0.0 if active or pending or prefilling else idle.next())
+        if frame.shutdown:
+            shutdown()
+            return
+        if frame.requests or active:
+            idle.reset()
+
+        # Optional "gather" window when starting from an empty batch.
+        if frame.requests and not active and wait_steps > 0:
+            for _ in range(wait_steps):
+                if len(active) + len(pending) + len(prefilling) >= max_inflight:
+                    break
+                frame = control_tick(0.005)
+                if frame.shutdown:
+                    shutdown()
+                    return
+
+        while pending and len(active) + len(prefilling) < max_inflight:
             req = pending.popleft()
-            if rank == 0:
-                logging.info(
-                    "Serving request sequentially (seed specified): max_tokens=%d temperature=%.3f top_p=%.3f top_k=%d",
-                    int(req.max_tokens),
-                    float(req.temperature),
-                    float(req.top_p),
-                    int(req.top_k),
-                )
-            _serve_one_request_sequential(
-                dist_state=dist_state,
+            job = _start_prefill(
                 model=model,
-                tokenizer=tokenizer,
-                args=args,
                 prompt_cache_store=prompt_cache_store,
-                prompt_tokens=req.prompt_tokens,
-                max_tokens=req.max_tokens,
-                seed=req.seed,
-                temperature=req.temperature,
-                top_p=req.top_p,
-                top_k=req.top_k,
-                repetition_penalty=req.repetition_penalty,
-                repetition_context_size=req.repetition_context_size,
-                stop_token_sequences=req.stop_token_sequences,
-                response_queue=req.response_queue,
-                request_id=req.request_id,
+                model_key=args.model,
+                req=req,
+                policy=checkpoint_policy,
+                rank=rank,
             )
-            tick += 1
-            continue
-
-        if not drain_batch:
-            while pending and pending[0].batchable and len(active) < max_inflight:
-                req = pending.popleft()
-
-                if dist_state.sync_should_cancel(req.request_id):
-                    if rank == 0 and req.request_id:
-                        logging.info("Request canceled before start (id=%s)", req.request_id)
-                        if req.response_queue is not None:
-                            req.response_queue.put(None)
-                        dist_state.clear_request_canceled(req.request_id)
-                    continue
+            if job is None:
+                if rank == 0 and req.response_queue is not None:
+                    req.response_queue.put(
+                        {
+                            "text": "Error: empty prompt_tokens (cannot generate).",
+                            "finish_reason": "error",
+                        }
+                    )
+                    req.response_queue.put(None)
+                continue
+            if rank == 0 and job.remaining > prefill_step_size:
+                logging.info(
+                    "Chunked prefill queued: prompt_len=%d reused_len=%d to_prefill=%d chunks=%d",
+                    len(req.prompt_tokens),
+                    job.reused_len,
+                    job.remaining,
+                    -(-job.remaining // prefill_step_size),
+                )
+            prefilling.append(job)
 
-                prompt_cache, tokens_to_process = _prepare_prompt_cache_and_suffix(
+        # Prefill gets what the tick's token budget leaves after decoding the
+        # active batch (at least a quarter of it, so long prompts still move),
+        # so running streams see a bounded gap between tokens.
+        if active:
+            prefill_budget = max(tick_token_budget - len(active) * steps_per_tick, tick_token_budget // 4)
+        else:
+            prefill_budget = max(tick_token_budget, prefill_step_size)
+        prefill_tokens = 0
+        prefill_seconds = 0.0
+        while prefilling:
+            job = prefilling[0]
+            if job.remaining > 0:
+                if prefill_tokens >= prefill_budget:
+                    break
+                t0 = time.perf_counter()
+                prefill_tokens += _advance_prefill(
+                    job=job,
                     model=model,
                     prompt_cache_store=prompt_cache_store,
                     model_key=args.model,
-                    prompt_tokens=req.prompt_tokens,
-                    rank=rank,
+                    budget=prefill_budget - prefill_tokens,
+                    prefill_step_size=prefill_step_size,
                 )
+                prefill_seconds += time.perf_counter() - t0
+                if rank == 0 and job.req.response_queue is not None:
+                    job.req.response_queue.put(PrefillProgress(job.pos, len(job.prompt_tokens)))
+                if job.remaining > 0:
+                    break
+                mx.clear_cache()
+            prefilling.popleft()
+            req = job.req
+            prompt_cache = job.prompt_cache
+            reused_len = job.reused_len
+
+            # BatchGenerator's prompt prefill path cannot merge a mix of empty
+            # and non-empty KV caches. Prime empty caches with a single token
+            # so all inserted prompts have mergeable history caches.
+            tokens_to_process = _prime_empty_prompt_cache(
+                model=model,
+                prompt_cache=prompt_cache,
+                tokens_to_process=req.prompt_tokens[job.pos :],
+            )
 
-                if not tokens_to_process:
-                    if rank == 0 and req.response_queue is not None:
-                        req.response_queue.put(
-                            {
-                                "text": "Error: empty prompt_tokens (cannot generate).",
-                                "finish_reason": "error",
-                            }
-                        )
-                        req.response_queue.put(None)
-                    continue
+            sampler = _request_sampler(
+                seed=req.seed,
+                temperature=req.temperature,
+                top_p=req.top_p,
+                top_k=req.top_k,
+            )
+            processors: List[Any] = []
+            if req.repetition_penalty and req.repetition_penalty != 0.0:
+                processors = make_logits_processors(
+                    repetition_penalty=req.repetition_penalty,
+                    repetition_context_size=req.repetition_context_size,
+                )
 
-                if prompt_cache is None:
-                    prompt_cache = make_prompt_cache(model)
+            (uid,) = batch_generator.insert(
+                [tokens_to_process],
+                req.max_tokens,
+                caches=[prompt_cache],
+                samplers=[sampler],
+                logits_processors=[processors],
+            )
 
-                # BatchGenerator's prompt prefill path cannot merge a mix of empty
-                # and non-empty KV caches. Prime empty caches with a single token
-                # so all inserted prompts have mergeable history caches.
-                tokens_to_process = _prime_empty_prompt_cache(
-                    model=model,
-                    prompt_cache=prompt_cache,
-                    tokens_to_process=tokens_to_process,
-                )
+            stop_matcher.add(uid, compile_stop_sequences(req.stop_token_sequences))
 
-                sampler = make_sampler(
-                    temp=req.temperature,
-                    top_p=req.top_p,
-                    top_k=req.top_k,
-                )
-                processors: List[Any] = []
-                if req.repetition_penalty and req.repetition_penalty != 0.0:
-                    processors = make_logits_processors(
-                        repetition_penalty=req.repetition_penalty,
-                        repetition_context_size=req.repetition_context_size,
+            emit = None
+            if rank == 0 and req.response_queue is not None:
+                emit = req.response_queue.put
+                emit(
+                    RequestUsage(
+                        len(req.prompt_tokens),
+                        reused_len,
+                        _cache_creation_tokens(req.cache_breakpoints, reused_len),
                     )
-
-                (uid,) = batch_generator.insert(
-                    [tokens_to_process],
-                    req.max_tokens,
-                    caches=[prompt_cache],
-                    samplers=[sampler],
-                    logits_processors=[processors],
                 )
 
-                detokenizer = getattr(tokenizer, "detokenizer", None)
-                try:
-                    reset = getattr(detokenizer, "reset", None)
-                    if callable(reset):
-                        reset()
-                except Exception:
-                    pass
-
-                stop_sequences = [s for s in (req.stop_token_sequences or []) if s]
-                stop_lps = [build_kmp_lps(s) for s in stop_sequences]
-                stop_match = [0] * len(stop_sequences)
-
-                pending_items = (
-                    deque() if rank == 0 and req.response_queue is not None else None
-                )
+            active[uid] = _ActiveRequest(
+                cache_key=req.prompt_tokens[:],
+                request_id=req.request_id,
+                response_queue=req.response_queue,
+                cache_breakpoints=req.cache_breakpoints,
+                seq=req.seq,
+                emit=emit,
+            )
 
-                active[uid] = _ActiveRequest(
-                    prompt_len=len(req.prompt_tokens),
-                    cache_key=req.prompt_tokens[:],
-                    detokenizer=detokenizer,
-                    stop_sequences=stop_sequences,
-                    stop_lps=stop_lps,
-                    stop_match=stop_match,
-                    pending_items=pending_items,
-                    generation_tokens=0,
-                    request_id=req.request_id,
-                    response_queue=req.response_queue,
+            if rank == 0:
+                logging.info(
+                    "Batched request inserted: uid=%d prompt_len=%d reused_len=%d max_tokens=%d temperature=%.3f top_p=%.3f top_k=%d",
+                    int(uid),
+                    len(req.prompt_tokens),
+                    reused_len,
+                    int(req.max_tokens),
+                    float(req.temperature),
+                    float(req.top_p),
+                    int(req.top_k),
                 )
 
-                if rank == 0:
-                    logging.info(
-                        "Batched request inserted: uid=%d prompt_len=%d max_tokens=%d temperature=%.3f top_p=%.3f top_k=%d",
-                        int(uid),
-                        len(req.prompt_tokens),
-                        int(req.max_tokens),
-                        float(req.temperature),
-                        float(req.top_p),
-                        int(req.top_k),
-                    )
-
+        dist_state.record_prefill(prefill_tokens, sum(job.remaining for job in prefilling), prefill_seconds)
         if not active:
-            time.sleep(0.005)
-            tick += 1
+            last_step_at = None
             continue
 
         for _ in range(steps_per_tick):
@@ -750,75 +1306,33 @@ def _generation_loop_batched(
             responses = batch_generator.next()
             if not responses:
                 break
+            # The gap between decode steps is every running stream's inter-token latency.
+            now = time.perf_counter()
+            dist_state.record_decode_step(len(responses), now - last_step_at if last_step_at is not None else None)
+            last_step_at = now
 
             stop_uids: List[int] = []
             finished: List[Tuple[int, Optional[List[Any]]]] = []
 
-            for r in responses:
+            _, stop_trims = stop_matcher.step(
+                [int(r.uid) for r in responses], [int(r.token) for r in responses]
+            )
+
+            # Only raw tokens leave the loop; detokenization and stop-text
+            # holdback happen on the request's HTTP thread (TokenStream).
+            for r, stop_trim in zip(responses, stop_trims):
                 state = active.get(int(r.uid))
                 if state is None:
                     continue
 
                 token = int(r.token)
                 state.cache_key.append(token)
-                state.generation_tokens += 1
-
-                if r.finish_reason != "stop":
-                    try:
-                        add_token = getattr(state.detokenizer, "add_token", None)
-                        if callable(add_token):
-                            add_token(token)
-                    except Exception:
-                        pass
-                if r.finish_reason is not None:
-                    try:
-                        finalize = getattr(state.detokenizer, "finalize", None)
-                        if callable(finalize):
-                            finalize()
-                    except Exception:
-                        pass
-
-                try:
-                    segment = getattr(state.detokenizer, "last_segment", "")
-                except Exception:
-                    segment = ""
-                if not isinstance(segment, str):
-                    segment = ""
-
-                holdback = 0
-                stop_trim = 0
-                if state.stop_sequences:
-                    for i, seq in enumerate(state.stop_sequences):
-                        l = state.stop_match[i]
-                        while l > 0 and seq[l] != token:
-                            l = state.stop_lps[i][l - 1]
-                        if l < len(seq) and seq[l] == token:
-                            l += 1
-                        if l > holdback:
-                            holdback = l
-                        if l == len(seq) and len(seq) > stop_trim:
-                            stop_trim = len(seq)
-                        state.stop_match[i] = l
-
-                if state.pending_items is not None and state.response_queue is not None:
-                    state.pending_items.append(
-                        {
-                            "text": segment,
-                            "finish_reason": r.finish_reason,
-                            "prompt_tokens": state.prompt_len,
-                            "generation_tokens": state.generation_tokens,
-                            "token": token,
-                        }
-                    )
+                if state.emit is not None:
+                    state.emit((token, r.finish_reason))
 
-                    if stop_trim > 0:
-                        for _ in range(min(stop_trim, len(state.pending_items))):
-                            state.pending_items.pop()
-                        stop_uids.append(int(r.uid))
-                    else:
-                        flush_count = len(state.pending_items) - holdback
-                        for _ in range(max(0, flush_count)):
-                            state.response_queue.put(state.pending_items.popleft())
+                # Every rank matches stops, so every rank removes the request.
+                if stop_trim > 0:
+                    stop_uids.append(int(r.uid))
 
                 if r.finish_reason is not None:
                     finished.append((int(r.uid), getattr(r, "prompt_cache", None)))
@@ -844,6 +1358,7 @@ def _generation_loop_batched(
 
                 batch_generator.remove(stop_uids)
                 for uid in stop_uids:
+                    stop_matcher.remove(uid)
                     state = active.pop(uid, None)
                     if state is None:
                         continue
@@ -857,6 +1372,7 @@ def _generation_loop_batched(
                     )
 
             for uid, prompt_cache in finished:
+                stop_matcher.remove(uid)
                 state = active.pop(uid, None)
                 if state is None:
                     continue
@@ -869,7 +1385,6 @@ def _generation_loop_batched(
                     prompt_cache=prompt_cache,
                 )
 
-        tick += 1
 
 def generation_loop(dist_state, model, tokenizer, args, prompt_cache_store=None):
     """Main generation loop running on ALL ranks.
@@ -881,45 +1396,52 @@ def generation_loop(dist_state, model, tokenizer, args, prompt_cache_store=None)
 
     # Initialize prompt cache store if not provided.
     if prompt_cache_store is None:
-        prompt_cache_store = LRUPromptCache(max_size=max(0, int(args.prompt_cache_size)))
+        prompt_cache_store = _make_prompt_cache_store(dist_state, args, model)
+    dist_state.prompt_cache_store = prompt_cache_store
+    checkpoint_policy = _make_checkpoint_policy(tokenizer, args)
 
     batch_enabled = bool(getattr(args, "batch", False)) and int(
         getattr(args, "batch_max_inflight", 0)
     ) > 1
     if batch_enabled:
         if _is_model_batchable_for_distributed(model):
-            _generation_loop_batched(dist_state, model, tokenizer, args, prompt_cache_store)
+            _generation_loop_batched(
+                dist_state, model, tokenizer, args, prompt_cache_store, checkpoint_policy
+            )
             return
         if rank == 0:
             logging.warning(
                 "Batching requested but model caches are not batchable; running sequential."
             )
 
+    idle = IdleBackoff(max_wait=max(5, int(getattr(args, "idle_poll_max_ms", 100))) / 1000.0)
     request_n = 0
     while True:
-        (
-            prompt_tokens,
-            max_tokens,
-            seed,
-            temperature,
-            top_p,
-            top_k,
-            seed_is_user,
-            repetition_penalty,
-            repetition_context_size,
-            stop_token_sequences,
-            response_queue,
-            request,
-        ) = dist_state.broadcast_request()
-
-        if prompt_tokens is None:
-            # No request - brief sleep to avoid busy-waiting
-            time.sleep(0.005)
+        # No request: rank 0 waits for one (with backoff) before the next frame.
+        frame = dist_state.sync_control(max_requests=1, idle_wait=idle.next())
+        if frame.shutdown:
+            if rank == 0:
+                logging.info("Shutting down generation loop")
+            return
+        if not frame.requests:
             continue
+        idle.reset()
+        req = frame.requests[0]
+        prompt_cache_store.retention_clock = frame.clock
 
-        request_id = None
-        if rank == 0 and isinstance(request, dict):
-            request_id = request.get("request_id")
+        if req.op != REQUEST_OP_GENERATE:
+            _run_prefix_op(
+                dist_state=dist_state,
+                model=model,
+                prompt_cache_store=prompt_cache_store,
+                model_key=args.model,
+                op=req.op,
+                prompt_tokens=req.prompt_tokens,
+                response_queue=req.response_queue,
+                prefill_step_size=2048,
+                request=req.request,
+            )
+            continue
 
         request_n += 1
 
@@ -927,15 +1449,15 @@ def generation_loop(dist_state, model, tokenizer, args, prompt_cache_store=None)
             logging.info(
                 "Request params: req=%d seed=%d seed_is_user=%d max_tokens=%d temperature=%.3f top_p=%.3f top_k=%d repetition_penalty=%.3f repetition_context_size=%d stop_sequences=%d",
                 request_n,
-                int(seed),
-                int(seed_is_user),
-                int(max_tokens) if max_tokens is not None else 0,
-                float(temperature),
-                float(top_p),
-                int(top_k),
-                float(repetition_penalty),
-                int(repetition_context_size),
-                len(stop_token_sequences or []),
+                int(req.seed),
+                int(req.seed_is_user),
+                int(req.max_tokens),
+                float(req.temperature),
+                float(req.top_p),
+                int(req.top_k),
+                float(req.repetition_penalty),
+                int(req.repetition_context_size),
+                len(req.stop_token_sequences),
             )
 
         _serve_one_request_sequential(
@@ -944,17 +1466,20 @@ def generation_loop(dist_state, model, tokenizer, args, prompt_cache_store=None)
             tokenizer=tokenizer,
             args=args,
             prompt_cache_store=prompt_cache_store,
-            prompt_tokens=prompt_tokens,
-            max_tokens=max_tokens,
-            seed=seed,
-            temperature=temperature,
-            top_p=top_p,
-            top_k=top_k,
-            repetition_penalty=repetition_penalty,
-            repetition_context_size=repetition_context_size,
-            stop_token_sequences=stop_token_sequences or [],
-            response_queue=response_queue,
-            request_id=request_id,
+            prompt_tokens=req.prompt_tokens,
+            max_tokens=req.max_tokens,
+            seed=req.seed,
+            temperature=req.temperature,
+            top_p=req.top_p,
+            top_k=req.top_k,
+            repetition_penalty=req.repetition_penalty,
+            repetition_context_size=req.repetition_context_size,
+            stop_token_sequences=req.stop_token_sequences,
+            response_queue=req.response_queue,
+            request_id=req.request_id,
+            checkpoint_policy=checkpoint_policy,
+            cache_breakpoints=req.cache_breakpoints,
         )
 
+
 __all__ = ["generation_loop"]
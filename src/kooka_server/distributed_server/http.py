@@ -2,9 +2,12 @@ from __future__ import annotations
 
 import json
 import logging
+import math
 import os
 import select
 import socket
+import struct
+import tempfile
 import time
 import uuid
 from http.server import BaseHTTPRequestHandler, HTTPServer
@@ -13,10 +16,18 @@ from socketserver import ThreadingMixIn
 from typing import Any, List, Optional
 
 from ..api.anthropic.messages import (
+    anthropic_usage,
+    cache_control_offsets,
     convert_anthropic_to_openai_messages,
     convert_anthropic_tools,
     process_message_content,
 )
+from ..api.canonicalize import (
+    canonicalize_request,
+    common_prefix_len,
+    log_canonicalization,
+    pinned_template_vars,
+)
 from ..api.models_endpoint import list_models as list_v1_models
 from ..api.openai.tool_calls import make_openai_tool_call, normalize_finish_reason_for_tool_calls
 from ..logging_utils import redact_request_body
@@ -25,12 +36,28 @@ from ..tool_fixes import (
     apply as apply_tool_fixes,
     infer_tool_parser_type,
 )
+from .admission import DEFAULT_MAX_WAIT, DEFAULT_PRIORITY_CLASSES
 from .constants import (
     DEFAULT_REPETITION_CONTEXT_SIZE,
     DEFAULT_REPETITION_PENALTY,
+    MAX_PROMPT_LENGTH,
     MAX_STOP_SEQUENCES,
     MAX_STOP_SEQUENCE_LENGTH,
+    REQUEST_OP_EXPORT_SESSION,
+    REQUEST_OP_IMPORT_SESSION,
+    REQUEST_OP_PIN_PREFIX,
+    REQUEST_OP_UNPIN_PREFIX,
 )
+from .session_snapshot import read_session_metadata
+from .template_cache import PromptTokenCache
+from .token_stream import PrefillProgress, TokenChannel, TokenDeliveryStats, TokenStream
+from .tokenizer_pool import make_tokenizer_pool
+
+# Read/write size for streamed KV session snapshots.
+_SESSION_CHUNK_BYTES = 1 << 20
+# Non-streaming requests only need their tokens at the end (and on cancel polls).
+_BLOCKING_FLUSH_TOKENS = 256
+_BLOCKING_FLUSH_MS = 1000.0
 
 
 def apply_chat_template_safe(
@@ -40,6 +67,7 @@ def apply_chat_template_safe(
     tools: Any,
     add_generation_prompt: bool,
     tokenize: bool,
+    **template_args: Any,
 ) -> str:
     """Apply a chat template while normalizing empty tools to None."""
     return tokenizer.apply_chat_template(
@@ -47,6 +75,7 @@ def apply_chat_template_safe(
         tools=tools or None,
         add_generation_prompt=add_generation_prompt,
         tokenize=tokenize,
+        **template_args,
     )
 
 
@@ -54,19 +83,58 @@ class BadRequestError(Exception):
     pass
 
 
+class OverloadedError(Exception):
+    """Request shed by admission control: answered with `status` and a Retry-After."""
+
+    def __init__(self, status: int, message: str, retry_after: float):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
 class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
     """Thread-per-request HTTP server."""
     daemon_threads = True
 
 
+class _SSEBuffer:
+    """Collects SSE frames so a batch of them goes out in one socket write.
+
+    The handler's wfile is unbuffered: every write is a send and flush() does
+    nothing, so frames are joined here and written on `flush`.
+    """
+
+    def __init__(self, wfile: Any, stats: TokenDeliveryStats):
+        self._wfile = wfile
+        self._stats = stats
+        self._parts: List[bytes] = []
+
+    def write(self, data: bytes) -> None:
+        self._parts.append(data)
+
+    def flush(self) -> None:
+        if not self._parts:
+            return
+        data = b"".join(self._parts)
+        self._parts.clear()
+        self._wfile.write(data)
+        self._wfile.flush()
+        self._stats.record(writes=1)
+
+
 class DistributedHandler(BaseHTTPRequestHandler):
     """HTTP request handler for distributed inference."""
 
-    def __init__(self, dist_state, tokenizer, args, *handler_args, **handler_kwargs):
+    def __init__(self, dist_state, tokenizer, args, *handler_args, template_args=None, **handler_kwargs):
         self.dist_state = dist_state
         self.tokenizer = tokenizer
         self.args = args
         self.created = int(time.time())
+        if template_args is None:
+            template_args = pinned_template_vars(getattr(args, "pin_template_vars", None))
+        self.template_args = template_args
+        self._canonical_prefix: Optional[int] = None
+        self._canonical_changes: List[str] = []
         super().__init__(*handler_args, **handler_kwargs)
 
     def log_message(self, format, *args):
@@ -87,6 +155,12 @@ class DistributedHandler(BaseHTTPRequestHandler):
             self._json_response(200, {"status": "ok"})
         elif self.path.startswith("/v1/models"):
             self._handle_models_request()
+        elif self.path.split("?")[0] == "/v1/cache/stats":
+            self._handle_cache_stats()
+        elif self.path.split("?")[0] == "/v1/cache/prefixes":
+            self._handle_list_prefixes()
+        elif self.path.split("?")[0] == "/v1/stats":
+            self._handle_server_stats()
         else:
             self.send_error(404)
 
@@ -94,6 +168,212 @@ class DistributedHandler(BaseHTTPRequestHandler):
         models = list_v1_models(created=self.created, active_model=self.args.model, request_path=self.path)
         self._json_response(200, {"object": "list", "data": models})
 
+    def _handle_cache_stats(self):
+        store = getattr(self.dist_state, "prompt_cache_store", None)
+        stats = store.stats() if store is not None else None
+        token_cache = self.dist_state.prompt_token_cache
+        self._json_response(200, {
+            "prompt_cache": stats,
+            "prompt_token_cache": token_cache.stats() if token_cache is not None else None,
+            "canonicalization": self.dist_state.canonical_stats.snapshot(),
+        })
+
+    def _handle_server_stats(self):
+        pool = self.dist_state.tokenizer_pool
+        self._json_response(200, {
+            "tokenizer_pool": pool.stats() if pool is not None else None,
+            "control_plane": self.dist_state.control_plane_stats(),
+            "scheduler": self.dist_state.scheduler_stats(),
+            "token_delivery": self.dist_state.token_delivery.snapshot(),
+            "admission": self.dist_state.admission_stats(),
+        })
+
+    def _token_channel(self, stream: bool) -> TokenChannel:
+        if not stream:
+            return TokenChannel(_BLOCKING_FLUSH_TOKENS, _BLOCKING_FLUSH_MS)
+        return TokenChannel(
+            int(getattr(self.args, "stream_flush_tokens", 4)),
+            float(getattr(self.args, "stream_flush_ms", 50.0)),
+        )
+
+    def _token_stream(
+        self, channel: TokenChannel, stop_token_sequences: List[List[int]], progress: bool = False
+    ) -> TokenStream:
+        return TokenStream(
+            channel, self.tokenizer, stop_token_sequences, self.dist_state.token_delivery, progress=progress
+        )
+
+    @staticmethod
+    def _progress_comment(progress: PrefillProgress) -> bytes:
+        # Same SSE comment as mlx-lm's server: clients ignore it, proxies see bytes.
+        return f": keepalive {progress.processed}/{progress.total}\n\n".encode()
+
+    def _prompt_cache_store(self):
+        store = getattr(self.dist_state, "prompt_cache_store", None)
+        if store is None or store.max_size <= 0:
+            raise BadRequestError("Prompt cache is disabled")
+        return store
+
+    def _run_prefix_op(self, op: int, prompt_tokens: List[int], **extra: Any) -> dict:
+        response_queue = Queue()
+        self.dist_state.request_queue.put({
+            "op": op,
+            "prompt_tokens": prompt_tokens,
+            "max_tokens": 0,
+            "response_queue": response_queue,
+            **extra,
+        })
+        return response_queue.get()
+
+    def _handle_list_prefixes(self):
+        store = getattr(self.dist_state, "prompt_cache_store", None)
+        prefixes = store.pinned_prefixes() if store is not None else []
+        self._json_response(200, {"object": "list", "data": prefixes})
+
+    def _handle_pin_prefix(self):
+        """Prefill and pin a shared prefix (system prompt, tool schemas, few-shot turns).
+
+        The messages are rendered without a generation prompt, so any later
+        request that extends them with more turns starts with the same tokens.
+        """
+        body = self._parse_body()
+        self._prompt_cache_store()
+        messages = body.get("messages")
+        if not isinstance(messages, list) or not messages:
+            raise BadRequestError("messages must be a non-empty list")
+        tools = body.get("tools")
+        process_message_content(messages)
+        prompt_tokens = self._render_prefix(messages, tools)
+        if not prompt_tokens:
+            raise BadRequestError("Prefix renders to an empty prompt")
+        if len(prompt_tokens) > MAX_PROMPT_LENGTH:
+            raise BadRequestError(f"Prefix exceeds {MAX_PROMPT_LENGTH} tokens")
+
+        logging.info(f"Pinning prompt prefix: {len(prompt_tokens)} tokens")
+        result = self._run_prefix_op(REQUEST_OP_PIN_PREFIX, prompt_tokens)
+        if "error" in result:
+            self._json_response(500, result)
+        else:
+            self._json_response(200, result)
+
+    def _session_tokens(self, session_id: str) -> Optional[List[int]]:
+        tokens = self.dist_state.sessions.get(session_id)
+        if tokens is None:
+            pinned = self._prompt_cache_store().pinned_tokens(session_id)
+            tokens = pinned[1] if pinned is not None else None
+        return tokens
+
+    def _handle_export_session(self):
+        """Stream the cached KV state for a conversation as a safetensors blob.
+
+        The body names the conversation either by `messages` (+ `tools`),
+        rendered without a generation prompt like a pinned prefix, or by a
+        `session` id returned from an earlier export/import or prefix pin. The
+        longest cached prefix is exported; 404 if nothing is cached.
+        """
+        body = self._parse_body()
+        self._prompt_cache_store()
+        session_id = body.get("session")
+        if session_id is not None:
+            prompt_tokens = self._session_tokens(str(session_id))
+            if prompt_tokens is None:
+                self._json_response(404, {"error": "Unknown session id"})
+                return
+        else:
+            messages = body.get("messages")
+            if not isinstance(messages, list) or not messages:
+                raise BadRequestError("messages must be a non-empty list (or pass a session id)")
+            process_message_content(messages)
+            prompt_tokens = self._render_prefix(messages, body.get("tools"))
+        if not prompt_tokens:
+            raise BadRequestError("Session renders to an empty prompt")
+        if len(prompt_tokens) > MAX_PROMPT_LENGTH:
+            raise BadRequestError(f"Session exceeds {MAX_PROMPT_LENGTH} tokens")
+
+        fd, path = tempfile.mkstemp(prefix="kooka-session-", suffix=".safetensors")
+        os.close(fd)
+        try:
+            result = self._run_prefix_op(REQUEST_OP_EXPORT_SESSION, prompt_tokens, path=path)
+            if "error" in result:
+                self._json_response(500, result)
+                return
+            if not result["tokens"]:
+                self._json_response(404, {"error": "No cached KV state for this session"})
+                return
+            self.dist_state.remember_session(result["id"], prompt_tokens[: result["tokens"]])
+
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(os.path.getsize(path)))
+            self.send_header("X-Kooka-Session", result["id"])
+            self.send_header("X-Kooka-Session-Tokens", str(result["tokens"]))
+            self._set_cors_headers()
+            self.end_headers()
+            with open(path, "rb") as f:
+                while chunk := f.read(_SESSION_CHUNK_BYTES):
+                    self.wfile.write(chunk)
+        finally:
+            os.unlink(path)
+
+    def _handle_import_session(self):
+        """Load a blob from /v1/cache/sessions/export into the prompt cache."""
+        self._prompt_cache_store()
+        length = int(self.headers.get("Content-Length", 0))
+        if length <= 8:
+            raise BadRequestError("Request body must be a KV session snapshot")
+
+        fd, path = tempfile.mkstemp(prefix="kooka-session-", suffix=".safetensors")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                while length > 0:
+                    chunk = self.rfile.read(min(length, _SESSION_CHUNK_BYTES))
+                    if not chunk:
+                        raise BadRequestError("Truncated request body")
+                    f.write(chunk)
+                    length -= len(chunk)
+            try:
+                metadata = read_session_metadata(path)
+            except (ValueError, KeyError, struct.error) as e:
+                raise BadRequestError(f"Invalid KV session snapshot: {e}") from e
+            if metadata["model"] != str(self.args.model):
+                raise BadRequestError(f"Snapshot is for model {metadata['model']!r}")
+            if metadata["world_size"] != self.dist_state.world_size:
+                raise BadRequestError(
+                    f"Snapshot was taken on {metadata['world_size']} ranks, server has {self.dist_state.world_size}"
+                )
+            prompt_tokens = [int(t) for t in metadata["tokens"]]
+            if not prompt_tokens or len(prompt_tokens) > MAX_PROMPT_LENGTH:
+                raise BadRequestError(f"Snapshot must cover 1..{MAX_PROMPT_LENGTH} tokens")
+
+            logging.info(f"Importing KV session: {len(prompt_tokens)} tokens")
+            result = self._run_prefix_op(REQUEST_OP_IMPORT_SESSION, prompt_tokens, path=path)
+            if "error" in result:
+                self._json_response(400, result)
+                return
+            self.dist_state.remember_session(result["id"], prompt_tokens)
+            self._json_response(200, result)
+        finally:
+            os.unlink(path)
+
+    def do_DELETE(self):
+        path = self.path.split("?")[0]
+        prefix = "/v1/cache/prefixes/"
+        if not path.startswith(prefix) or len(path) == len(prefix):
+            self.send_error(404)
+            return
+        try:
+            pinned = self._prompt_cache_store().pinned_tokens(path[len(prefix):])
+            if pinned is None:
+                self._json_response(404, {"error": "Unknown prefix id"})
+                return
+            _, prompt_tokens = pinned
+            self._json_response(200, self._run_prefix_op(REQUEST_OP_UNPIN_PREFIX, prompt_tokens))
+        except BadRequestError as e:
+            self._json_response(400, {"error": str(e)})
+        except Exception as e:
+            logging.exception("Request error")
+            self._json_response(500, {"error": str(e)})
+
     def do_POST(self):
         path = self.path.split("?")[0]  # Remove query string
 
@@ -102,6 +382,9 @@ class DistributedHandler(BaseHTTPRequestHandler):
             "/chat/completions": self._handle_chat,
             "/v1/completions": self._handle_text,
             "/v1/messages": self._handle_anthropic,
+            "/v1/cache/prefixes": self._handle_pin_prefix,
+            "/v1/cache/sessions/export": self._handle_export_session,
+            "/v1/cache/sessions/import": self._handle_import_session,
         }
 
         handler = handlers.get(path)
@@ -113,6 +396,8 @@ class DistributedHandler(BaseHTTPRequestHandler):
             handler()
         except BadRequestError as e:
             self._json_response(400, {"error": str(e)})
+        except OverloadedError as e:
+            self._json_response(e.status, {"error": str(e)}, {"Retry-After": str(e.retry_after)})
         except Exception as e:
             logging.exception("Request error")
             self._json_response(500, {"error": str(e)})
@@ -128,9 +413,11 @@ class DistributedHandler(BaseHTTPRequestHandler):
             raise BadRequestError("Request body must be a JSON object")
         return body
 
-    def _json_response(self, code, data):
+    def _json_response(self, code, data, headers: Optional[dict] = None):
         self.send_response(code)
         self.send_header("Content-Type", "application/json")
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
         self._set_cors_headers()
         self.end_headers()
         self.wfile.write(json.dumps(data).encode())
@@ -154,6 +441,92 @@ class DistributedHandler(BaseHTTPRequestHandler):
         except (TypeError, ValueError):
             return None, False
 
+    def _api_key(self) -> Optional[str]:
+        auth = self.headers.get("Authorization") or ""
+        if auth.lower().startswith("bearer "):
+            return auth[7:].strip() or None
+        return self.headers.get("x-api-key") or None
+
+    def _parse_priority(self, body: dict) -> dict:
+        """Priority class and fair-share client for the request queue.
+
+        An API key listed in --priority-api-keys fixes the class; otherwise the
+        X-Priority header, then a "priority" body field. The client is the API
+        key, else the body's user id, else the peer address.
+        """
+        queue = self.dist_state.request_queue
+        api_key = self._api_key()
+        priority = (getattr(self.args, "priority_api_keys", None) or {}).get(api_key) if api_key else None
+        if priority is None:
+            priority = str(self.headers.get("X-Priority") or body.get("priority") or queue.default_priority)
+        if priority not in queue.classes:
+            raise BadRequestError(f"Unknown priority {priority!r}; expected one of {sorted(queue.classes)}")
+        metadata = body.get("metadata")
+        client = api_key or body.get("user") or (metadata.get("user_id") if isinstance(metadata, dict) else None)
+        return {"priority": priority, "client": str(client or self.client_address[0])}
+
+    def _parse_timeout(self, body: dict) -> Optional[float]:
+        """Seconds the client will wait for the response (X-Request-Timeout header or "timeout" field)."""
+        raw = self.headers.get("X-Request-Timeout") or body.get("timeout")
+        if raw is None:
+            return None
+        try:
+            timeout = float(raw)
+        except (TypeError, ValueError):
+            raise BadRequestError(f"Invalid request timeout: {raw!r}") from None
+        if not timeout > 0:
+            raise BadRequestError("Request timeout must be positive")
+        return timeout
+
+    def _enqueue(self, request: dict, timeout: Optional[float]) -> None:
+        """Queue a generate request, unless admission control turns it away first.
+
+        Prompts that don't fit the context are a 400 (max_tokens is clamped to
+        what's left). A full queue is a 429, and a timeout shorter than the
+        estimated queue wait is a 503; both carry that estimate as Retry-After.
+        """
+        dist_state = self.dist_state
+        shed = dist_state.shed_stats
+        self._request_deadline = None
+        context = int(getattr(self.args, "max_context_tokens", 0) or 0) or dist_state.context_length
+        prompt_len = len(request["prompt_tokens"])
+        if context:
+            if prompt_len >= context:
+                shed["context_overflow"] += 1
+                raise BadRequestError(f"Prompt is {prompt_len} tokens; the model's context length is {context} tokens")
+            request["max_tokens"] = min(request["max_tokens"], context - prompt_len)
+
+        max_queued = int(getattr(self.args, "max_queued_requests", 0) or 0)
+        if max_queued and dist_state.request_queue.qsize() >= max_queued:
+            shed["queue_full"] += 1
+            raise OverloadedError(
+                429, "Request queue is full", dist_state.estimate_queue_wait(request.get("priority"))
+            )
+        if timeout is not None:
+            wait = dist_state.estimate_queue_wait(request.get("priority"))
+            if wait >= timeout:
+                shed["deadline"] += 1
+                raise OverloadedError(
+                    503, f"Estimated queue wait {wait:.1f}s exceeds the request timeout of {timeout:g}s", wait
+                )
+            request["deadline"] = self._request_deadline = time.perf_counter() + timeout
+        dist_state.request_queue.put(request)
+
+    def _shed_response(self, item: dict) -> None:
+        """A request dropped by the generation loop before it started (blocking handlers)."""
+        self._json_response(
+            item["status"], {"error": item.get("text", "")}, {"Retry-After": str(item.get("retry_after", 1))}
+        )
+
+    def _blocking_timeout(self) -> float:
+        """DISTRIBUTED_BLOCKING_TIMEOUT_S, cut short by the request's own deadline."""
+        timeout = float(os.environ.get("DISTRIBUTED_BLOCKING_TIMEOUT_S", "3600"))
+        deadline = getattr(self, "_request_deadline", None)
+        if deadline is not None:
+            remaining = max(0.001, deadline - time.perf_counter())
+            timeout = min(timeout, remaining) if timeout > 0 else remaining
+        return timeout
+
     def _parse_max_tokens(self, body: dict) -> int:
         max_tokens = body.get("max_completion_tokens", None)
         if max_tokens is None:
@@ -236,6 +609,8 @@ class DistributedHandler(BaseHTTPRequestHandler):
         max_tokens = self._parse_max_tokens(body)
         temperature, top_p, top_k, repetition_penalty, repetition_context_size = self._parse_sampling(body)
         seed, seed_is_user = self._parse_seed(body)
+        admission = self._parse_priority(body)
+        timeout = self._parse_timeout(body)
         stop_token_sequences = self._parse_stop_token_sequences(body.get("stop") or [])
         model = body.get("model", self.args.model)
 
@@ -267,26 +642,20 @@ class DistributedHandler(BaseHTTPRequestHandler):
 
         process_message_content(messages)
 
-        prompt = apply_chat_template_safe(
-            self.tokenizer,
-            messages,
-            tools=tools,
-            add_generation_prompt=True,
-            tokenize=False,
-        )
+        prompt, prompt_tokens, tools = self._render_chat_prompt(messages, tools)
         emit_initial_think = prompt.rstrip().endswith("<think>")
-        prompt_tokens = self.tokenizer.encode(prompt)
         
         logging.info(f"Processing prompt: {len(prompt_tokens)} tokens")
 
         request_id = f"chatcmpl-{uuid.uuid4().hex[:8]}"
-        response_queue = Queue()
-        self.dist_state.request_queue.put({
+        response_queue = self._token_channel(stream)
+        self._enqueue({
             "request_id": request_id,
             "prompt_tokens": prompt_tokens,
             "max_tokens": max_tokens,
             "seed": seed,
             "seed_is_user": seed_is_user,
+            **admission,
             "temperature": temperature,
             "top_p": top_p,
             "top_k": top_k,
@@ -295,15 +664,16 @@ class DistributedHandler(BaseHTTPRequestHandler):
             "stop_token_sequences": stop_token_sequences,
             "response_queue": response_queue,
             "tools": tools,
-        })
+        }, timeout)
 
         if stream:
-            self._stream_chat(response_queue, request_id, model, tools, stream_options, emit_initial_think)
+            self._stream_chat(self._token_stream(response_queue, stop_token_sequences, progress=True), request_id, model, tools, stream_options, emit_initial_think)
         else:
-            self._blocking_chat(response_queue, request_id, model, tools, emit_initial_think)
+            self._blocking_chat(self._token_stream(response_queue, stop_token_sequences), request_id, model, tools, emit_initial_think)
 
     def _stream_chat(self, queue, request_id, model, tools, stream_options, emit_initial_think: bool = False):
         self._stream_response()
+        out = _SSEBuffer(self.wfile, self.dist_state.token_delivery)
 
         has_tool_calling = getattr(self.tokenizer, "has_tool_calling", False)
         tool_call_start = getattr(self.tokenizer, "tool_call_start", None)
@@ -413,12 +783,12 @@ class DistributedHandler(BaseHTTPRequestHandler):
                 "model": model,
                 "choices": [{"index": 0, "delta": delta, "finish_reason": finish}],
             }
-            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
-            self.wfile.flush()
+            out.write(f"data: {json.dumps(chunk)}\n\n".encode())
 
         # Emit an initial chunk to avoid idle timeouts during long prefill.
         try:
             send_chunk("", force=True)
+            out.flush()
         except Exception:
             pass
 
@@ -441,8 +811,10 @@ class DistributedHandler(BaseHTTPRequestHandler):
         try:
             if emit_initial_think:
                 send_chunk("<think>\n")
+                out.flush()
             while True:
-                if client_disconnected():
+                # Between batches only: the rest of a batch is already here.
+                if not queue.ready() and client_disconnected():
                     try:
                         self.dist_state.cancel_request(request_id)
                     except Exception:
@@ -461,17 +833,23 @@ class DistributedHandler(BaseHTTPRequestHandler):
                     # even when the model is busy (e.g. long prefill) and no tokens are produced yet.
                     try:
                         send_chunk("", force=True)
+                        out.flush()
                     except Exception:
                         pass
                     continue
 
                 if item is None:
                     break
+                if isinstance(item, PrefillProgress):
+                    out.write(self._progress_comment(item))
+                    out.flush()
+                    continue
 
                 gen_text = item.get("text", "")
                 finish_reason = item.get("finish_reason")
                 prompt_toks = item.get("prompt_tokens", prompt_toks)
                 gen_toks = item.get("generation_tokens", gen_toks)
+                self._note_cached_tokens(item)
 
                 if has_tool_calling and gen_text == tool_call_start:
                     in_tool_call = True
@@ -485,10 +863,14 @@ class DistributedHandler(BaseHTTPRequestHandler):
                 else:
                     content_buffer += gen_text
 
+                if queue.ready():
+                    # Fold the rest of this batch into the same chunk and write.
+                    continue
                 if not in_tool_call and (content_buffer or tool_calls):
                     send_chunk(content_buffer, tool_calls if tool_calls else None, finish=None)
                     content_buffer = ""
                     tool_calls.clear()
+                out.flush()
 
             final_finish = normalize_finish_reason_for_tool_calls(finish_reason or "stop", saw_tool_calls=saw_tool_calls)
 
@@ -512,11 +894,10 @@ class DistributedHandler(BaseHTTPRequestHandler):
                         "total_tokens": prompt_toks + gen_toks,
                     },
                 }
-                self.wfile.write(f"data: {json.dumps(usage_chunk)}\n\n".encode())
-                self.wfile.flush()
+                out.write(f"data: {json.dumps(usage_chunk)}\n\n".encode())
 
-            self.wfile.write(b"data: [DONE]\n\n")
-            self.wfile.flush()
+            out.write(b"data: [DONE]\n\n")
+            out.flush()
         except (BrokenPipeError, ConnectionResetError):
             # Client disconnected; signal generation loop to stop for this request.
             try:
@@ -599,8 +980,8 @@ class DistributedHandler(BaseHTTPRequestHandler):
                     parsed.append(tc)
             return parsed
 
-        blocking_timeout_s = float(os.environ.get("DISTRIBUTED_BLOCKING_TIMEOUT_S", "3600"))
-        blocking_poll_s = float(os.environ.get("DISTRIBUTED_BLOCKING_POLL_S", "1"))
+        blocking_timeout_s = self._blocking_timeout()
+        blocking_poll_s = min(blocking_timeout_s, float(os.environ.get("DISTRIBUTED_BLOCKING_POLL_S", "1")))
         start_t = time.perf_counter()
 
         while True:
@@ -645,6 +1026,9 @@ class DistributedHandler(BaseHTTPRequestHandler):
                 item = queue.get()
             if item is None:
                 break
+            if "status" in item:
+                self._shed_response(item)
+                return
             gen_text = item.get("text", "")
             if has_tool_calling and gen_text == tool_call_start:
                 made_tool_call = True
@@ -661,6 +1045,7 @@ class DistributedHandler(BaseHTTPRequestHandler):
             finish_reason = item.get("finish_reason")
             prompt_toks = item.get("prompt_tokens", 0)
             gen_toks = item.get("generation_tokens", 0)
+            self._note_cached_tokens(item)
 
         tool_calls_payload = parse_tools(tool_calls)
 
@@ -701,19 +1086,22 @@ class DistributedHandler(BaseHTTPRequestHandler):
         max_tokens = self._parse_max_tokens(body)
         temperature, top_p, top_k, repetition_penalty, repetition_context_size = self._parse_sampling(body)
         seed, seed_is_user = self._parse_seed(body)
+        admission = self._parse_priority(body)
+        timeout = self._parse_timeout(body)
         stop_token_sequences = self._parse_stop_token_sequences(body.get("stop") or [])
         model = body.get("model", self.args.model)
 
         prompt_tokens = self.tokenizer.encode(prompt)
 
-        response_queue = Queue()
+        response_queue = self._token_channel(stream)
         request_id = f"cmpl-{uuid.uuid4().hex[:8]}"
-        self.dist_state.request_queue.put({
+        self._enqueue({
             "request_id": request_id,
             "prompt_tokens": prompt_tokens,
             "max_tokens": max_tokens,
             "seed": seed,
             "seed_is_user": seed_is_user,
+            **admission,
             "temperature": temperature,
             "top_p": top_p,
             "top_k": top_k,
@@ -722,45 +1110,63 @@ class DistributedHandler(BaseHTTPRequestHandler):
             "stop_token_sequences": stop_token_sequences,
             "response_queue": response_queue,
             "tools": None,
-        })
+        }, timeout)
 
         if stream:
-            self._stream_text(response_queue, request_id, model)
+            self._stream_text(self._token_stream(response_queue, stop_token_sequences, progress=True), request_id, model)
         else:
-            self._blocking_text(response_queue, request_id, model)
+            self._blocking_text(self._token_stream(response_queue, stop_token_sequences), request_id, model)
 
     def _stream_text(self, queue, request_id, model):
         self._stream_response()
+        out = _SSEBuffer(self.wfile, self.dist_state.token_delivery)
         try:
-            self.wfile.write(b": keepalive\n\n")
-            self.wfile.flush()
+            out.write(b": keepalive\n\n")
+            out.flush()
         except Exception:
             pass
 
+        def send_chunk(text: str, finish_reason: Optional[str]) -> None:
+            chunk = {
+                "id": request_id,
+                "object": "text_completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "text": text, "finish_reason": finish_reason}],
+            }
+            out.write(f"data: {json.dumps(chunk)}\n\n".encode())
+
         try:
+            text = ""
             while True:
                 try:
                     item = queue.get(timeout=10)
                 except Empty:
-                    self.wfile.write(b": keepalive\n\n")
-                    self.wfile.flush()
+                    out.write(b": keepalive\n\n")
+                    out.flush()
                     continue
 
                 if item is None:
                     break
+                if isinstance(item, PrefillProgress):
+                    out.write(self._progress_comment(item))
+                    out.flush()
+                    continue
 
-                chunk = {
-                    "id": request_id,
-                    "object": "text_completion",
-                    "created": int(time.time()),
-                    "model": model,
-                    "choices": [{"index": 0, "text": item.get("text", ""), "finish_reason": item.get("finish_reason")}],
-                }
-                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
-                self.wfile.flush()
-
-            self.wfile.write(b"data: [DONE]\n\n")
-            self.wfile.flush()
+                # One chunk per batch of tokens; a finish reason ends it early.
+                text += item.get("text", "")
+                finish_reason = item.get("finish_reason")
+                if queue.ready() and finish_reason is None:
+                    continue
+                send_chunk(text, finish_reason)
+                text = ""
+                if not queue.ready():
+                    out.flush()
+
+            if text:
+                send_chunk(text, None)
+            out.write(b"data: [DONE]\n\n")
+            out.flush()
         except (BrokenPipeError, ConnectionResetError):
             try:
                 self.dist_state.cancel_request(request_id)
@@ -774,8 +1180,8 @@ class DistributedHandler(BaseHTTPRequestHandler):
         prompt_toks = 0
         gen_toks = 0
 
-        blocking_timeout_s = float(os.environ.get("DISTRIBUTED_BLOCKING_TIMEOUT_S", "3600"))
-        blocking_poll_s = float(os.environ.get("DISTRIBUTED_BLOCKING_POLL_S", "1"))
+        blocking_timeout_s = self._blocking_timeout()
+        blocking_poll_s = min(blocking_timeout_s, float(os.environ.get("DISTRIBUTED_BLOCKING_POLL_S", "1")))
         start_t = time.perf_counter()
 
         while True:
@@ -802,6 +1208,9 @@ class DistributedHandler(BaseHTTPRequestHandler):
                 item = queue.get()
             if item is None:
                 break
+            if "status" in item:
+                self._shed_response(item)
+                return
             full_text += item.get("text", "")
             finish_reason = item.get("finish_reason")
             prompt_toks = item.get("prompt_tokens", 0)
@@ -826,28 +1235,29 @@ class DistributedHandler(BaseHTTPRequestHandler):
         max_tokens = self._parse_max_tokens(body)
         temperature, top_p, top_k, repetition_penalty, repetition_context_size = self._parse_sampling(body)
         seed, seed_is_user = self._parse_seed(body)
+        admission = self._parse_priority(body)
+        timeout = self._parse_timeout(body)
         stop_token_sequences = self._parse_stop_token_sequences(body.get("stop_sequences") or [])
         model = body.get("model", self.args.model)
 
         process_message_content(messages)
-        prompt = apply_chat_template_safe(
-            self.tokenizer,
-            messages,
-            tools=tools,
-            add_generation_prompt=True,
-            tokenize=False,
-        )
+        prompt, prompt_tokens, tools = self._render_chat_prompt(messages, tools)
         emit_initial_think = prompt.rstrip().endswith("<think>")
-        prompt_tokens = self.tokenizer.encode(prompt)
+        cache_breakpoints = cache_control_offsets(body, prompt_tokens, self._render_prefix)
+        if cache_breakpoints:
+            logging.info(f"cache_control breakpoints at {[offset for offset, _ in cache_breakpoints]}")
 
-        response_queue = Queue()
+        # The Anthropic stream is rendered once generation ends, so it never
+        # needs tokens sooner than a blocking request does.
+        response_queue = self._token_channel(stream=False)
         request_id = f"msg_{uuid.uuid4().hex[:24]}"
-        self.dist_state.request_queue.put({
+        self._enqueue({
             "request_id": request_id,
             "prompt_tokens": prompt_tokens,
             "max_tokens": max_tokens,
             "seed": seed,
             "seed_is_user": seed_is_user,
+            **admission,
             "temperature": temperature,
             "top_p": top_p,
             "top_k": top_k,
@@ -856,12 +1266,66 @@ class DistributedHandler(BaseHTTPRequestHandler):
             "stop_token_sequences": stop_token_sequences,
             "response_queue": response_queue,
             "tools": tools,
-        })
+            "cache_breakpoints": cache_breakpoints,
+        }, timeout)
 
         if stream:
-            self._stream_anthropic(response_queue, request_id, model, tools, emit_initial_think)
+            self._stream_anthropic(self._token_stream(response_queue, stop_token_sequences, progress=True), request_id, model, tools, emit_initial_think)
+        else:
+            self._blocking_anthropic(self._token_stream(response_queue, stop_token_sequences), request_id, model, tools, emit_initial_think)
+
+    def _render_prefix(self, messages: list[dict], tools: Any) -> List[int]:
+        messages, tools, _ = self._canonicalize(messages, tools)
+        return self.tokenizer.encode(self._render(messages, tools, add_generation_prompt=False))
+
+    def _render(self, messages: list[dict], tools: Any, *, add_generation_prompt: bool) -> str:
+        return apply_chat_template_safe(
+            self.tokenizer,
+            messages,
+            tools=tools,
+            add_generation_prompt=add_generation_prompt,
+            tokenize=False,
+            **self.template_args,
+        )
+
+    def _canonicalize(self, messages: list[dict], tools: Any):
+        if not getattr(self.args, "canonicalize_prompts", False):
+            return messages, tools, []
+        return canonicalize_request(messages, tools)
+
+    def _render_chat_prompt(self, messages: list[dict], tools: Any):
+        """Render a chat request, canonicalized when --canonicalize-prompts is set.
+
+        Returns (prompt text, prompt tokens, tools to use). When
+        canonicalization changed the prompt, remembers where the raw prompt
+        would have diverged so the response can report the prefill it saved.
+        """
+        canonical_messages, canonical_tools, changes = self._canonicalize(messages, tools)
+        prompt = self._render(canonical_messages, canonical_tools, add_generation_prompt=True)
+        token_cache = self.dist_state.prompt_token_cache
+        if token_cache is not None:
+            prompt_tokens = token_cache.encode(
+                prompt, canonical_messages, canonical_tools, getattr(self.args, "pin_template_vars", None)
+            )
         else:
-            self._blocking_anthropic(response_queue, request_id, model, tools, emit_initial_think)
+            prompt_tokens = self.tokenizer.encode(prompt)
+        if getattr(self.args, "canonicalize_prompts", False):
+            self.dist_state.canonical_stats.record(changes)
+        if changes:
+            raw_tokens = self.tokenizer.encode(self._render(messages, tools, add_generation_prompt=True))
+            self._canonical_prefix = common_prefix_len(raw_tokens, prompt_tokens)
+            self._canonical_changes = changes
+        return prompt, prompt_tokens, canonical_tools
+
+    def _note_cached_tokens(self, item: dict) -> None:
+        """Count prefill saved by canonicalization, once per request."""
+        if self._canonical_prefix is None or "cached_tokens" not in item:
+            return
+        saved = max(0, item["cached_tokens"] - self._canonical_prefix)
+        self._canonical_prefix = None
+        stats = self.dist_state.canonical_stats
+        stats.add_saved(saved)
+        log_canonicalization(self._canonical_changes, saved, stats)
 
     def _stream_anthropic(self, queue, request_id, model, tools, emit_initial_think: bool = False):
         self._stream_response()
@@ -876,6 +1340,8 @@ class DistributedHandler(BaseHTTPRequestHandler):
         finish_reason = None
         prompt_toks = 0
         gen_toks = 0
+        cached_toks = 0
+        created_toks = 0
 
         try:
             while True:
@@ -890,6 +1356,10 @@ class DistributedHandler(BaseHTTPRequestHandler):
                     continue
                 if item is None:
                     break
+                if isinstance(item, PrefillProgress):
+                    self.wfile.write(self._progress_comment(item))
+                    self.wfile.flush()
+                    continue
 
                 gen_text = item.get("text", "")
                 if has_tool_calling and gen_text == tool_call_start:
@@ -907,6 +1377,9 @@ class DistributedHandler(BaseHTTPRequestHandler):
                 finish_reason = item.get("finish_reason")
                 prompt_toks = item.get("prompt_tokens", prompt_toks)
                 gen_toks = item.get("generation_tokens", gen_toks)
+                self._note_cached_tokens(item)
+                cached_toks = item.get("cached_tokens", cached_toks)
+                created_toks = item.get("cache_creation_tokens", created_toks)
 
             self._send_anthropic_stream_events(
                 full_text,
@@ -918,6 +1391,8 @@ class DistributedHandler(BaseHTTPRequestHandler):
                 request_id,
                 model,
                 emit_initial_think,
+                cache_read_tokens=cached_toks,
+                cache_creation_tokens=created_toks,
             )
         except (BrokenPipeError, ConnectionResetError):
             try:
@@ -937,6 +1412,8 @@ class DistributedHandler(BaseHTTPRequestHandler):
         request_id: str,
         model: str,
         emit_initial_think: bool = False,
+        cache_read_tokens: int = 0,
+        cache_creation_tokens: int = 0,
     ):
         tool_parser = getattr(self.tokenizer, "tool_parser", None)
         tool_parser_type = infer_tool_parser_type(self.tokenizer)
@@ -965,10 +1442,11 @@ class DistributedHandler(BaseHTTPRequestHandler):
         if parsed_tool_calls:
             finish_reason = "tool_calls"
 
+        # The whole message goes out in one write.
+        out = _SSEBuffer(self.wfile, self.dist_state.token_delivery)
+
         def write_event(event: str, payload: dict) -> None:
-            self.wfile.write(
-                f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8")
-            )
+            out.write(f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8"))
 
         write_event(
             "message_start",
@@ -982,7 +1460,7 @@ class DistributedHandler(BaseHTTPRequestHandler):
                     "content": [],
                     "stop_reason": None,
                     "stop_sequence": None,
-                    "usage": {"input_tokens": input_tokens, "output_tokens": 0},
+                    "usage": anthropic_usage(input_tokens, 0, cache_read_tokens, cache_creation_tokens),
                 },
             },
         )
@@ -1063,8 +1541,8 @@ class DistributedHandler(BaseHTTPRequestHandler):
             },
         )
 
-        self.wfile.write(f"event: message_stop\ndata: {json.dumps({'type': 'message_stop'})}\n\n".encode())
-        self.wfile.flush()
+        out.write(f"event: message_stop\ndata: {json.dumps({'type': 'message_stop'})}\n\n".encode())
+        out.flush()
 
     def _blocking_anthropic(self, queue, request_id, model, tools, emit_initial_think: bool = False):
         full_text = ""
@@ -1077,6 +1555,8 @@ class DistributedHandler(BaseHTTPRequestHandler):
         finish_reason = None
         prompt_toks = 0
         gen_toks = 0
+        cached_toks = 0
+        created_toks = 0
         tool_parser_type = infer_tool_parser_type(self.tokenizer)
         tool_fix_ctx = ToolFixContext(
             tool_parser_type=tool_parser_type,
@@ -1090,6 +1570,9 @@ class DistributedHandler(BaseHTTPRequestHandler):
                 break
             if item is None:
                 break
+            if "status" in item:
+                self._shed_response(item)
+                return
             gen_text = item.get("text", "")
             if has_tool_calling and gen_text == tool_call_start:
                 in_tool_call = True
@@ -1105,6 +1588,9 @@ class DistributedHandler(BaseHTTPRequestHandler):
             finish_reason = item.get("finish_reason")
             prompt_toks = item.get("prompt_tokens", 0)
             gen_toks = item.get("generation_tokens", 0)
+            self._note_cached_tokens(item)
+            cached_toks = item.get("cached_tokens", 0)
+            created_toks = item.get("cache_creation_tokens", 0)
 
         clean_text = full_text
         if emit_initial_think and not clean_text.lstrip().startswith("<think>"):
@@ -1147,7 +1633,7 @@ class DistributedHandler(BaseHTTPRequestHandler):
             "model": model,
             "content": content,
             "stop_reason": stop_reason,
-            "usage": {"input_tokens": prompt_toks, "output_tokens": gen_toks},
+            "usage": anthropic_usage(prompt_toks, gen_toks, cached_toks, created_toks),
         }
         self._json_response(200, response)
 
@@ -1156,8 +1642,21 @@ class DistributedHandler(BaseHTTPRequestHandler):
 
 def run_http_server(dist_state, tokenizer, args):
     """Run HTTP server (rank 0 only)."""
+    pool = make_tokenizer_pool(tokenizer, int(getattr(args, "tokenizer_workers", 0) or 0))
+    if pool is not None:
+        dist_state.tokenizer_pool = pool
+        tokenizer = pool
+    dist_state.request_queue.configure(
+        getattr(args, "priority_classes", None) or DEFAULT_PRIORITY_CLASSES,
+        float(getattr(args, "priority_max_wait_s", DEFAULT_MAX_WAIT)),
+    )
+    token_cache_size = int(getattr(args, "prompt_token_cache_size", 32) or 0)
+    if token_cache_size > 0:
+        dist_state.prompt_token_cache = PromptTokenCache(tokenizer, max_entries=token_cache_size)
+    template_args = pinned_template_vars(getattr(args, "pin_template_vars", None))
+
     def factory(*a, **kw):
-        return DistributedHandler(dist_state, tokenizer, args, *a, **kw)
+        return DistributedHandler(dist_state, tokenizer, args, *a, template_args=template_args, **kw)
 
     server_address = (args.host, args.port)
     infos = socket.getaddrinfo(
@@ -40,7 +40,9 @@ https://ml-explore.github.io/mlx/build/html/usage/distributed.html
 """
 
 import argparse
+import json
 import logging
+import signal
 import warnings
 from threading import Thread
 from typing import List, Optional
@@ -94,6 +96,12 @@ def _run(args: argparse.Namespace) -> None:
     maybe_patch_tool_parser(tokenizer)
 
     dist_state = DistributedState(group)
+    context_length = getattr(getattr(model, "args", None), "max_position_embeddings", None)
+    if isinstance(context_length, int) and context_length > 0:
+        dist_state.context_length = context_length
+    # SIGTERM on any rank ends the generation loop on all ranks at the next
+    # control frame, so the prompt cache below gets flushed everywhere.
+    signal.signal(signal.SIGTERM, lambda signum, frame: dist_state.request_shutdown())
 
     if rank == 0:
         # Rank 0: HTTP server in background, generation loop in foreground
@@ -102,7 +110,12 @@ def _run(args: argparse.Namespace) -> None:
         warnings.warn("kooka-server serve-distributed: early development; contract enforced by pytest contract tests (tests/).")
 
     # All ranks run generation loop
-    generation_loop(dist_state, model, tokenizer, args)
+    try:
+        generation_loop(dist_state, model, tokenizer, args)
+    finally:
+        if dist_state.prompt_cache_store is not None:
+            logging.info("Flushing prompt cache")
+            dist_state.prompt_cache_store.close()
 
 
 def serve_distributed(args: argparse.Namespace) -> None:
@@ -127,6 +140,151 @@ def main(argv: Optional[List[str]] = None):
         default=2,
         help="Maximum number of prompt-cache entries to keep (LRU). Set to 0 to disable.",
     )
+    parser.add_argument(
+        "--prompt-cache-bytes",
+        type=int,
+        default=0,
+        help="Per-rank byte budget for prompt-cache KV arrays (0 disables). Enables cost-aware eviction.",
+    )
+    parser.add_argument(
+        "--prompt-cache-memory-fraction",
+        type=float,
+        default=0.0,
+        help="Per-rank prompt-cache budget as a fraction of device working-set memory (0 disables).",
+    )
+    parser.add_argument(
+        "--prompt-cache-dir",
+        type=str,
+        default="",
+        help="Directory for a persistent on-disk prompt-cache tier (evicted entries, and all entries at shutdown).",
+    )
+    parser.add_argument(
+        "--prompt-cache-disk-bytes",
+        type=int,
+        default=0,
+        help="Per-rank byte budget for the on-disk prompt-cache tier (0 = unlimited).",
+    )
+    parser.add_argument(
+        "--prompt-cache-checkpoint-turns",
+        type=int,
+        default=0,
+        help="Also snapshot non-trimmable caches at the last N assistant-turn starts in each prompt (prompt ends always are).",
+    )
+    parser.add_argument(
+        "--prompt-cache-turn-marker",
+        type=str,
+        default="",
+        help="Text that opens an assistant turn (default: derived from the chat template's generation prompt).",
+    )
+    parser.add_argument(
+        "--prompt-cache-checkpoint-interval",
+        type=int,
+        default=0,
+        help="Snapshot non-trimmable (recurrent) caches every N prompt tokens during prefill (0 disables).",
+    )
+    parser.add_argument(
+        "--prompt-cache-checkpoint-max",
+        type=int,
+        default=4,
+        help="Keep at most this many periodic snapshots per prompt (the ones closest to the prompt end).",
+    )
+    parser.add_argument(
+        "--prompt-cache-cold-after",
+        type=float,
+        default=0.0,
+        help="Quantize prompt-cache entries idle for this many seconds; dequantized on a hit (0 disables).",
+    )
+    parser.add_argument(
+        "--prompt-cache-cold-bits",
+        type=int,
+        default=8,
+        choices=[4, 8],
+        help="Bits for quantized (cold) prompt-cache entries.",
+    )
+    parser.add_argument(
+        "--prompt-cache-cold-group-size",
+        type=int,
+        default=64,
+        help="Quantization group size for cold prompt-cache entries.",
+    )
+    parser.add_argument(
+        "--prompt-cache-compact",
+        action="store_true",
+        help="Copy KV buffers down to their used length when inserting into the prompt cache (drops step slack).",
+    )
+    parser.add_argument(
+        "--canonicalize-prompts",
+        action="store_true",
+        help="Sort tools and tool-schema keys and normalize message whitespace before applying the chat template.",
+    )
+    parser.add_argument(
+        "--pin-template-vars",
+        type=json.loads,
+        default="{}",
+        help='JSON variables passed to the chat template on every request, e.g. \'{"date_string": "01 Jan 2026"}\'. '
+        'A "strftime_now" ISO date pins templates that format the current date.',
+    )
+    parser.add_argument(
+        "--prompt-token-cache-size",
+        type=int,
+        default=32,
+        help="Conversations whose tokenized prompt prefix is kept so the next turn only encodes its new tail (0 disables).",
+    )
+    parser.add_argument(
+        "--tokenizer-workers",
+        type=int,
+        default=0,
+        help="Processes for chat templating, prompt/stop encoding and decoding on rank 0 (0 = on the HTTP threads).",
+    )
+    parser.add_argument(
+        "--idle-poll-max-ms",
+        type=int,
+        default=100,
+        help="Longest gap between control frames while idle; rank 0 still sends one as soon as a request arrives.",
+    )
+    parser.add_argument(
+        "--stream-flush-tokens",
+        type=int,
+        default=4,
+        help="Wake a streaming response for every this many tokens (the first token is always sent at once).",
+    )
+    parser.add_argument(
+        "--stream-flush-ms",
+        type=float,
+        default=50.0,
+        help="Longest a generated token waits before a streaming response is woken to send it.",
+    )
+    parser.add_argument(
+        "--priority-classes",
+        type=json.loads,
+        default='{"interactive": 16, "batch": 1}',
+        help="JSON priority classes and their admission weights; the first is the default. Requests pick one "
+        "with an X-Priority header or a \"priority\" body field.",
+    )
+    parser.add_argument(
+        "--priority-api-keys",
+        type=json.loads,
+        default="{}",
+        help='JSON map of API key to priority class, e.g. \'{"sk-summarizer": "batch"}\'; overrides the request\'s own choice.',
+    )
+    parser.add_argument(
+        "--priority-max-wait-s",
+        type=float,
+        default=30.0,
+        help="A request queued longer than this is admitted next whatever its class (starvation guard).",
+    )
+    parser.add_argument(
+        "--max-queued-requests",
+        type=int,
+        default=0,
+        help="Answer new requests with 429 and a Retry-After once this many are queued (0 = unbounded).",
+    )
+    parser.add_argument(
+        "--max-context-tokens",
+        type=int,
+        default=0,
+        help="Reject prompts this long or longer before queueing them (0 = the model config's max_position_embeddings).",
+    )
 
     args = parser.parse_args(argv)
     _run(args)
@@ -1,147 +1,834 @@
 from __future__ import annotations
 
 import copy
-from collections import deque
+import hashlib
+import logging
+import time
+from array import array
+from collections import OrderedDict
 from dataclasses import dataclass
-from typing import Any, List
+from fractions import Fraction
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
-from mlx_lm.models.cache import can_trim_prompt_cache, trim_prompt_cache
+import mlx.core as mx
+from mlx.utils import tree_flatten
+from mlx_lm.models.cache import (
+    ArraysCache,
+    CacheList,
+    KVCache,
+    MambaCache,
+    QuantizedKVCache,
+    RotatingKVCache,
+    can_trim_prompt_cache,
+)
 
+# Edge labels are compared in slices of this many tokens (a C-level memcmp)
+# before falling back to a per-token scan to locate the first mismatch.
+_COMPARE_CHUNK = 256
 
-class LRUPromptCache:
-    """LRU cache for prompt prefixes to speed up generation."""
+_NO_ENTRY = float("inf")
 
-    @dataclass
-    class CacheEntry:
-        prompt_cache: List[Any]
-        count: int
+
+def _common_prefix_len(a: array, a_start: int, b: array, b_start: int, limit: int) -> int:
+    n = 0
+    while n < limit:
+        step = min(_COMPARE_CHUNK, limit - n)
+        if a[a_start + n : a_start + n + step] == b[b_start + n : b_start + n + step]:
+            n += step
+            continue
+        for i in range(step):
+            if a[a_start + n + i] != b[b_start + n + i]:
+                return n + i
+    return n
+
+
+_STEP_ALLOCATED = (KVCache, QuantizedKVCache, RotatingKVCache)
+
+
+def _layer_nbytes(c: Any) -> Tuple[int, int]:
+    """(allocated, used) bytes of one cache layer.
+
+    Step-allocated KV buffers hold up to `step - 1` unused slots past
+    `offset`; those count as allocated but not used.
+    """
+    try:
+        used = sum(int(getattr(arr, "nbytes", 0) or 0) for _, arr in tree_flatten(c.state))
+    except Exception:
+        return 0, 0
+    allocated = used
+    if type(c) in _STEP_ALLOCATED and c.keys is not None:
+        allocated = sum(int(arr.nbytes) for _, arr in tree_flatten((c.keys, c.values)))
+    return max(allocated, used), used
+
+
+def prompt_cache_nbytes(prompt_cache: Optional[List[Any]]) -> int:
+    """Total bytes allocated by a prompt cache (all layers on this rank)."""
+    return sum(_layer_nbytes(c)[0] for c in prompt_cache or [])
+
+
+def prompt_cache_slack_bytes(prompt_cache: Optional[List[Any]]) -> int:
+    """Allocated but unused bytes (KV step slack) in a prompt cache."""
+    return sum(a - u for a, u in (_layer_nbytes(c) for c in prompt_cache or []))
+
+
+def compact_prompt_cache(prompt_cache: List[Any]) -> List[Any]:
+    """Copy step-allocated layers down to their used length.
+
+    The copies are scheduled with `mx.async_eval`, so the caller does not wait
+    for them; the oversized buffers are released once the copies land and the
+    old layer objects are dropped.
+    """
+    compacted = []
+    arrays = []
+    for c in prompt_cache:
+        allocated, used = _layer_nbytes(c)
+        new = _share_layer(c, 0) if allocated > used else None
+        if new is None or new.keys is None or type(new) is not type(c):
+            compacted.append(c)
+            continue
+        if type(new) is QuantizedKVCache:
+            new.keys = [mx.contiguous(x) for x in new.keys]
+            new.values = [mx.contiguous(x) for x in new.values]
+            arrays.extend(new.keys + new.values)
+        else:
+            new.keys = mx.contiguous(new.keys)
+            new.values = mx.contiguous(new.values)
+            arrays.extend((new.keys, new.values))
+        compacted.append(new)
+    if arrays:
+        mx.async_eval(arrays)
+    return compacted
+
+
+def _share_layer(c: Any, num_to_trim: int) -> Any:
+    """Return a new cache object over `c`'s arrays, `num_to_trim` tokens shorter.
+
+    MLX arrays are values: a write to a buffer that is still referenced
+    elsewhere copies it first, so the stored entry is never mutated as long as
+    the caller gets distinct array objects. Slicing to the kept length means the
+    first write copies only the kept prefix, not the trimmed tail or the
+    preallocated step slack.
+    """
+    kind = type(c)
+    if kind is CacheList:
+        return CacheList(*(_share_layer(sub, num_to_trim) for sub in c.caches))
+
+    if kind in (KVCache, QuantizedKVCache) or (kind is RotatingKVCache and c.offset < c.max_size):
+        if kind is QuantizedKVCache:
+            new = QuantizedKVCache(group_size=c.group_size, bits=c.bits)
+        elif kind is RotatingKVCache:
+            new = RotatingKVCache(max_size=c.max_size, keep=c.keep)
+        else:
+            new = KVCache()
+        n = max(0, c.offset - num_to_trim)
+        if c.keys is None or n == 0:
+            return new
+        if kind is QuantizedKVCache:
+            new.keys = tuple(x[..., :n, :] for x in c.keys)
+            new.values = tuple(x[..., :n, :] for x in c.values)
+        else:
+            new.keys = c.keys[..., :n, :]
+            new.values = c.values[..., :n, :]
+        new.offset = n
+        if kind is RotatingKVCache:
+            # Not yet wrapped around, so the buffer is in temporal order.
+            new._idx = n
+        return new
+
+    if kind in (ArraysCache, MambaCache) and num_to_trim == 0:
+        # Recurrent layers replace list slots rather than writing in place.
+        new = copy.copy(c)
+        new.cache = list(c.cache)
+        return new
+
+    new = copy.deepcopy(c)
+    if num_to_trim:
+        new.trim(num_to_trim)
+    return new
+
+
+def share_prompt_cache(prompt_cache: List[Any], num_to_trim: int = 0) -> List[Any]:
+    """Copy-on-write view of a stored prompt cache, optionally trimmed."""
+    return [_share_layer(c, num_to_trim) for c in prompt_cache]
+
+
+def _freeze_layer(c: Any, group_size: int, bits: int) -> Optional[Any]:
+    """Group-wise quantized copy of a full-precision KV layer (None if not applicable)."""
+    if type(c) is not KVCache or c.keys is None:
+        return None
+    # Quantize only the live tokens, not the preallocated step slack.
+    return _share_layer(c, 0).to_quantized(group_size=group_size, bits=bits)
+
+
+def _thaw_layer(c: Any) -> Any:
+    new = KVCache()
+    if c.keys is not None:
+        new.keys = mx.dequantize(*c.keys, group_size=c.group_size, bits=c.bits)
+        new.values = mx.dequantize(*c.values, group_size=c.group_size, bits=c.bits)
+        new.offset = c.offset
+    return new
+
+
+def _eval_prompt_cache(prompt_cache: List[Any]) -> None:
+    arrays = []
+    for c in prompt_cache:
+        try:
+            arrays.extend(arr for _, arr in tree_flatten(c.state))
+        except Exception:
+            continue
+    mx.eval(arrays)
+
+
+class _Node:
+    """Radix-tree node; `label` holds the edge tokens leading into the node."""
+
+    __slots__ = ("label", "parent", "children", "depth", "entry", "shortest", "via")
+
+    def __init__(self, label: array, parent: Optional["_Node"], depth: int):
+        self.label = label
+        self.parent = parent
+        self.children: Dict[int, _Node] = {}
+        self.depth = depth
+        self.entry: Any = None
+        # Distance (in tokens) to the nearest cached descendant, and the child
+        # to follow to reach it (None when this node holds the entry itself).
+        self.shortest: float = _NO_ENTRY
+        self.via: Optional[_Node] = None
+
+
+class _RadixIndex:
+    """Compressed radix tree over token sequences, one tree per model.
+
+    Nodes carry an optional `entry`; every node also tracks its nearest
+    descendant holding one, so "longer" matches are found without a scan.
+    """
 
     @dataclass
     class SearchResult:
         model: Any
-        exact: List[int]
-        shorter: List[int]
-        longer: List[int]
+        exact: Optional[_Node]
+        shorter: Optional[_Node]
+        longer: Optional[_Node]
         common_prefix: int
 
-    def __init__(self, max_size: int = 2):
-        self.max_size = max_size
-        self._cache = {}
-        self._lru = deque()
+    def __init__(self):
+        self._roots: Dict[Any, _Node] = {}
 
-    def _search(self, model, tokens):
-        """Search the cache for a prompt cache. Return exact or close match."""
-        if model not in self._cache:
+    @staticmethod
+    def _node_tokens(node: _Node) -> List[int]:
+        labels = []
+        while node is not None:
+            labels.append(node.label)
+            node = node.parent
+        key = array("i")
+        for label in reversed(labels):
+            key.extend(label)
+        return key.tolist()
+
+    def _search(self, model, tokens, always_longer: bool = False):
+        """Search the cache for a prompt cache. Return exact or close match.
+
+        `longer` is only looked up without a `shorter` match, unless
+        `always_longer` is set.
+        """
+        root = self._roots.get(model)
+        if root is None:
             return self.SearchResult(model, None, None, None, 0)
 
-        current = self._cache[model]
-        last_cache_index = -1
+        key = array("i", tokens)
+        n = len(key)
+        node = root
+        last_cached = root if root.entry is not None else None
         index = 0
+        partial = None
 
-        while index < len(tokens) and tokens[index] in current:
-            current = current[tokens[index]]
-            if "cache" in current:
-                last_cache_index = index
-            index += 1
+        while index < n:
+            child = node.children.get(key[index])
+            if child is None:
+                break
+            label = child.label
+            m = len(label)
+            if index + m <= n and key[index : index + m] == label:
+                index += m
+                node = child
+                if child.entry is not None:
+                    last_cached = child
+                continue
+            matched = _common_prefix_len(label, 0, key, index, min(m, n - index))
+            index += matched
+            partial = (child, matched)
+            break
 
-        if last_cache_index == len(tokens) - 1:
-            return self.SearchResult(model, tokens, None, None, 0)
+        if last_cached is not None and last_cached.depth == n:
+            return self.SearchResult(model, last_cached, None, None, 0)
 
         shorter = None
-        if last_cache_index > 0:
-            shorter = tokens[: last_cache_index + 1]
+        if last_cached is not None and last_cached.depth > 1:
+            shorter = last_cached
 
         longer = None
         common_prefix = index
-        if index > 0 and last_cache_index <= 0:
-            best = None
-            stack = [(current, [])]
-            while stack:
-                current, extra = stack.pop()
-                if "cache" in current:
-                    if best is None or len(extra) < len(best):
-                        best = extra
-                else:
-                    for tok in current:
-                        stack.append((current[tok], extra + [tok]))
-            longer = tokens[:index] + best
+        if index > 0 and (shorter is None or always_longer):
+            longer = partial[0] if partial is not None else node
+            while longer.via is not None:
+                longer = longer.via
+            if longer.entry is None:
+                longer = None
         return self.SearchResult(model, None, shorter, longer, common_prefix)
 
-    def _get(self, model, tokens):
-        current = self._cache[model]
-        for tok in tokens:
-            current = current[tok]
-        return current["cache"]
-
-    def _delete(self, model, tokens):
-        path = [self._cache[model]]
-        for tok in tokens:
-            path.append(path[-1][tok])
-        del path[-1]["cache"]
-        for i in reversed(range(len(tokens))):
-            d_prev, d, t = path[i], path[i + 1], tokens[i]
-            if len(d) > 0:
+    def _refresh(self, node: Optional[_Node]) -> None:
+        """Recompute the shortest-descendant index from `node` up to the root."""
+        while node is not None:
+            if node.entry is not None:
+                shortest, via = 0, None
+            else:
+                shortest, via = _NO_ENTRY, None
+                for child in node.children.values():
+                    d = len(child.label) + child.shortest
+                    if d < shortest:
+                        shortest, via = d, child
+            if shortest == node.shortest and via is node.via:
                 break
-            del d_prev[t]
+            node.shortest, node.via = shortest, via
+            node = node.parent
+
+    def _insert_node(self, root: _Node, key: array) -> _Node:
+        node = root
+        index = 0
+        n = len(key)
+        while index < n:
+            child = node.children.get(key[index])
+            if child is None:
+                leaf = _Node(key[index:], node, n)
+                node.children[key[index]] = leaf
+                return leaf
+            label = child.label
+            m = len(label)
+            matched = _common_prefix_len(label, 0, key, index, min(m, n - index))
+            if matched == m:
+                node = child
+                index += m
+                continue
+
+            # Split the edge at the first mismatch.
+            mid = _Node(label[:matched], node, node.depth + matched)
+            child.label = label[matched:]
+            child.parent = mid
+            mid.children[child.label[0]] = child
+            mid.shortest = len(child.label) + child.shortest
+            mid.via = child
+            node.children[key[index]] = mid
+            if node.via is child:
+                node.via = mid
+            node = mid
+            index += matched
+        return node
+
+    def _delete(self, node: _Node) -> None:
+        node.entry = None
+        parent = node.parent
+        if parent is not None and not node.children:
+            del parent.children[node.label[0]]
+            node.parent = None
+            node = parent
+            parent = node.parent
+
+        # Re-compress entry-less pass-through nodes.
+        if parent is not None and node.entry is None and len(node.children) == 1:
+            (child,) = node.children.values()
+            child.label = node.label + child.label
+            child.parent = parent
+            parent.children[child.label[0]] = child
+            node.parent = None
+            node = parent
+        self._refresh(node)
+
+
+def prefix_id(model: Any, tokens: List[int]) -> str:
+    """Stable identifier for a pinned prefix (model + token ids)."""
+    h = hashlib.sha256(str(model).encode("utf-8"))
+    h.update(b"\0")
+    h.update(array("i", tokens).tobytes())
+    return h.hexdigest()[:16]
+
+
+class LRUPromptCache(_RadixIndex):
+    """LRU cache for prompt prefixes to speed up generation.
+
+    Prompts are indexed in a compressed radix tree per model. Entries are
+    addressed by node handles, so LRU bookkeeping is O(1) and lookups never
+    materialize token lists for cached keys.
+
+    With `max_bytes` set, eviction switches from plain LRU to a cost-aware
+    policy: the entry with the lowest `tokens / (1 + age)` goes first, where
+    age counts cache operations since the entry was last used. Recompute cost
+    is tokens x layers held on this rank, but the layer count is the same for
+    every entry on a rank, so the ordering only depends on token counts and the
+    operation clock, which all ranks share. Byte usage differs per rank
+    (different layer slices), so the number of entries to evict is agreed via
+    `sync_evictions` (max across ranks) to keep every rank's index identical.
 
-    def _extract(self, model, tokens):
-        cache_entry = self._get(model, tokens)
+    With `cold_after` set, entries idle for that many seconds are re-encoded
+    as group-wise quantized KV (`QuantizedKVCache`, as `--kv-bits` uses) the
+    next time the store makes room, and dequantized when they are hit. This
+    only changes per-rank byte usage, never the index.
+
+    Byte usage counts allocated buffers, including KV step slack (reported as
+    `slack_bytes`). With `compact` set, inserted entries are copied down to
+    their used length so that slack is released.
+
+    An optional `disk` tier (see `prompt_cache_disk.DiskPromptCache`) receives
+    evicted entries and is consulted when it can reuse more tokens than the
+    best in-memory match; `close()` spills whatever is still in memory.
+
+    Pinned entries (`insert_cache(..., pinned=True)` or `pin()`) live outside
+    the LRU: hits always share them, they are never evicted or quantized, and
+    they do not count toward `max_size`. Their bytes do count toward
+    `max_bytes`, so pinning shrinks the room left for ordinary entries.
+
+    Retained entries (`retain_until`, e.g. from Anthropic `cache_control`
+    breakpoints) are shared on a hit and evicted only after every other
+    entry, until `retention_clock` passes their deadline. The clock is set
+    by the caller from a value every rank agrees on, never read locally.
+
+    `trim_limit`, when set, is the longest entry (in tokens) every rank can
+    trim, agreed across ranks (see `can_trim`). Pipeline ranks hold different
+    layer slices, so checking each rank's own cache could pick different
+    matches on different ranks.
+    """
+
+    @dataclass
+    class CacheEntry:
+        prompt_cache: List[Any]
+        count: int
+        nbytes: int = 0
+        tokens: int = 0
+        last_used: int = 0
+        seq: int = 0
+        checkpoint: bool = False
+        touched: float = 0.0
+        cold: bool = False
+        cold_layers: Tuple[int, ...] = ()
+        cold_saved: int = 0
+        slack: int = 0
+        pinned: bool = False
+        retain_until: float = 0.0
+
+    def __init__(
+        self,
+        max_size: int = 2,
+        max_bytes: Optional[int] = None,
+        sync_evictions: Optional[Callable[[int], int]] = None,
+        disk: Any = None,
+        cold_after: Optional[float] = None,
+        cold_bits: int = 8,
+        cold_group_size: int = 64,
+        compact: bool = False,
+        trim_limit: Optional[int] = None,
+    ):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.sync_evictions = sync_evictions
+        self.disk = disk
+        self.cold_after = cold_after
+        self.cold_bits = cold_bits
+        self.cold_group_size = cold_group_size
+        self.compact = compact
+        self.trim_limit = trim_limit
+        self.slack_bytes = 0
+        self.cold_saved_bytes = 0
+        self.thaws = 0
+        self.thaw_seconds = 0.0
+        self.nbytes = 0
+        self.checkpoint_bytes = 0
+        self.evictions = 0
+        super().__init__()
+        self._lru: "OrderedDict[_Node, Any]" = OrderedDict()
+        self._pinned: Dict[str, Tuple[Any, _Node]] = {}
+        self.pinned_bytes = 0
+        self.retention_clock = 0.0
+        self._clock = 0
+        self._seq = 0
+
+    def __len__(self) -> int:
+        return len(self._lru)
+
+    def can_trim(self, prompt_cache: List[Any], tokens: int) -> bool:
+        """Whether `prompt_cache`, holding `tokens` tokens, can be trimmed.
+
+        With `trim_limit` set the answer only depends on `tokens`, so every
+        rank gives the same one.
+        """
+        if self.trim_limit is not None:
+            return tokens < self.trim_limit
+        return can_trim_prompt_cache(prompt_cache)
+
+    def stats(self) -> Dict[str, Any]:
+        stats = {
+            "entries": len(self._lru),
+            "max_entries": self.max_size,
+            "bytes": self.nbytes,
+            "max_bytes": self.max_bytes,
+            "evictions": self.evictions,
+            "checkpoints": sum(1 for node in self._lru if node.entry.checkpoint),
+            "checkpoint_bytes": self.checkpoint_bytes,
+            "slack_bytes": self.slack_bytes,
+            "pinned": {"entries": len(self._pinned), "bytes": self.pinned_bytes},
+            "retained": sum(1 for node in self._lru if self._retained(node.entry)),
+        }
+        if self.cold_after is not None:
+            stats["cold"] = {
+                "entries": sum(1 for node in self._lru if node.entry.cold_layers),
+                "bits": self.cold_bits,
+                "saved_bytes": self.cold_saved_bytes,
+                "thaws": self.thaws,
+                "thaw_ms_avg": 1e3 * self.thaw_seconds / self.thaws if self.thaws else 0.0,
+            }
+        if self.disk is not None:
+            stats["disk"] = self.disk.stats()
+        return stats
+
+    def _tick(self) -> int:
+        self._clock += 1
+        return self._clock
+
+    def _remove(self, node: _Node) -> None:
+        if not node.entry.pinned:
+            del self._lru[node]
+        self._account(node.entry, -node.entry.nbytes)
+        self.cold_saved_bytes -= node.entry.cold_saved
+        self.slack_bytes -= node.entry.slack
+        self._delete(node)
+
+    def _account(self, entry: "LRUPromptCache.CacheEntry", delta: int) -> None:
+        self.nbytes += delta
+        if entry.pinned:
+            self.pinned_bytes += delta
+        if entry.checkpoint:
+            self.checkpoint_bytes += delta
+
+    def _resize(self, entry: "LRUPromptCache.CacheEntry", prompt_cache: List[Any]) -> None:
+        _eval_prompt_cache(prompt_cache)
+        entry.prompt_cache = prompt_cache
+        nbytes = prompt_cache_nbytes(prompt_cache)
+        self._account(entry, nbytes - entry.nbytes)
+        entry.nbytes = nbytes
+        slack = prompt_cache_slack_bytes(prompt_cache)
+        self.slack_bytes += slack - entry.slack
+        entry.slack = slack
+
+    def _freeze_idle(self) -> None:
+        now = time.monotonic()
+        for node in self._lru:
+            entry = node.entry
+            if entry.cold or now - entry.touched < self.cold_after:
+                continue
+            entry.cold = True
+            prompt_cache = list(entry.prompt_cache)
+            layers = []
+            for i, c in enumerate(prompt_cache):
+                try:
+                    frozen = _freeze_layer(c, self.cold_group_size, self.cold_bits)
+                except Exception:
+                    logging.debug("Failed to quantize prompt cache layer %d", i, exc_info=True)
+                    frozen = None
+                if frozen is not None:
+                    prompt_cache[i] = frozen
+                    layers.append(i)
+            if not layers:
+                continue
+            before = entry.nbytes
+            self._resize(entry, prompt_cache)
+            entry.cold_layers = tuple(layers)
+            entry.cold_saved = before - entry.nbytes
+            self.cold_saved_bytes += entry.cold_saved
+
+    def _touch(self, entry: "LRUPromptCache.CacheEntry") -> None:
+        entry.touched = time.monotonic()
+        if not entry.cold:
+            return
+        entry.cold = False
+        if not entry.cold_layers:
+            return
+        t0 = time.perf_counter()
+        prompt_cache = list(entry.prompt_cache)
+        for i in entry.cold_layers:
+            prompt_cache[i] = _thaw_layer(prompt_cache[i])
+        self._resize(entry, prompt_cache)
+        self.thaw_seconds += time.perf_counter() - t0
+        self.thaws += 1
+        self.cold_saved_bytes -= entry.cold_saved
+        entry.cold_layers = ()
+        entry.cold_saved = 0
+
+    def _retained(self, entry: "LRUPromptCache.CacheEntry") -> bool:
+        return entry.retain_until > self.retention_clock
+
+    def _evict(self, node: _Node) -> None:
+        if self.disk is not None:
+            self.disk.put(self._lru[node], self._node_tokens(node), node.entry.prompt_cache)
+        self._remove(node)
+        self.evictions += 1
+
+    def _reuse_len(self, result: "_RadixIndex.SearchResult", tokens: List[int]) -> int:
+        if result.exact is not None:
+            return len(tokens)
+        return max(self._shorter_len(result), self._longer_len(result, tokens))
+
+    @staticmethod
+    def _shorter_len(result: "_RadixIndex.SearchResult") -> int:
+        return result.shorter.depth if result.shorter is not None else 0
+
+    def _longer_len(self, result: "_RadixIndex.SearchResult", tokens: List[int]) -> int:
+        """Tokens reused by trimming the `longer` match back to the divergence point."""
+        longer = result.longer
+        if longer is None or not self.can_trim(longer.entry.prompt_cache, longer.depth):
+            return 0
+        return min(len(tokens) - 1, result.common_prefix)
+
+    def _extract(self, node: _Node):
+        cache_entry = node.entry
+        self._touch(cache_entry)
+        if cache_entry.pinned or self._retained(cache_entry):
+            cache_entry.last_used = self._clock
+            return self.CacheEntry(share_prompt_cache(cache_entry.prompt_cache), 1)
         if cache_entry.count == 1:
-            self._delete(model, tokens)
-            self._lru.remove((model, tokens))
+            self._remove(node)
             return cache_entry
 
         cache_entry.count -= 1
-        return self.CacheEntry(
-            copy.deepcopy(cache_entry.prompt_cache),
-            1,
-        )
+        cache_entry.last_used = self._clock
+        return self.CacheEntry(share_prompt_cache(cache_entry.prompt_cache), 1)
 
     def fetch_nearest_cache(self, model, tokens):
-        result = self._search(model, tokens)
+        if not tokens:
+            return None, tokens
+
+        self._tick()
+        # A pinned or retained prefix entry is always the deepest `shorter`
+        # match, so also look past it: trimming a longer entry back to where
+        # the prompts diverge can reuse far more.
+        result = self._search(model, tokens, always_longer=True)
+        if self.disk is not None:
+            hit = self.disk.fetch_nearest_cache(model, tokens, min_reuse=self._reuse_len(result, tokens))
+            if hit is not None:
+                return hit
+
         if result.exact is not None:
-            cache_entry = self._extract(result.model, result.exact)
+            cache_entry = self._extract(result.exact)
             return cache_entry.prompt_cache, []
 
+        prefix = self._longer_len(result, tokens)
+        if prefix > self._shorter_len(result):
+            cache_entry = result.longer.entry
+            self._touch(cache_entry)
+            cache_entry.last_used = self._clock
+            num_to_trim = result.longer.depth - prefix
+            return share_prompt_cache(cache_entry.prompt_cache, num_to_trim), tokens[prefix:]
+
         if result.shorter is not None:
-            cache_entry = self._extract(result.model, result.shorter)
-            prefix_len = len(result.shorter)
+            prefix_len = result.shorter.depth
+            cache_entry = self._extract(result.shorter)
             return cache_entry.prompt_cache, tokens[prefix_len:]
 
-        if result.longer is not None:
-            cache_entry = self._get(result.model, result.longer)
-            if can_trim_prompt_cache(cache_entry.prompt_cache):
-                cache_entry = self.CacheEntry(
-                    copy.deepcopy(cache_entry.prompt_cache),
-                    1,
-                )
-                prefix = min(len(tokens) - 1, result.common_prefix)
-                num_to_trim = len(result.longer) - prefix
-                trim_prompt_cache(cache_entry.prompt_cache, num_to_trim)
-                return cache_entry.prompt_cache, tokens[prefix:]
-
         return None, tokens
 
-    def insert_cache(self, model, tokens, prompt_cache):
-        if model not in self._cache:
-            self._cache[model] = {}
-        current = self._cache[model]
-        for tok in tokens:
-            if tok not in current:
-                current[tok] = {}
-            current = current[tok]
-
-        if "cache" in current:
-            current["cache"].count += 1
-            self._lru.remove((model, tokens))
+    def peek(self, model: Any, tokens: List[int]) -> Tuple[Optional[List[Any]], int]:
+        """Share the entry covering the longest prefix of `tokens`, leaving it in place.
+
+        Returns (prompt_cache, covered token count) or (None, 0). Used to
+        export entries, so the whole of `tokens` may be covered.
+        """
+        if not tokens:
+            return None, 0
+        result = self._search(model, tokens, always_longer=True)
+        node = result.exact
+        if node is None:
+            node = result.shorter
+            longer = result.longer
+            if (
+                longer is not None
+                and result.common_prefix > (node.depth if node is not None else 0)
+                and self.can_trim(longer.entry.prompt_cache, longer.depth)
+            ):
+                prefix = result.common_prefix
+                self._touch(longer.entry)
+                return share_prompt_cache(longer.entry.prompt_cache, longer.depth - prefix), prefix
+        if node is None:
+            return None, 0
+        self._touch(node.entry)
+        return share_prompt_cache(node.entry.prompt_cache), node.depth
+
+    def insert_cache(
+        self,
+        model,
+        tokens,
+        prompt_cache,
+        checkpoint: bool = False,
+        pinned: bool = False,
+        retain_until: float = 0.0,
+    ):
+        """Insert a prompt cache.
+
+        `checkpoint` marks mid-prefill snapshots (reported in stats); `pinned`
+        keeps the entry until `unpin()`; `retain_until` protects it until the
+        retention clock reaches that value.
+        """
+        clock = self._tick()
+        root = self._roots.get(model)
+        if root is None:
+            root = self._roots[model] = _Node(array("i"), None, 0)
+        node = self._insert_node(root, array("i", tokens))
+
+        if node.entry is not None and node.entry.pinned:
+            node.entry.last_used = clock
+        elif node.entry is not None:
+            node.entry.count += 1
+            node.entry.last_used = clock
+            node.entry.touched = time.monotonic()
+            self._lru.move_to_end(node)
         else:
-            current["cache"] = self.CacheEntry(prompt_cache, 1)
+            self._seq += 1
+            if self.compact:
+                prompt_cache = compact_prompt_cache(prompt_cache)
+            node.entry = self.CacheEntry(
+                prompt_cache,
+                1,
+                nbytes=prompt_cache_nbytes(prompt_cache),
+                tokens=node.depth,
+                last_used=clock,
+                seq=self._seq,
+                checkpoint=checkpoint,
+                touched=time.monotonic(),
+                slack=prompt_cache_slack_bytes(prompt_cache),
+            )
+            self._account(node.entry, node.entry.nbytes)
+            self.slack_bytes += node.entry.slack
+            self._lru[node] = model
+            self._refresh(node)
+        node.entry.retain_until = max(node.entry.retain_until, retain_until)
+
+        if pinned:
+            self._pin_node(model, tokens, node)
+
+        if self.cold_after is not None:
+            self._freeze_idle()
+
+        if self.max_bytes is None:
+            while len(self._lru) > self.max_size:
+                victim = next((n for n in self._lru if not self._retained(n.entry)), None)
+                self._evict(victim if victim is not None else next(iter(self._lru)))
+            return
+
+        self._evict_to_budget()
+
+    def _pin_node(self, model: Any, tokens: List[int], node: _Node) -> str:
+        key = prefix_id(model, tokens)
+        entry = node.entry
+        if not entry.pinned:
+            self._touch(entry)
+            del self._lru[node]
+            entry.pinned = True
+            self.pinned_bytes += entry.nbytes
+            self._pinned[key] = (model, node)
+        return key
+
+    def pin(self, model: Any, tokens: List[int]) -> Optional[str]:
+        """Pin an existing exact entry; returns its prefix id, or None if absent."""
+        result = self._search(model, tokens)
+        if result.exact is None:
+            return None
+        self._tick()
+        return self._pin_node(model, tokens, result.exact)
+
+    def unpin(self, model: Any, tokens: List[int]) -> bool:
+        """Drop a pinned entry from the cache; returns False if it was not pinned."""
+        item = self._pinned.pop(prefix_id(model, tokens), None)
+        if item is None:
+            return False
+        self._tick()
+        self._remove(item[1])
+        return True
+
+    def retain(self, model: Any, tokens: List[int], until: float) -> bool:
+        """Extend the retention deadline of an existing exact entry."""
+        node = self._search(model, tokens).exact
+        if node is None:
+            return False
+        node.entry.retain_until = max(node.entry.retain_until, until)
+        return True
+
+    def pinned_prefixes(self) -> List[Dict[str, Any]]:
+        """Describe pinned entries: id, model, token count, bytes."""
+        return [
+            {"id": key, "model": model, "tokens": node.entry.tokens, "bytes": node.entry.nbytes}
+            for key, (model, node) in list(self._pinned.items())
+        ]
+
+    def pinned_tokens(self, key: str) -> Optional[Tuple[Any, List[int]]]:
+        item = self._pinned.get(key)
+        if item is None:
+            return None
+        model, node = item
+        return model, self._node_tokens(node)
+
+    def _eviction_order(self) -> List[_Node]:
+        clock = self._clock
+
+        def score(node: _Node):
+            entry = node.entry
+            return (
+                self._retained(entry),
+                Fraction(entry.tokens, 1 + clock - entry.last_used),
+                entry.last_used,
+                entry.seq,
+            )
+
+        return sorted(self._lru, key=score)
+
+    def _evict_to_budget(self) -> None:
+        over_entries = len(self._lru) - self.max_size
+        if over_entries <= 0 and self.nbytes <= self.max_bytes and self.sync_evictions is None:
+            return
+
+        order = self._eviction_order()
+        count = max(0, over_entries)
+        remaining = self.nbytes - sum(node.entry.nbytes for node in order[:count])
+        while count < len(order) and remaining > self.max_bytes:
+            remaining -= order[count].entry.nbytes
+            count += 1
+
+        if self.sync_evictions is not None:
+            count = min(len(order), int(self.sync_evictions(count)))
+
+        for node in order[:count]:
+            logging.debug(
+                "Evicting prompt cache entry: tokens=%d bytes=%d",
+                node.entry.tokens,
+                node.entry.nbytes,
+            )
+            self._evict(node)
 
-        self._lru.append((model, tokens))
-        if len(self._lru) > self.max_size:
-            model, tokens = self._lru.popleft()
-            self._delete(model, tokens)
+    def close(self) -> None:
+        """Spill in-memory entries to the disk tier and flush it.
 
+        Runs at shutdown when other ranks may already be gone, so the disk tier
+        stops synchronizing; a mismatch is caught when the index is reloaded.
+        """
+        if self.disk is None:
+            return
+        self.disk.sync_max = None
+        nodes = list(self._lru.items()) + [(node, model) for model, node in self._pinned.values()]
+        for node, model in nodes:
+            self.disk.put(model, self._node_tokens(node), node.entry.prompt_cache)
+        self.disk.close()
 
-__all__ = ["LRUPromptCache"]
 
+__all__ = [
+    "LRUPromptCache",
+    "compact_prompt_cache",
+    "prefix_id",
+    "prompt_cache_nbytes",
+    "prompt_cache_slack_bytes",
+    "share_prompt_cache",
+]
@@ -0,0 +1,363 @@
+"""Persistent on-disk tier behind the in-memory prompt cache.
+
+Entries evicted from memory (and everything left in memory at shutdown) are
+written as safetensors files, one per entry, under a directory that encodes
+the model and this rank's layer slice. Files are keyed by a hash of the
+token prefix; the tokens themselves live in a raw int32 sidecar so the
+radix index can be rebuilt at startup without touching the KV payload.
+
+Writes and deletions run on a background thread in submission order. An
+entry whose write has not landed yet is served straight from the arrays
+queued for writing.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import queue
+import re
+import threading
+from array import array
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import mlx.core as mx
+from mlx.utils import tree_flatten, tree_unflatten
+from mlx_lm.models import cache as cache_module
+from mlx_lm.models.cache import KVCache, QuantizedKVCache, can_trim_prompt_cache
+
+from .prompt_cache import _Node, _RadixIndex, _thaw_layer, share_prompt_cache
+
+_INDEX_FILE = "index.json"
+_INDEX_VERSION = 1
+
+
+def cache_identity(model_key: str, rank: int, world_size: int, layers: Tuple[int, int]) -> str:
+    """Directory name for one rank's entries: model, rank and layer slice."""
+    slug = re.sub(r"[^A-Za-z0-9._-]+", "_", model_key).strip("_")[-64:] or "model"
+    digest = hashlib.sha256(model_key.encode("utf-8")).hexdigest()[:12]
+    start, end = layers
+    return f"{slug}-{digest}/rank{rank}of{world_size}-layers{start}-{end}"
+
+
+def _entry_key(model: Any, tokens: array) -> str:
+    h = hashlib.sha256(str(model).encode("utf-8"))
+    h.update(b"\0")
+    h.update(tokens.tobytes())
+    return h.hexdigest()[:32]
+
+
+def _layer_is_empty(c: Any) -> bool:
+    try:
+        return bool(c.empty())
+    except Exception:
+        return False
+
+
+def _serialize(prompt_cache: List[Any]) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+    states = {}
+    layers = []
+    for i, c in enumerate(prompt_cache):
+        if _layer_is_empty(c):
+            continue
+        states[f"layer{i}"] = c.state
+        layers.append({"index": i, "class": type(c).__name__, "meta": c.meta_state})
+    arrays = dict(tree_flatten(states))
+    return arrays, layers
+
+
+def _deserialize(states: Dict[str, Any], layers: List[Dict[str, Any]], template: List[Any]) -> List[Any]:
+    """Rebuild a prompt cache from `_serialize` output over an empty `template`."""
+    prompt_cache = list(template)
+    for layer in layers:
+        i = layer["index"]
+        cls = getattr(cache_module, layer["class"])
+        expected = type(template[i])
+        if cls is not expected and not (cls is QuantizedKVCache and expected is KVCache):
+            raise ValueError(f"layer {i} is {expected.__name__}, file has {cls.__name__}")
+        prompt_cache[i] = cls.from_state(states[f"layer{i}"], layer["meta"])
+    return _thaw_cold_layers(prompt_cache, template)
+
+
+def _thaw_cold_layers(prompt_cache: List[Any], template: List[Any]) -> List[Any]:
+    """Dequantize layers written while cold (quantized where the model uses KVCache)."""
+    return [
+        _thaw_layer(c) if type(c) is QuantizedKVCache and type(t) is KVCache else c
+        for c, t in zip(prompt_cache, template)
+    ]
+
+
+@dataclass
+class DiskEntry:
+    key: str
+    model: Any
+    tokens: int
+    nbytes: int
+    # Arrays queued for writing; cleared by the writer once the file lands.
+    pending: Optional[List[Any]] = None
+    failed: bool = False
+
+
+class DiskPromptCache(_RadixIndex):
+    """Prompt-cache entries persisted as safetensors, indexed by token prefix.
+
+    `make_cache` builds an empty prompt cache for this rank; loaded layers
+    replace its non-empty slots, so layers owned by other pipeline ranks stay
+    empty. With `sync_max` set, ranks agree on the reloaded index, on eviction
+    counts and on load failures, keeping every rank's index identical.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        identity: str,
+        make_cache: Callable[[], List[Any]],
+        max_bytes: Optional[int] = None,
+        sync_max: Optional[Callable[[int], int]] = None,
+    ):
+        super().__init__()
+        self.path = Path(directory) / identity
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.make_cache = make_cache
+        self.max_bytes = max_bytes
+        self.sync_max = sync_max
+        self.nbytes = 0
+        self.hits = 0
+        self.writes = 0
+        self.write_errors = 0
+        self.evictions = 0
+        self._lru: "OrderedDict[_Node, DiskEntry]" = OrderedDict()
+        self._jobs: "queue.Queue[Optional[tuple]]" = queue.Queue()
+        self._failed_keys: set = set()
+
+        self._load_index()
+        self._agree_on_index()
+        self._writer = threading.Thread(target=self._write_loop, name="prompt-cache-disk", daemon=True)
+        self._writer.start()
+
+    def __len__(self) -> int:
+        return len(self._lru)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._lru),
+            "bytes": self.nbytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "writes": self.writes,
+            "write_errors": self.write_errors,
+            "evictions": self.evictions,
+            "queued_jobs": self._jobs.qsize(),
+        }
+
+    def _file(self, key: str, suffix: str) -> Path:
+        return self.path / f"{key}{suffix}"
+
+    def _load_index(self) -> None:
+        index_path = self.path / _INDEX_FILE
+        listed = []
+        if index_path.exists():
+            try:
+                index = json.loads(index_path.read_text())
+                if index.get("version") == _INDEX_VERSION:
+                    listed = index.get("entries", [])
+            except (OSError, ValueError) as e:
+                logging.warning("Ignoring unreadable prompt-cache index %s: %s", index_path, e)
+
+        known = set()
+        for item in listed:
+            key = item["key"]
+            tokens_path = self._file(key, ".tokens")
+            if not self._file(key, ".safetensors").exists() or not tokens_path.exists():
+                continue
+            tokens = array("i")
+            tokens.frombytes(tokens_path.read_bytes())
+            if len(tokens) != item["tokens"] or _entry_key(item["model"], tokens) != key:
+                continue
+            self._add(DiskEntry(key, item["model"], len(tokens), int(item["nbytes"])), tokens)
+            known.add(key)
+
+        # Drop files from interrupted writes or entries no longer indexed.
+        for path in self.path.iterdir():
+            if path.name != _INDEX_FILE and path.name.split(".", 1)[0] not in known:
+                path.unlink(missing_ok=True)
+        if self._lru:
+            logging.info("Prompt cache disk tier: %d entries (%.2f GiB) from %s", len(self._lru), self.nbytes / 2**30, self.path)
+
+    def _agree_on_index(self) -> None:
+        if self.sync_max is None:
+            return
+        keys = sorted(entry.key for entry in self._lru.values())
+        digest = int(hashlib.sha256(",".join(keys).encode()).hexdigest()[:7], 16)
+        if self.sync_max(digest) == digest and -self.sync_max(-digest) == digest:
+            return
+        logging.warning("Prompt cache disk tier differs across ranks; discarding it")
+        for node in list(self._lru):
+            self._remove(node)
+        self._jobs.put(("index", []))
+
+    def _add(self, entry: DiskEntry, tokens: array) -> _Node:
+        root = self._roots.get(entry.model)
+        if root is None:
+            root = self._roots[entry.model] = _Node(array("i"), None, 0)
+        node = self._insert_node(root, tokens)
+        node.entry = entry
+        self._lru[node] = entry
+        self.nbytes += entry.nbytes
+        self._refresh(node)
+        return node
+
+    def _remove(self, node: _Node) -> None:
+        entry = self._lru.pop(node)
+        self.nbytes -= entry.nbytes
+        self._delete(node)
+        self._jobs.put(("delete", entry.key))
+
+    def _index_snapshot(self) -> List[Dict[str, Any]]:
+        return [
+            {"key": e.key, "model": e.model, "tokens": e.tokens, "nbytes": e.nbytes}
+            for e in self._lru.values()
+        ]
+
+    def put(self, model: Any, tokens: List[int], prompt_cache: List[Any]) -> None:
+        """Persist a prompt cache under `tokens` (a no-op if already stored)."""
+        if not tokens or not prompt_cache:
+            return
+        key_tokens = array("i", tokens)
+        root = self._roots.get(model)
+        if root is not None:
+            result = self._search(model, tokens)
+            if result.exact is not None and result.exact.entry.failed:
+                self._remove(result.exact)
+            elif result.exact is not None:
+                self._lru.move_to_end(result.exact)
+                self._jobs.put(("index", self._index_snapshot()))
+                return
+
+        arrays, layers = _serialize(prompt_cache)
+        # Materialize on this thread; the writer only copies finished buffers.
+        mx.eval(list(arrays.values()))
+        entry = DiskEntry(
+            key=_entry_key(model, key_tokens),
+            model=model,
+            tokens=len(key_tokens),
+            nbytes=sum(int(a.nbytes) for a in arrays.values()),
+            pending=prompt_cache,
+        )
+        self._add(entry, key_tokens)
+        self._jobs.put(("write", entry, arrays, {"layers": json.dumps(layers)}, key_tokens))
+        self._evict_to_budget()
+        self._jobs.put(("index", self._index_snapshot()))
+
+    def _evict_to_budget(self) -> None:
+        if self.max_bytes is None:
+            return
+        count = 0
+        remaining = self.nbytes
+        for entry in self._lru.values():
+            if remaining <= self.max_bytes:
+                break
+            remaining -= entry.nbytes
+            count += 1
+        if self.sync_max is not None:
+            count = min(len(self._lru), int(self.sync_max(count)))
+        for node in list(self._lru)[:count]:
+            self._remove(node)
+            self.evictions += 1
+
+    def _read(self, entry: DiskEntry) -> Optional[List[Any]]:
+        if entry.failed:
+            return None
+        template = self.make_cache()
+        pending = entry.pending
+        if pending is not None:
+            return _thaw_cold_layers(pending, template)
+        try:
+            arrays, metadata = mx.load(str(self._file(entry.key, ".safetensors")), return_metadata=True)
+            states = tree_unflatten(list(arrays.items()))
+            return _deserialize(states, json.loads(metadata["layers"]), template)
+        except Exception as e:
+            logging.warning("Failed to load prompt cache entry %s: %s", entry.key, e)
+            return None
+
+    def fetch_nearest_cache(self, model: Any, tokens: List[int], min_reuse: int = 0):
+        """Load the best on-disk match if it reuses more than `min_reuse` tokens.
+
+        Returns `(prompt_cache, remaining_tokens)` like the in-memory cache, or
+        None. Entries stay on disk; the request re-inserts its cache in memory.
+        """
+        if not self._lru or not tokens:
+            return None
+        result = self._search(model, tokens)
+        num_to_trim = 0
+        if result.exact is not None:
+            node, reuse = result.exact, len(tokens)
+        elif result.shorter is not None:
+            node, reuse = result.shorter, result.shorter.depth
+        elif result.longer is not None:
+            reuse = min(len(tokens) - 1, result.common_prefix)
+            node, num_to_trim = result.longer, result.longer.depth - reuse
+        else:
+            return None
+        if reuse <= min_reuse:
+            return None
+
+        prompt_cache = self._read(node.entry)
+        failed = prompt_cache is None or (num_to_trim > 0 and not can_trim_prompt_cache(prompt_cache))
+        if self.sync_max is not None:
+            failed = bool(self.sync_max(int(failed)))
+        if failed:
+            self._remove(node)
+            self._jobs.put(("index", self._index_snapshot()))
+            return None
+
+        self.hits += 1
+        self._lru.move_to_end(node)
+        return share_prompt_cache(prompt_cache, num_to_trim), tokens[reuse:]
+
+    def _write_loop(self) -> None:
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            kind = job[0]
+            try:
+                if kind == "write":
+                    self._write_entry(*job[1:])
+                elif kind == "delete":
+                    for suffix in (".safetensors", ".tokens"):
+                        self._file(job[1], suffix).unlink(missing_ok=True)
+                elif kind == "index":
+                    entries = [e for e in job[1] if e["key"] not in self._failed_keys]
+                    tmp = self.path / (_INDEX_FILE + ".tmp")
+                    tmp.write_text(json.dumps({"version": _INDEX_VERSION, "entries": entries}))
+                    os.replace(tmp, self.path / _INDEX_FILE)
+            except Exception as e:
+                logging.warning("Prompt cache disk job %s failed: %s", kind, e)
+
+    def _write_entry(self, entry: DiskEntry, arrays: Dict[str, Any], metadata: Dict[str, str], tokens: array) -> None:
+        try:
+            tmp = self.path / f"tmp-{entry.key}.safetensors"
+            mx.save_safetensors(str(tmp), arrays, metadata)
+            os.replace(tmp, self._file(entry.key, ".safetensors"))
+            self._file(entry.key, ".tokens").write_bytes(tokens.tobytes())
+            self.writes += 1
+        except Exception as e:
+            self._failed_keys.add(entry.key)
+            entry.failed = True
+            self.write_errors += 1
+            logging.warning("Failed to write prompt cache entry %s: %s", entry.key, e)
+        finally:
+            entry.pending = None
+
+    def close(self) -> None:
+        """Flush queued writes and the index, then stop the writer."""
+        self._jobs.put(None)
+        self._writer.join()
+
+
+__all__ = ["DiskPromptCache", "cache_identity"]
@@ -0,0 +1,244 @@
+"""Export and import of prompt-cache entries as one safetensors blob.
+
+A snapshot holds the KV state of a single prompt-cache entry for every rank:
+rank r's arrays are stored under `rank{r}.`, and the metadata carries the
+token key plus a manifest of each rank's cache identity (model, rank, world
+size, layer slice) and layer classes. Only an identically configured server
+can restore it; each rank checks its manifest entry before loading its shard.
+
+Shards move between ranks with the same all_sum broadcast the request path
+uses, so export/import must run on every rank at the same point of the
+generation loop.
+"""
+from __future__ import annotations
+
+import json
+import struct
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import mlx.core as mx
+from mlx.utils import tree_unflatten
+
+from .prompt_cache import LRUPromptCache
+from .prompt_cache_disk import _deserialize, _serialize
+
+SESSION_FORMAT = "kooka-kv-session"
+SESSION_VERSION = 1
+# safetensors header dtype codes -> mlx dtype names.
+_SAFETENSORS_DTYPES = {
+    "BOOL": "bool",
+    "U8": "uint8",
+    "I8": "int8",
+    "U16": "uint16",
+    "I16": "int16",
+    "U32": "uint32",
+    "I32": "int32",
+    "U64": "uint64",
+    "I64": "int64",
+    "F16": "float16",
+    "BF16": "bfloat16",
+    "F32": "float32",
+    "F64": "float64",
+}
+
+
+def _broadcast_json(dist_state: Any, obj: Any, src: int) -> Any:
+    """Send a JSON-serializable object from rank `src` to every rank."""
+    if dist_state.world_size == 1:
+        return obj
+    payload = json.dumps(obj).encode("utf-8") if dist_state.rank == src else b""
+    size = mx.array([len(payload)], dtype=mx.int32)
+    size = mx.distributed.all_sum(size, stream=mx.cpu)
+    mx.eval(size)
+    n = int(size[0].item())
+    if dist_state.rank == src:
+        buf = mx.array(list(payload), dtype=mx.uint8)
+    else:
+        buf = mx.zeros((n,), dtype=mx.uint8)
+    buf = mx.distributed.all_sum(buf, stream=mx.cpu)
+    mx.eval(buf)
+    return json.loads(bytes(buf.tolist()).decode("utf-8"))
+
+
+def _array_specs(arrays: Dict[str, mx.array]) -> List[Tuple[str, List[int], str]]:
+    return [(key, list(a.shape), str(a.dtype).rsplit(".", 1)[-1]) for key, a in arrays.items()]
+
+
+def _broadcast_arrays(
+    dist_state: Any,
+    arrays: Optional[Dict[str, mx.array]],
+    specs: List[Tuple[str, List[int], str]],
+    src: int,
+) -> Dict[str, mx.array]:
+    """Send `arrays` (described by `specs`) from rank `src` to every rank."""
+    if dist_state.world_size == 1:
+        return dict(arrays or {})
+    out = {}
+    for key, shape, dtype in specs:
+        x = arrays[key] if dist_state.rank == src else mx.zeros(shape, dtype=getattr(mx, dtype))
+        out[key] = mx.distributed.all_sum(x, stream=mx.cpu)
+        mx.eval(out[key])
+    return out
+
+
+def _check_manifest(manifest: Any, stored: Dict[str, Tuple[List[int], str]]) -> None:
+    """Raise ValueError unless every shard the manifest lists is stored as declared.
+
+    `stored` maps blob keys to (shape, dtype name). Rank 0 checks this before
+    the ranks start broadcasting shards, which assume the declared specs.
+    """
+    if not isinstance(manifest, list):
+        raise ValueError("snapshot manifest is not a list")
+    for r, entry in enumerate(manifest):
+        if not isinstance(entry, dict):
+            raise ValueError(f"snapshot manifest entry {r} is not an object")
+        missing = [field for field in ("identity", "cache_layers", "arrays") if field not in entry]
+        if missing:
+            raise ValueError(f"snapshot manifest entry {r} lacks {', '.join(missing)}")
+        if not isinstance(entry["arrays"], list):
+            raise ValueError(f"snapshot manifest entry {r} has no array list")
+        for spec in entry["arrays"]:
+            if not isinstance(spec, list) or len(spec) != 3:
+                raise ValueError(f"snapshot manifest entry {r} has a malformed array spec")
+            key, shape, dtype = spec
+            name = f"rank{r}.{key}"
+            if name not in stored:
+                raise ValueError(f"snapshot is missing array {name}")
+            if stored[name] != (list(shape), dtype):
+                raise ValueError(f"snapshot array {name} is {stored[name]}, manifest declares {(shape, dtype)}")
+
+
+def read_session_metadata(path: str) -> Dict[str, Any]:
+    """Parse and check a snapshot's metadata without loading its arrays."""
+    with open(path, "rb") as f:
+        (size,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(size))
+    metadata = header.get("__metadata__") or {}
+    if metadata.get("format") != SESSION_FORMAT:
+        raise ValueError("not a KV session snapshot")
+    if int(metadata.get("version", 0)) != SESSION_VERSION:
+        raise ValueError(f"unsupported snapshot version {metadata.get('version')}")
+    manifest = json.loads(metadata["manifest"])
+    stored = {
+        key: (list(info["shape"]), _SAFETENSORS_DTYPES.get(info["dtype"], info["dtype"]))
+        for key, info in header.items()
+        if key != "__metadata__"
+    }
+    _check_manifest(manifest, stored)
+    return {
+        "model": metadata.get("model"),
+        "world_size": int(metadata["world_size"]),
+        "tokens": json.loads(metadata["tokens"]),
+        "manifest": manifest,
+    }
+
+
+def export_session(
+    dist_state: Any,
+    store: LRUPromptCache,
+    model_key: str,
+    tokens: List[int],
+    identity: str,
+    layers: Tuple[int, int],
+    path: Optional[str],
+) -> int:
+    """Write the entry covering the longest prefix of `tokens` to `path` (rank 0).
+
+    All ranks must call. Returns the number of tokens exported (0 if nothing
+    is cached); the cache index is identical on every rank, so they agree.
+    """
+    prompt_cache, covered = store.peek(model_key, tokens)
+    if prompt_cache is None:
+        return 0
+
+    arrays, cache_layers = _serialize(prompt_cache)
+    mx.eval(list(arrays.values()))
+    entry = {
+        "rank": dist_state.rank,
+        "identity": identity,
+        "layers": list(layers),
+        "cache_layers": cache_layers,
+        "arrays": _array_specs(arrays),
+    }
+
+    blob: Dict[str, mx.array] = {}
+    manifest = []
+    for r in range(dist_state.world_size):
+        shard_entry = _broadcast_json(dist_state, entry if dist_state.rank == r else None, r)
+        shard = _broadcast_arrays(dist_state, arrays if dist_state.rank == r else None, shard_entry["arrays"], r)
+        if dist_state.rank == 0:
+            manifest.append(shard_entry)
+            blob.update({f"rank{r}.{key}": a for key, a in shard.items()})
+
+    if dist_state.rank == 0:
+        metadata = {
+            "format": SESSION_FORMAT,
+            "version": str(SESSION_VERSION),
+            "model": str(model_key),
+            "world_size": str(dist_state.world_size),
+            "tokens": json.dumps(tokens[:covered]),
+            "manifest": json.dumps(manifest),
+        }
+        mx.save_safetensors(path, blob, metadata)
+    return covered
+
+
+def import_session(
+    dist_state: Any,
+    store: LRUPromptCache,
+    model_key: str,
+    tokens: List[int],
+    identity: str,
+    make_cache: Callable[[], List[Any]],
+    sync_failed: Callable[[int], int],
+    path: Optional[str],
+) -> Optional[str]:
+    """Restore a snapshot read from `path` (rank 0) into `store` on every rank.
+
+    All ranks must call; `tokens` is the snapshot's key as broadcast with the
+    request. Returns None on success, else an error message (agreed across
+    ranks via `sync_failed`, so either every rank inserts or none does).
+    """
+    error = None
+    arrays: Dict[str, mx.array] = {}
+    manifest: List[Dict[str, Any]] = []
+    if dist_state.rank == 0:
+        try:
+            arrays, metadata = mx.load(path, return_metadata=True)
+            manifest = json.loads(metadata["manifest"])
+            _check_manifest(manifest, {key: (shape, dtype) for key, shape, dtype in _array_specs(arrays)})
+            if len(manifest) != dist_state.world_size:
+                raise ValueError(f"snapshot has {len(manifest)} ranks, server has {dist_state.world_size}")
+        except Exception as e:
+            error = str(e)
+    if sync_failed(int(error is not None)):
+        return error or "snapshot failed to load on rank 0"
+
+    own = None
+    for r in range(dist_state.world_size):
+        entry = _broadcast_json(dist_state, manifest[r] if dist_state.rank == 0 else None, 0)
+        shard = None
+        if dist_state.rank == 0:
+            prefix = f"rank{r}."
+            shard = {key: arrays[prefix + key] for key, _, _ in entry["arrays"]}
+        shard = _broadcast_arrays(dist_state, shard, entry["arrays"], 0)
+        if dist_state.rank == r:
+            own = entry, shard
+
+    prompt_cache = None
+    entry, shard = own
+    try:
+        if entry["identity"] != identity:
+            raise ValueError(f"snapshot shard is for {entry['identity']}, this rank is {identity}")
+        states = tree_unflatten(list(shard.items()))
+        prompt_cache = _deserialize(states, entry["cache_layers"], make_cache())
+    except Exception as e:
+        error = str(e)
+    if sync_failed(int(error is not None)):
+        return error or "snapshot does not match another rank"
+
+    store.insert_cache(model_key, tokens, prompt_cache)
+    return None
+
+
+__all__ = ["SESSION_FORMAT", "SESSION_VERSION", "export_session", "import_session", "read_session_metadata"]
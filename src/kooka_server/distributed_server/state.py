@@ -2,19 +2,34 @@ from __future__ import annotations
 
 import logging
 import time
-from queue import Empty, Queue
+from collections import OrderedDict, deque
+from queue import Empty
 from threading import Lock
-from typing import Any, Optional
+from typing import Any, Deque, List, Optional, Sequence, Tuple
 
 import mlx.core as mx
 
-from .constants import (
-    DEFAULT_REPETITION_CONTEXT_SIZE,
-    DEFAULT_REPETITION_PENALTY,
-    MAX_PROMPT_LENGTH,
-    MAX_STOP_SEQUENCES,
-    MAX_STOP_SEQUENCE_LENGTH,
+from ..api.canonicalize import CanonicalizationStats
+from .admission import AdmissionQueue, deadline_error
+from .constants import MAX_PROMPT_LENGTH, REQUEST_OP_GENERATE
+from .control import (
+    CONTROL_FRAME_VERSION,
+    CONTROL_FRAME_WORDS,
+    ControlFrame,
+    PromptHistory,
+    decode_frame,
+    encode_frame,
+    frame_length,
+    request_from_dict,
 )
+from .token_stream import TokenDeliveryStats
+
+# KV session ids remembered for export by id.
+_MAX_SESSIONS = 256
+# Recent decode-step gaps kept for the inter-token latency percentiles.
+_STEP_GAP_WINDOW = 2048
+# Weight of the newest tick in the running prefill throughput.
+_PREFILL_RATE_ALPHA = 0.2
 
 
 class DistributedState:
@@ -24,9 +39,62 @@ class DistributedState:
         self.group = group
         self.rank = group.rank()
         self.world_size = group.size()
-        self.request_queue: Queue[dict] = Queue()  # Only used by rank 0
+        # Only used by rank 0. Stamps each request so queue waits can be measured.
+        self.request_queue = AdmissionQueue()
         self.lock = Lock()
         self.canceled_requests: set[str] = set()  # request_id strings (rank 0)
+        self.prompt_cache_store: Any = None  # Owned by the generation loop
+        # Whole seconds on rank 0's clock, as of the last broadcast request.
+        # Every rank sees the same value, so it can drive cache retention.
+        self.request_clock = 0
+        self._clock_origin = time.monotonic()
+        # KV session id -> token key, for exports/imports by id (rank 0).
+        self.sessions: OrderedDict[str, List[int]] = OrderedDict()
+        self.canonical_stats = CanonicalizationStats()  # rank 0
+        self.prompt_token_cache: Any = None  # Owned by the HTTP server (rank 0)
+        self.tokenizer_pool: Any = None  # Owned by the HTTP server (rank 0)
+        self.token_delivery = TokenDeliveryStats()  # rank 0
+        self._shutdown = False
+        self._next_seq = 1
+        # Delta base for prompts on the wire; unused with a single rank.
+        self.prompt_history = PromptHistory() if self.world_size > 1 else None
+        self.control_stats = {
+            "frames": 0,
+            "idle_frames": 0,
+            "collectives": 0,
+            "requests": 0,
+            "seconds": 0.0,
+            "max_seconds": 0.0,
+            "pickup_seconds": 0.0,
+            "max_pickup_seconds": 0.0,
+        }
+        # Batched generation loop: what each tick spent its tokens on.
+        self.tick_stats = {
+            "ticks": 0,
+            "prefill_ticks": 0,
+            "prefill_tokens": 0,
+            "decode_steps": 0,
+            "decode_tokens": 0,
+            "prefill_backlog_tokens": 0,
+        }
+        self._step_gaps: Deque[float] = deque(maxlen=_STEP_GAP_WINDOW)
+        self.prefill_tps: Optional[float] = None  # Prompt tokens/s while prefilling
+        self.context_length: Optional[int] = None  # From the model config, if it has one
+        # Requests turned away or dropped by admission control (rank 0).
+        self.shed_stats = {
+            "queue_full": 0,
+            "deadline": 0,
+            "expired_in_queue": 0,
+            "missed_before_prefill": 0,
+            "context_overflow": 0,
+        }
+
+    def remember_session(self, session_id: str, tokens: List[int]) -> None:
+        with self.lock:
+            self.sessions[session_id] = list(tokens)
+            self.sessions.move_to_end(session_id)
+            while len(self.sessions) > _MAX_SESSIONS:
+                self.sessions.popitem(last=False)
 
     def cancel_request(self, request_id: Optional[str]) -> None:
         if not request_id:
@@ -70,185 +138,219 @@ class DistributedState:
         mx.eval(flag)
         return int(flag[0].item()) > 0
 
-    def broadcast_request(self):
-        """Broadcast request from rank 0 to all ranks.
+    def sync_max(self, value: int) -> int:
+        """Collective max of an integer across ranks (all ranks must call)."""
+        if self.world_size == 1:
+            return int(value)
 
-        Returns (prompt_tokens, max_tokens, seed, temperature, top_p, top_k,
-        seed_is_user, repetition_penalty, repetition_context_size,
-        stop_token_sequences, response_queue, request) or (None, 0, 0, 0.0,
-        0.0, 0, 0, 0.0, ...).
+        mx.synchronize()
+        values = mx.array([int(value)], dtype=mx.int32)
+        values = mx.distributed.all_gather(values, stream=mx.cpu)
+        mx.eval(values)
+        return max(int(x) for x in values.tolist())
+
+    def request_shutdown(self) -> None:
+        """Ask every rank to leave the generation loop at the next control frame."""
+        self._shutdown = True
+
+    def sync_control(
+        self,
+        max_requests: int = 1,
+        cancel_candidates: Sequence[Tuple[int, Optional[str]]] = (),
+        idle_wait: float = 0.0,
+    ) -> ControlFrame:
+        """Exchange one control frame (all ranks must call).
+
+        Rank 0 takes up to `max_requests` requests off its queue (answering
+        any that are already past their deadline instead) and reports
+        which of `cancel_candidates` ((seq, request_id) pairs it knows about)
+        were canceled. Every rank gets the same frame back; with one rank no
+        collective runs at all.
+
+        With `idle_wait` > 0 and an empty queue, rank 0 first blocks up to that
+        long for a request and sends the frame the moment one arrives (the
+        other ranks wait inside the collective meanwhile).
         """
-        prompt_tokens = None
-        max_tokens = 256
-        seed = 0
-        seed_is_user = 0
-        temperature = 0.0
-        top_p = 0.0
-        top_k = 0
-        repetition_penalty = DEFAULT_REPETITION_PENALTY
-        repetition_context_size = DEFAULT_REPETITION_CONTEXT_SIZE
-        stop_token_sequences = []
-        response_queue = None
-        request = None
-
-        # Rank 0 checks for new request
-        if self.rank == 0:
+        if self.rank == 0 and idle_wait > 0 and max_requests > 0 and not self._shutdown:
             try:
-                request = self.request_queue.get_nowait()
-                prompt_tokens = request["prompt_tokens"]
-                max_tokens = request["max_tokens"]
-                seed_raw = request.get("seed")
-                seed_is_user = 1 if request.get("seed_is_user") else 0
-                if seed_raw is None:
-                    seed = int(time.time_ns() & 0x7FFFFFFF)
-                else:
-                    seed = int(seed_raw)
-                temperature = float(request.get("temperature") or 0.0)
-                top_p = float(request.get("top_p") or 0.0)
-                top_k = int(request.get("top_k") or 0)
-                rp = request.get("repetition_penalty", repetition_penalty)
-                repetition_penalty = float(repetition_penalty if rp is None else rp)
-                rcs = request.get("repetition_context_size", repetition_context_size)
-                repetition_context_size = int(repetition_context_size if rcs is None else rcs)
-                stop_token_sequences = request.get("stop_token_sequences") or []
-                response_queue = request["response_queue"]
-                logging.info(
-                    "Broadcasting request: prompt_len=%d, max_tokens=%d, stop_sequences=%d",
-                    len(prompt_tokens) if prompt_tokens else 0,
-                    int(max_tokens) if max_tokens is not None else 0,
-                    len(stop_token_sequences or []),
-                )
+                first = self.request_queue.get(timeout=idle_wait)
             except Empty:
-                prompt_tokens = None
-
-        # Broadcast metadata first so idle polling only does one collective.
-        # Metadata: [length, max_tokens, seed, top_k, stop_count, repetition_context_size, seed_is_user]
-        if self.rank == 0:
-            length = len(prompt_tokens) if prompt_tokens else 0
-            if length > MAX_PROMPT_LENGTH:
-                length = MAX_PROMPT_LENGTH
-            stop_count = min(len(stop_token_sequences or []), MAX_STOP_SEQUENCES)
-            meta = mx.array(
-                [length, max_tokens, seed, top_k, stop_count, repetition_context_size, seed_is_user],
-                dtype=mx.int32,
-            )
+                first = None
         else:
-            meta = mx.zeros((7,), dtype=mx.int32)
-
+            first = None
         t0 = time.perf_counter()
-        meta = mx.distributed.all_sum(meta, stream=mx.cpu)
-        mx.eval(meta)
-        meta_dt = time.perf_counter() - t0
-
-        length = int(meta[0].item())
-        max_tokens = int(meta[1].item())
-        seed = int(meta[2].item())
-        top_k = int(meta[3].item())
-        stop_count = int(meta[4].item())
-        repetition_context_size = int(meta[5].item())
-        seed_is_user = int(meta[6].item())
-
-        # Broadcast floats: [temperature, top_p, repetition_penalty]
-        if length == 0:
-            return (
-                None,
-                0,
-                0,
-                0.0,
-                0.0,
-                0,
-                0,
-                0.0,
-                DEFAULT_REPETITION_CONTEXT_SIZE,
-                [],
-                None,
-                None,
-            )
-
+        frame = ControlFrame(shutdown=self._shutdown)
         if self.rank == 0:
-            meta_f = mx.array([temperature, top_p, repetition_penalty], dtype=mx.float32)
-        else:
-            meta_f = mx.zeros((3,), dtype=mx.float32)
-
-        t1 = time.perf_counter()
-        meta_f = mx.distributed.all_sum(meta_f, stream=mx.cpu)
-        mx.eval(meta_f)
-        meta_f_dt = time.perf_counter() - t1
-        temperature = float(meta_f[0].item())
-        top_p = float(meta_f[1].item())
-        repetition_penalty = float(meta_f[2].item())
-
-        # Broadcast actual prompt tokens
-        if self.rank == 0:
-            tokens = mx.array(prompt_tokens[:length], dtype=mx.int32)
-        else:
-            tokens = mx.zeros((length,), dtype=mx.int32)
-
-        t2 = time.perf_counter()
-        tokens = mx.distributed.all_sum(tokens, stream=mx.cpu)
-        mx.eval(tokens)
-        tokens_dt = time.perf_counter() - t2
-
-        prompt = tokens.tolist()
-
-        stop_token_sequences_out = []
-        if stop_count > 0:
-            # Broadcast stop token sequences (padded per-sequence)
+            frame.clock = int(time.monotonic() - self._clock_origin)
+            frame.canceled = [seq for seq, request_id in cancel_candidates if self.is_request_canceled(request_id)]
+            while len(frame.requests) < max_requests:
+                if first is not None:
+                    request, first = first, None
+                else:
+                    try:
+                        request = self.request_queue.get_nowait()
+                    except Empty:
+                        break
+                # Past its deadline already: answer it here instead of prefilling it.
+                deadline = request.get("deadline")
+                if deadline is not None and t0 >= deadline:
+                    self._expire(request)
+                    continue
+                frame.requests.append(request_from_dict(request, self._next_seq, frame.clock, self._default_seed()))
+                self._next_seq += 1
+            # Clients that disconnected while queued are canceled in the same frame.
+            frame.canceled += [r.seq for r in frame.requests if self.is_request_canceled(r.request_id)]
+
+        collectives = 0
+        if self.world_size > 1:
+            local = frame
+            # Other ranks contribute only their version and shutdown flag.
             if self.rank == 0:
-                lens = [0] * stop_count
-                flat = [0] * (stop_count * MAX_STOP_SEQUENCE_LENGTH)
-                for i, seq in enumerate((stop_token_sequences or [])[:stop_count]):
-                    if not seq:
-                        continue
-                    seq = [int(x) for x in seq]
-                    l = min(len(seq), MAX_STOP_SEQUENCE_LENGTH)
-                    lens[i] = l
-                    start = i * MAX_STOP_SEQUENCE_LENGTH
-                    flat[start : start + l] = seq[:l]
-                stop_lens = mx.array(lens, dtype=mx.int32)
-                stop_tokens = mx.array(flat, dtype=mx.int32)
+                words = encode_frame(frame, self.prompt_history)
             else:
-                stop_lens = mx.zeros((stop_count,), dtype=mx.int32)
-                stop_tokens = mx.zeros((stop_count * MAX_STOP_SEQUENCE_LENGTH,), dtype=mx.int32)
-
-            t3 = time.perf_counter()
-            stop_lens = mx.distributed.all_sum(stop_lens, stream=mx.cpu)
-            stop_tokens = mx.distributed.all_sum(stop_tokens, stream=mx.cpu)
-            mx.eval(stop_lens, stop_tokens)
-            stop_dt = time.perf_counter() - t3
-
-            for i in range(stop_count):
-                l = int(stop_lens[i].item())
-                if l <= 0:
-                    continue
-                start = i * MAX_STOP_SEQUENCE_LENGTH
-                stop_token_sequences_out.append(stop_tokens[start : start + l].tolist())
-
-        if self.rank == 0:
+                words = [CONTROL_FRAME_VERSION, int(self._shutdown)]
+            # Same reason as sync_should_cancel: don't interleave with prefetch.
+            mx.synchronize()
+            inline = mx.array((words + [0] * CONTROL_FRAME_WORDS)[:CONTROL_FRAME_WORDS], dtype=mx.int32)
+            inline = mx.distributed.all_sum(inline, stream=mx.cpu)
+            mx.eval(inline)
+            collectives = 1
+            head = inline.tolist()
+            total = frame_length(head, self.world_size)
+            # Long prompts follow in bounded chunks rather than one huge buffer.
+            for start in range(CONTROL_FRAME_WORDS, total, MAX_PROMPT_LENGTH):
+                end = min(total, start + MAX_PROMPT_LENGTH)
+                if self.rank == 0:
+                    chunk = mx.array(words[start:end], dtype=mx.int32)
+                else:
+                    chunk = mx.zeros((end - start,), dtype=mx.int32)
+                chunk = mx.distributed.all_sum(chunk, stream=mx.cpu)
+                mx.eval(chunk)
+                collectives += 1
+                head += chunk.tolist()
+            frame = decode_frame(head, self.world_size, self.prompt_history)
+            if self.rank == 0:
+                for decoded, original in zip(frame.requests, local.requests):
+                    decoded.request = original.request
+            for req in frame.requests:
+                if req.op == REQUEST_OP_GENERATE:
+                    self.prompt_history.remember(req.prompt_tokens)
+
+        if frame.requests:
+            self.request_clock = frame.clock
+        dt = time.perf_counter() - t0
+        stats = self.control_stats
+        stats["frames"] += 1
+        stats["collectives"] += collectives
+        stats["requests"] += len(frame.requests)
+        if not frame.requests and not frame.canceled:
+            stats["idle_frames"] += 1
+        for req in frame.requests:
+            enqueued_at = req.request.get("enqueued_at") if req.request else None
+            if enqueued_at is not None:
+                pickup = t0 - enqueued_at
+                stats["pickup_seconds"] += pickup
+                stats["max_pickup_seconds"] = max(stats["max_pickup_seconds"], pickup)
+        stats["seconds"] += dt
+        stats["max_seconds"] = max(stats["max_seconds"], dt)
+        if self.rank == 0 and frame.requests:
             logging.info(
-                "Broadcast timings: meta=%.3fs floats=%.3fs tokens=%.3fs stop=%.3fs (length=%d stop_count=%d)",
-                meta_dt,
-                meta_f_dt,
-                tokens_dt,
-                stop_dt if stop_count > 0 else 0.0,
-                length,
-                stop_count,
+                "Control frame: requests=%d prompt_tokens=%s canceled=%d collectives=%d (%.3fs)",
+                len(frame.requests),
+                [len(r.prompt_tokens) for r in frame.requests],
+                len(frame.canceled),
+                collectives,
+                dt,
             )
-
-        return (
-            prompt,
-            max_tokens,
-            seed,
-            temperature,
-            top_p,
-            top_k,
-            seed_is_user,
-            repetition_penalty,
-            repetition_context_size,
-            stop_token_sequences_out,
-            response_queue,
-            request,
-        )
+        return frame
+
+    def _expire(self, request: dict) -> None:
+        self.shed_stats["expired_in_queue"] += 1
+        logging.info("Request expired in the queue (id=%s)", request.get("request_id"))
+        response_queue = request.get("response_queue")
+        if response_queue is not None:
+            response_queue.put(deadline_error(self.estimate_queue_wait(request.get("priority"))))
+            response_queue.put(None)
+
+    @staticmethod
+    def _default_seed() -> int:
+        return int(time.time_ns() & 0x7FFFFFFF)
+
+    def remember_tokens(self, tokens: Sequence[int]) -> None:
+        """Offer a finished generation as a delta base (all ranks, same order)."""
+        if self.prompt_history is not None:
+            self.prompt_history.remember(tokens)
+
+    def record_prefill(self, tokens: int, backlog: int, seconds: float = 0.0) -> None:
+        """One generation-loop tick: prompt tokens prefilled (in `seconds`), and those still queued for prefill."""
+        stats = self.tick_stats
+        stats["ticks"] += 1
+        stats["prefill_ticks"] += int(tokens > 0)
+        stats["prefill_tokens"] += tokens
+        stats["prefill_backlog_tokens"] = backlog
+        if tokens > 0 and seconds > 0:
+            rate = tokens / seconds
+            tps = self.prefill_tps
+            self.prefill_tps = rate if tps is None else tps + _PREFILL_RATE_ALPHA * (rate - tps)
+
+    def estimate_queue_wait(self, priority: Optional[str]) -> float:
+        """Seconds a new `priority` request can expect to wait before its own prefill starts.
+
+        The larger of two limits it can't beat: slots freeing up for the
+        requests queued ahead of it, and prefilling their prompts plus the
+        loop's current prefill backlog. 0 until there is throughput to go on.
+        """
+        requests, tokens, rate = self.request_queue.backlog(priority or self.request_queue.default_priority)
+        wait = requests / rate if rate else 0.0
+        if self.prefill_tps:
+            wait = max(wait, (self.tick_stats["prefill_backlog_tokens"] + tokens) / self.prefill_tps)
+        return wait
+
+    def admission_stats(self) -> dict:
+        return {**self.request_queue.stats(), "shed": dict(self.shed_stats)}
+
+    def record_decode_step(self, tokens: int, gap: Optional[float]) -> None:
+        """One batch decode step; `gap` is the time since the previous one, if the batch stayed busy."""
+        stats = self.tick_stats
+        stats["decode_steps"] += 1
+        stats["decode_tokens"] += tokens
+        if gap is not None:
+            self._step_gaps.append(gap)
+
+    def scheduler_stats(self) -> dict:
+        stats = dict(self.tick_stats)
+        gaps = sorted(self._step_gaps.copy())  # C-level copy: safe against the loop appending
+        total = stats["prefill_tokens"] + stats["decode_tokens"]
+
+        def percentile(q: float) -> float:
+            return 1000.0 * gaps[min(len(gaps) - 1, int(q * len(gaps)))] if gaps else 0.0
+
+        return {
+            **stats,
+            "prefill_share": stats["prefill_tokens"] / total if total else 0.0,
+            # Over the last _STEP_GAP_WINDOW decode steps.
+            "itl_p50_ms": percentile(0.5),
+            "itl_p99_ms": percentile(0.99),
+            "itl_max_ms": 1000.0 * gaps[-1] if gaps else 0.0,
+            "prefill_tps": self.prefill_tps or 0.0,
+        }
+
+    def control_plane_stats(self) -> dict:
+        stats = dict(self.control_stats)
+        frames = stats["frames"]
+        requests = stats["requests"]
+        return {
+            "frames": frames,
+            "idle_frames": stats["idle_frames"],
+            "collectives": stats["collectives"],
+            "requests": requests,
+            "avg_ms": 1000.0 * stats["seconds"] / frames if frames else 0.0,
+            "max_ms": 1000.0 * stats["max_seconds"],
+            # Queue wait before a request went out in a frame (rank 0).
+            "pickup_avg_ms": 1000.0 * stats["pickup_seconds"] / requests if requests else 0.0,
+            "pickup_max_ms": 1000.0 * stats["max_pickup_seconds"],
+            "prompt_history": self.prompt_history.stats() if self.prompt_history is not None else None,
+        }
 
 
 __all__ = ["DistributedState"]
@@ -0,0 +1,126 @@
+"""Token stop-sequence matching with Aho-Corasick automata.
+
+Stop sequences are matched on token ids as they are generated. For every
+token the generation loops need two numbers per request:
+
+- holdback: the length of the longest stop-sequence prefix that the output
+  currently ends with. Those tokens can't be streamed yet because they may
+  turn out to be part of a stop sequence.
+- trim: the length of the longest stop sequence the output now ends with
+  (0 if none). The request stops and those tokens are dropped.
+
+An automaton is compiled once per distinct stop set and cached. Its
+transition table only has columns for tokens that occur in the stop set,
+plus one shared column for every other token, so it stays small whatever
+the vocabulary. A token then costs one dict lookup and one table index,
+however many stop sequences the request has. The state's depth is the
+holdback, and `match_len` is the trim.
+"""
+from __future__ import annotations
+
+from collections import deque
+from functools import lru_cache
+from typing import Dict, Hashable, Iterable, List, Sequence, Tuple
+
+
+class StopAutomaton:
+    """Aho-Corasick automaton over a set of token sequences."""
+
+    def __init__(self, sequences: Sequence[Sequence[int]]):
+        patterns = [tuple(int(t) for t in s) for s in sequences if s]
+        tokens = sorted({t for p in patterns for t in p})
+        self._column = {t: i + 1 for i, t in enumerate(tokens)}
+
+        # Trie over the patterns; state 0 is the root.
+        children: List[Dict[int, int]] = [{}]
+        depth = [0]
+        match_len = [0]
+        for p in patterns:
+            state = 0
+            for t in p:
+                nxt = children[state].get(t)
+                if nxt is None:
+                    nxt = len(children)
+                    children[state][t] = nxt
+                    children.append({})
+                    depth.append(depth[state] + 1)
+                    match_len.append(0)
+                state = nxt
+            match_len[state] = max(match_len[state], len(p))
+
+        # Breadth-first: fill in missing transitions from failure links.
+        goto = [[0] * (len(tokens) + 1) for _ in children]
+        fail = [0] * len(children)
+        for t, child in children[0].items():
+            goto[0][self._column[t]] = child
+        queue = deque(children[0].values())
+        while queue:
+            state = queue.popleft()
+            goto[state] = list(goto[fail[state]])
+            for t, child in children[state].items():
+                fail[child] = goto[fail[state]][self._column[t]]
+                match_len[child] = max(match_len[child], match_len[fail[child]])
+                goto[state][self._column[t]] = child
+                queue.append(child)
+
+        self._goto = goto
+        self._depth = depth
+        self._match_len = match_len
+
+    @property
+    def num_states(self) -> int:
+        return len(self._depth)
+
+    def step(self, state: int, token: int) -> Tuple[int, int, int]:
+        """Advance one token: returns (state, holdback, trim)."""
+        nxt = self._goto[state][self._column.get(token, 0)]
+        return nxt, self._depth[nxt], self._match_len[nxt]
+
+
+@lru_cache(maxsize=256)
+def _compile(key: Tuple[Tuple[int, ...], ...]) -> StopAutomaton:
+    return StopAutomaton(key)
+
+
+def compile_stop_sequences(sequences: Iterable[Sequence[int]]) -> StopAutomaton | None:
+    """Cached automaton for a stop set, or None if it has no non-empty sequence."""
+    key = tuple(sorted({tuple(int(t) for t in s) for s in sequences if s}))
+    return _compile(key) if key else None
+
+
+class BatchStopMatcher:
+    """Stop-sequence state for every in-flight request of a batch."""
+
+    def __init__(self) -> None:
+        self._automata: Dict[Hashable, StopAutomaton] = {}
+        self._states: Dict[Hashable, int] = {}
+
+    def __contains__(self, uid: Hashable) -> bool:
+        return uid in self._automata
+
+    def add(self, uid: Hashable, automaton: StopAutomaton | None) -> None:
+        if automaton is None:
+            return
+        self._automata[uid] = automaton
+        self._states[uid] = 0
+
+    def remove(self, uid: Hashable) -> None:
+        self._automata.pop(uid, None)
+        self._states.pop(uid, None)
+
+    def step(self, uids: Sequence[Hashable], tokens: Sequence[int]) -> Tuple[List[int], List[int]]:
+        """Advance each uid by its token; returns (holdback, trim) lists aligned with `uids`.
+
+        Uids without stop sequences get zeros.
+        """
+        holdback = [0] * len(uids)
+        trim = [0] * len(uids)
+        automata, states = self._automata, self._states
+        for i, uid in enumerate(uids):
+            automaton = automata.get(uid)
+            if automaton is not None:
+                states[uid], holdback[i], trim[i] = automaton.step(states[uid], tokens[i])
+        return holdback, trim
+
+
+__all__ = ["BatchStopMatcher", "StopAutomaton", "compile_stop_sequences"]
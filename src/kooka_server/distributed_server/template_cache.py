@@ -0,0 +1,155 @@
+"""Incremental prompt tokenization keyed by chat message prefix.
+
+Agent conversations resend the whole history every turn, so rank 0 spends
+most of its per-request CPU re-tokenizing text it tokenized a moment ago.
+This cache keeps, per (chat template, tools, pinned template vars, message prefix),
+the tokens of the rendered prompt up to its last special token, i.e. just
+before the generation prompt. The next turn's render normally starts with
+that text; only the tail after it is encoded.
+
+Splitting is exact because tokenizers split on added (special) tokens before
+running the model's BPE/unigram pass, so text ending right before a special
+token tokenizes independently of what follows. The template is still
+rendered in full: Jinja chat templates are not segment-composable (loop
+state, injected system prompts, rewritten earlier turns), and a render that
+does not start with the cached text simply falls back to a full encode. The
+first few incremental encodes are also checked against a full encode; a
+mismatch disables the cache for the process.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+from array import array
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+
+class PromptTokenCache:
+    """Bounded LRU of tokenized prompt prefixes (rank 0, shared by HTTP threads)."""
+
+    def __init__(self, tokenizer: Any, max_entries: int = 32, verify: int = 4):
+        self.tokenizer = tokenizer
+        self.max_entries = max_entries
+        self._verify = verify
+        self._entries: "OrderedDict[bytes, Tuple[str, array]]" = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+        self.encoded_tokens = 0
+        self.disabled = False
+        self._special = self._added_tokens(tokenizer)
+        template = getattr(tokenizer, "chat_template", None)
+        self._template_key = hashlib.sha256(str(template).encode("utf-8")).digest()
+        if not self._special:
+            logging.info("Prompt token cache disabled: tokenizer exposes no added tokens")
+            self.disabled = True
+
+    @staticmethod
+    def _added_tokens(tokenizer: Any) -> Dict[int, str]:
+        added = getattr(tokenizer, "added_tokens_decoder", None)
+        if not isinstance(added, dict):
+            return {}
+        return {int(i): str(getattr(t, "content", t)) for i, t in added.items()}
+
+    def _prefix_keys(self, messages: Sequence[Any], tools: Any, template_vars: Any) -> List[bytes]:
+        """Rolling hashes of messages[:k] for k = 1..n, scoped to template/tools/vars."""
+        h = hashlib.sha256(self._template_key)
+        h.update(json.dumps(tools, sort_keys=True, default=str).encode("utf-8"))
+        h.update(json.dumps(template_vars, sort_keys=True, default=str).encode("utf-8"))
+        keys = []
+        for message in messages:
+            h.update(json.dumps(message, default=str).encode("utf-8"))
+            keys.append(h.copy().digest())
+        return keys
+
+    def encode(
+        self,
+        prompt: str,
+        messages: Sequence[Any],
+        tools: Any = None,
+        template_vars: Optional[Dict[str, Any]] = None,
+    ) -> List[int]:
+        """Tokenize `prompt` (rendered from `messages`), reusing a cached prefix.
+
+        `template_vars` are the configured (JSON) values the template kwargs
+        were built from, not the kwargs themselves: a pinned `strftime_now`
+        becomes a bound method whose repr differs per instance.
+        """
+        if self.disabled or self.max_entries <= 0 or not messages:
+            return self.tokenizer.encode(prompt)
+
+        keys = self._prefix_keys(messages, tools, template_vars or {})
+        cached = None
+        with self._lock:
+            for key in reversed(keys):
+                entry = self._entries.get(key)
+                if entry is not None and prompt.startswith(entry[0]):
+                    self._entries.move_to_end(key)
+                    cached = entry
+                    break
+
+        if cached is None:
+            tokens = self.tokenizer.encode(prompt)
+            with self._lock:
+                self.misses += 1
+                self.encoded_tokens += len(tokens)
+        else:
+            text, prefix_tokens = cached
+            tail = self.tokenizer.encode(prompt[len(text):], add_special_tokens=False)
+            tokens = prefix_tokens.tolist() + list(tail)
+            verify = False
+            with self._lock:
+                self.hits += 1
+                self.reused_tokens += len(prefix_tokens)
+                self.encoded_tokens += len(tail)
+                if self._verify > 0:
+                    self._verify -= 1
+                    verify = True
+            if verify and tokens != list(self.tokenizer.encode(prompt)):
+                logging.warning("Prompt token cache disabled: incremental tokenization differs from a full encode")
+                with self._lock:
+                    self.disabled = True
+                    self._entries.clear()
+                return self.tokenizer.encode(prompt)
+
+        self._store(keys[-1], prompt, tokens)
+        return tokens
+
+    def _store(self, key: bytes, prompt: str, tokens: List[int], attempts: int = 4) -> None:
+        """Cache the prompt up to (not including) its last special token."""
+        for cut in range(len(tokens) - 1, 0, -1):
+            if tokens[cut] not in self._special:
+                continue
+            attempts -= 1
+            pos = prompt.rfind(self._special[tokens[cut]])
+            # The tail is just the generation prompt; checking it keeps entries exact.
+            if pos > 0 and list(self.tokenizer.encode(prompt[pos:], add_special_tokens=False)) == tokens[cut:]:
+                with self._lock:
+                    self._entries[key] = (prompt[:pos], array("i", tokens[:cut]))
+                    self._entries.move_to_end(key)
+                    while len(self._entries) > self.max_entries:
+                        self._entries.popitem(last=False)
+                return
+            if attempts <= 0:
+                return
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "reused_tokens": self.reused_tokens,
+                "encoded_tokens": self.encoded_tokens,
+                "disabled": self.disabled,
+            }
+
+
+__all__ = ["PromptTokenCache"]
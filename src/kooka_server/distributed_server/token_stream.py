@@ -0,0 +1,235 @@
+"""Consumer side of a generation request's response queue.
+
+The generation loop runs in lock step with the other ranks, so rank 0 keeps
+per-token work there to a minimum: it puts raw `(token, finish_reason)`
+tuples on the request's queue, after one `RequestUsage` with the prompt
+accounting. `TokenStream` runs on the HTTP thread that owns the request. It
+does the streaming detokenization, the stop-sequence holdback and trimming,
+and builds the response items the handlers consume:
+
+    {"text", "finish_reason", "prompt_tokens", "cached_tokens",
+     "cache_creation_tokens", "generation_tokens", "token"}
+
+Dicts on the queue (errors) pass through unchanged, and `None` ends the
+stream. `PrefillProgress` events from a long prefill are passed through to
+streaming handlers (which report them as SSE comments) and dropped for the
+rest. The generation loop matches the same stop sequences to know when to
+stop, so the last token it sends is the one that completes a stop sequence.
+
+The queue is a `TokenChannel`: `put` is a deque append, and the HTTP thread
+is only woken for the first token, every `flush_tokens` tokens, or once the
+oldest unread token is `flush_ms` old. Each wakeup drains everything queued,
+so the handler writes one batch of SSE chunks per wakeup instead of one per
+token.
+"""
+from __future__ import annotations
+
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from queue import Empty
+from threading import Event, Lock
+from typing import Any, Deque, Dict, List, NamedTuple, Optional, Sequence
+
+from .stop_matcher import compile_stop_sequences
+
+
+class RequestUsage(NamedTuple):
+    prompt_tokens: int
+    cached_tokens: int
+    cache_creation_tokens: int
+
+
+class PrefillProgress(NamedTuple):
+    processed: int
+    total: int
+
+
+@dataclass
+class TokenDeliveryStats:
+    """Running totals for generation loop -> HTTP thread -> socket delivery."""
+
+    tokens: int = 0
+    wakeups: int = 0
+    writes: int = 0
+    _lock: Lock = field(default_factory=Lock, repr=False)
+
+    def record(self, tokens: int = 0, wakeups: int = 0, writes: int = 0) -> None:
+        with self._lock:
+            self.tokens += tokens
+            self.wakeups += wakeups
+            self.writes += writes
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            tokens, wakeups, writes = self.tokens, self.wakeups, self.writes
+        return {
+            "tokens": tokens,
+            "wakeups": wakeups,
+            "socket_writes": writes,
+            "wakeups_per_token": wakeups / tokens if tokens else 0.0,
+            "syscalls_per_token": writes / tokens if tokens else 0.0,
+        }
+
+
+class TokenChannel:
+    """Single-producer, single-consumer event channel for one request.
+
+    The generation loop calls `put` (a Queue-compatible signature, so error
+    paths need no special casing); the HTTP thread calls `drain`. Non-token
+    events and the first token wake the consumer right away.
+    """
+
+    def __init__(self, flush_tokens: int = 1, flush_ms: float = 0.0):
+        self._items: Deque[Any] = deque()
+        self._wake = Event()
+        self._flush_tokens = max(1, int(flush_tokens))
+        self._flush_s = max(0.0, float(flush_ms)) / 1000.0
+        self._unsignaled = 0
+        self._oldest: Optional[float] = None
+        self._seen_token = False
+
+    def put(self, item: Any, block: bool = True, timeout: Optional[float] = None) -> None:
+        if type(item) is tuple:
+            if self._seen_token:
+                self._unsignaled += 1
+                if self._unsignaled < self._flush_tokens:
+                    if self._unsignaled == 1:
+                        self._oldest = time.monotonic()
+                    self._items.append(item)
+                    return
+            self._seen_token = True
+        elif isinstance(item, RequestUsage):
+            # Always followed by a token (or the end) that wakes the consumer.
+            self._items.append(item)
+            return
+        self._items.append(item)
+        self._wake.set()
+
+    def drain(self, timeout: Optional[float] = None) -> List[Any]:
+        """Everything queued, once the flush policy allows; raises Empty on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if self._items:
+                oldest = self._oldest
+                if self._wake.is_set() or oldest is None:
+                    break
+                due: Optional[float] = oldest + self._flush_s
+            else:
+                # Clear before re-checking so a put in between isn't missed.
+                self._wake.clear()
+                if self._items:
+                    continue
+                due = None
+            now = time.monotonic()
+            if due is not None and now >= due:
+                break
+            if deadline is not None and now >= deadline:
+                if self._items:
+                    break
+                raise Empty
+            waits = [t - now for t in (due, deadline) if t is not None]
+            self._wake.wait(min(waits) if waits else None)
+        self._unsignaled = 0
+        self._oldest = None
+        self._wake.clear()
+        items = []
+        while self._items:
+            items.append(self._items.popleft())
+        return items
+
+
+class TokenStream:
+    """Queue-like view of a request's raw token events (HTTP thread)."""
+
+    def __init__(
+        self,
+        queue: TokenChannel,
+        tokenizer: Any,
+        stop_token_sequences: Sequence[Sequence[int]] = (),
+        stats: Optional[TokenDeliveryStats] = None,
+        progress: bool = False,
+    ):
+        self._queue = queue
+        self._stats = stats
+        self._progress = progress
+        self._detokenizer = tokenizer.detokenizer
+        self._stops = compile_stop_sequences(stop_token_sequences)
+        self._stop_state = 0
+        self._usage = RequestUsage(0, 0, 0)
+        self._generation_tokens = 0
+        self._pending: Deque[dict] = deque()  # Possible stop-sequence prefix
+        self._ready: Deque[Any] = deque()
+        self._stopped = False
+
+    def get(self, block: bool = True, timeout: Optional[float] = None) -> Any:
+        """Next response item (or PrefillProgress), None at the end; raises Empty like Queue.get."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self._ready:
+            if not block:
+                wait = 0.0
+            elif deadline is None:
+                wait = None
+            else:
+                wait = max(0.0, deadline - time.monotonic())
+            tokens = self._generation_tokens
+            for event in self._queue.drain(wait):
+                self._handle(event)
+            if self._stats is not None:
+                self._stats.record(tokens=self._generation_tokens - tokens, wakeups=1)
+        return self._ready.popleft()
+
+    def ready(self) -> int:
+        """Items that `get` returns without waiting (the rest of the current batch)."""
+        return len(self._ready)
+
+    def _handle(self, event: Any) -> None:
+        if event is None:
+            self._ready.extend(self._pending)
+            self._pending.clear()
+            self._ready.append(None)
+        elif isinstance(event, RequestUsage):
+            self._usage = event
+        elif isinstance(event, PrefillProgress):
+            if self._progress:
+                self._ready.append(event)
+        elif isinstance(event, dict):
+            self._ready.append(event)
+        elif not self._stopped:
+            self._add_token(*event)
+
+    def _add_token(self, token: int, finish_reason: Optional[str]) -> None:
+        detokenizer = self._detokenizer
+        if finish_reason != "stop":
+            detokenizer.add_token(token)
+        if finish_reason is not None:
+            detokenizer.finalize()
+        self._generation_tokens += 1
+
+        holdback = trim = 0
+        if self._stops is not None:
+            self._stop_state, holdback, trim = self._stops.step(self._stop_state, token)
+
+        usage = self._usage
+        self._pending.append(
+            {
+                "text": detokenizer.last_segment,
+                "finish_reason": finish_reason,
+                "prompt_tokens": usage.prompt_tokens,
+                "cached_tokens": usage.cached_tokens,
+                "cache_creation_tokens": usage.cache_creation_tokens,
+                "generation_tokens": self._generation_tokens,
+                "token": token,
+            }
+        )
+        if trim > 0:
+            # Stop sequence: drop its tokens; the generation loop ends here too.
+            for _ in range(min(trim, len(self._pending))):
+                self._pending.pop()
+            self._stopped = True
+            return
+        while len(self._pending) > holdback:
+            self._ready.append(self._pending.popleft())
+
+
+__all__ = ["PrefillProgress", "RequestUsage", "TokenChannel", "TokenDeliveryStats", "TokenStream"]
@@ -0,0 +1,121 @@
+"""Tokenizer worker processes for rank 0 request ingestion.
+
+Rank 0 runs the HTTP threads and the generation loop in one process, so a
+large chat-template render or encode on an HTTP thread holds the GIL while
+the generation thread waits to emit its next token. `PooledTokenizer` moves
+template rendering, encoding and decoding into spawned worker processes,
+each holding its own copy of the tokenizer; every other attribute is read
+from the local tokenizer.
+
+Threads alone would not help: the HTTP handlers already run on threads, and
+while the fast tokenizer's Rust encode releases the GIL, the Jinja render
+and the Python glue around it do not.
+"""
+from __future__ import annotations
+
+import logging
+import multiprocessing
+import pickle
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from threading import Lock
+from typing import Any, Dict, Optional
+
+_worker_tokenizer: Any = None
+
+
+def _init_worker(payload: bytes) -> None:
+    global _worker_tokenizer
+    _worker_tokenizer = pickle.loads(payload)
+
+
+def _call(method: str, args: tuple, kwargs: dict) -> Any:
+    return getattr(_worker_tokenizer, method)(*args, **kwargs)
+
+
+class PooledTokenizer:
+    """Tokenizer facade running apply_chat_template/encode/decode in worker processes."""
+
+    def __init__(self, tokenizer: Any, workers: int):
+        self._tokenizer = tokenizer
+        self.workers = workers
+        self._executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(pickle.dumps(tokenizer),),
+        )
+        self._lock = Lock()
+        self._depth = 0
+        self._max_depth = 0
+        self._tasks = 0
+        self._fallbacks = 0
+        self._seconds = 0.0
+        # Start every worker now so a tokenizer that fails to load surfaces here.
+        try:
+            for future in [self._executor.submit(_call, "encode", ("",), {}) for _ in range(workers)]:
+                future.result()
+        except Exception:
+            self.shutdown()
+            raise
+
+    def _run(self, method: str, *args: Any, **kwargs: Any) -> Any:
+        with self._lock:
+            self._depth += 1
+            self._max_depth = max(self._max_depth, self._depth)
+        t0 = time.perf_counter()
+        try:
+            return self._executor.submit(_call, method, args, kwargs).result()
+        except BrokenProcessPool:
+            logging.warning("Tokenizer worker died; running %s on the calling thread", method)
+            with self._lock:
+                self._fallbacks += 1
+            return getattr(self._tokenizer, method)(*args, **kwargs)
+        finally:
+            with self._lock:
+                self._depth -= 1
+                self._tasks += 1
+                self._seconds += time.perf_counter() - t0
+
+    def apply_chat_template(self, *args: Any, **kwargs: Any) -> Any:
+        return self._run("apply_chat_template", *args, **kwargs)
+
+    def encode(self, *args: Any, **kwargs: Any) -> Any:
+        return self._run("encode", *args, **kwargs)
+
+    def decode(self, *args: Any, **kwargs: Any) -> Any:
+        return self._run("decode", *args, **kwargs)
+
+    def __getattr__(self, attr: str) -> Any:
+        return getattr(self._tokenizer, attr)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "queue_depth": self._depth,
+                "max_queue_depth": self._max_depth,
+                "tasks": self._tasks,
+                "fallbacks": self._fallbacks,
+                "avg_latency_ms": 1000.0 * self._seconds / self._tasks if self._tasks else 0.0,
+            }
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def make_tokenizer_pool(tokenizer: Any, workers: int) -> Optional[PooledTokenizer]:
+    """A PooledTokenizer, or None (tokenize inline) if disabled or the tokenizer can't be shipped."""
+    if workers <= 0:
+        return None
+    try:
+        pool = PooledTokenizer(tokenizer, workers)
+    except Exception as e:
+        logging.warning("Tokenizer worker pool unavailable (%s); tokenizing on the HTTP threads", e)
+        return None
+    logging.info("Tokenizer worker pool: %d processes", workers)
+    return pool
+
+
+__all__ = ["PooledTokenizer", "make_tokenizer_pool"]
@@ -4,7 +4,10 @@ import logging
 import socket
 import uuid
 import warnings
-from typing import Any, Callable, Dict, Optional
+from array import array
+from collections import OrderedDict
+from dataclasses import replace
+from typing import Any, Callable, Dict, List, Optional
 from urllib.parse import urlparse
 
 from mlx_lm.server import (
@@ -22,10 +25,19 @@ from mlx_lm.server import (
 )
 
 from .api.anthropic.messages import (
+    anthropic_usage,
+    cache_control_offsets,
     convert_anthropic_to_openai_messages,
     convert_anthropic_tools,
     process_message_content,
 )
+from .api.canonicalize import (
+    CanonicalizationStats,
+    canonicalize_request,
+    common_prefix_len,
+    log_canonicalization,
+    pinned_template_vars,
+)
 from .api.models_endpoint import json_response as models_json_response
 from .api.openai.tool_calls import (
     apply_tool_fixes_to_openai_tool_calls,
@@ -50,6 +62,48 @@ def _json_error(handler: APIHandler, status: int, message: str) -> None:
         return
 
 
+class KookaPromptCache(LRUPromptCache):
+    """LRUPromptCache that remembers how many prompt tokens each lookup reused.
+
+    The generation thread fetches the cache; the handler thread reads the
+    count back by prompt once the response is done (for Anthropic usage).
+    It also credits canonicalized prompts with the prefill they saved.
+    """
+
+    _MAX_TRACKED = 64
+
+    def __init__(self, *args: Any, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self._reused: "OrderedDict[bytes, int]" = OrderedDict()
+        self._canonical: "OrderedDict[bytes, tuple[int, List[str]]]" = OrderedDict()
+        self.canonical_stats = CanonicalizationStats()
+
+    def fetch_nearest_cache(self, model, tokens):
+        prompt_cache, rest = super().fetch_nearest_cache(model, tokens)
+        key = array("i", tokens).tobytes()
+        reused = 0 if prompt_cache is None else len(tokens) - len(rest)
+        self._reused[key] = reused
+        while len(self._reused) > self._MAX_TRACKED:
+            self._reused.popitem(last=False)
+        canonical = self._canonical.pop(key, None)
+        if canonical is not None:
+            raw_prefix, changes = canonical
+            saved = max(0, reused - raw_prefix)
+            self.canonical_stats.add_saved(saved)
+            log_canonicalization(changes, saved, self.canonical_stats)
+        return prompt_cache, rest
+
+    def pop_reused(self, tokens: List[int]) -> int:
+        return self._reused.pop(array("i", tokens).tobytes(), 0)
+
+    def expect_canonical(self, tokens: List[int], raw_prefix: int, changes: List[str]) -> None:
+        """Report prefill saved when `tokens` is looked up: the raw request would
+        have diverged from it after `raw_prefix` tokens."""
+        self._canonical[array("i", tokens).tobytes()] = (raw_prefix, changes)
+        while len(self._canonical) > self._MAX_TRACKED:
+            self._canonical.popitem(last=False)
+
+
 class KookaAPIHandler(APIHandler):
     """APIHandler wrapper with stricter request parsing."""
 
@@ -172,6 +226,9 @@ class KookaAPIHandler(APIHandler):
         self.wfile.write(response_json)
         self.wfile.flush()
 
+    def handle_chat_completions(self) -> CompletionRequest:
+        return self._canonicalize(super().handle_chat_completions())
+
     def handle_anthropic_messages(self) -> CompletionRequest:
         body = self.body
         messages = convert_anthropic_to_openai_messages(body)
@@ -179,14 +236,70 @@ class KookaAPIHandler(APIHandler):
         process_message_content(messages)
 
         self.request_id = f"msg_{uuid.uuid4().hex[:24]}"
-        return CompletionRequest(
-            "chat",
-            "",
-            messages,
-            tools,
-            None,
+        return self._canonicalize(
+            CompletionRequest(
+                "chat",
+                "",
+                messages,
+                tools,
+                None,
+            )
         )
 
+    def _canonicalize(self, request: CompletionRequest) -> CompletionRequest:
+        """Apply --canonicalize-prompts to a chat request.
+
+        When something changed, renders both versions so the prompt cache can
+        credit the canonical prompt with the prefill the raw one would have
+        redone.
+        """
+        cli_args = self.response_generator.cli_args
+        if not getattr(cli_args, "canonicalize_prompts", False):
+            return request
+        process_message_content(request.messages)
+        messages, tools, changes = canonicalize_request(request.messages, request.tools)
+        prompt_cache = self.response_generator.prompt_cache
+        if not isinstance(prompt_cache, KookaPromptCache):
+            return replace(request, messages=messages, tools=tools)
+        prompt_cache.canonical_stats.record(changes)
+        tokenizer = getattr(self.response_generator.model_provider, "tokenizer", None)
+        if changes and tokenizer is not None and getattr(tokenizer, "has_chat_template", False):
+            template_args = getattr(cli_args, "chat_template_args", None) or {}
+
+            def render(m: list, t: Any) -> List[int]:
+                return tokenizer.apply_chat_template(
+                    m, tools=t, add_generation_prompt=True, tokenize=True, **template_args
+                )
+
+            tokens = render(messages, tools)
+            raw_prefix = common_prefix_len(render(request.messages, request.tools), tokens)
+            prompt_cache.expect_canonical(tokens, raw_prefix, changes)
+        return replace(request, messages=messages, tools=tools)
+
+    def _anthropic_cache_usage(self, prompt: List[int], output_tokens: int) -> dict:
+        """Usage with cache reads (reused prefix) and writes up to the last cache_control breakpoint."""
+        prompt_cache = self.response_generator.prompt_cache
+        cache_read = prompt_cache.pop_reused(prompt) if isinstance(prompt_cache, KookaPromptCache) else 0
+        tokenizer = getattr(self.response_generator.model_provider, "tokenizer", None)
+        cache_creation = 0
+        if tokenizer is not None and getattr(tokenizer, "has_chat_template", False):
+            template_args = getattr(self.response_generator.cli_args, "chat_template_args", None) or {}
+
+            def render(messages: list[dict], prefix_tools: Any) -> List[int]:
+                if getattr(self.response_generator.cli_args, "canonicalize_prompts", False):
+                    messages, prefix_tools, _ = canonicalize_request(messages, prefix_tools)
+                return tokenizer.apply_chat_template(
+                    messages,
+                    tools=prefix_tools,
+                    add_generation_prompt=False,
+                    tokenize=True,
+                    **template_args,
+                )
+
+            offsets = cache_control_offsets(self.body, prompt, render)
+            cache_creation = max([0] + [offset - cache_read for offset, _ in offsets])
+        return anthropic_usage(len(prompt), output_tokens, cache_read, cache_creation)
+
     def _send_anthropic_events(
         self,
         *,
@@ -195,8 +308,7 @@ class KookaAPIHandler(APIHandler):
         text: str,
         finish_reason: Optional[str],
         tool_calls: list[str],
-        input_tokens: int,
-        output_tokens: int,
+        usage: dict,
         tools: Optional[list[dict]],
     ) -> None:
         tokenizer = getattr(self.response_generator.model_provider, "tokenizer", None)
@@ -247,7 +359,7 @@ class KookaAPIHandler(APIHandler):
                     "content": [],
                     "stop_reason": None,
                     "stop_sequence": None,
-                    "usage": {"input_tokens": input_tokens, "output_tokens": 0},
+                    "usage": {**usage, "output_tokens": 0},
                 },
             },
         )
@@ -324,7 +436,7 @@ class KookaAPIHandler(APIHandler):
             {
                 "type": "message_delta",
                 "delta": {"stop_reason": stop_reason_map.get(finish_reason, finish_reason), "stop_sequence": None},
-                "usage": {"output_tokens": output_tokens},
+                "usage": {"output_tokens": usage["output_tokens"]},
             },
         )
 
@@ -453,6 +565,7 @@ class KookaAPIHandler(APIHandler):
                     if isinstance(parsed, dict) and parsed.get("name"):
                         tool_calls = [clean_text]
 
+        usage = self._anthropic_cache_usage(ctx.prompt, len(tokens))
         if self.stream:
             self._send_anthropic_events(
                 request_id=self.request_id,
@@ -460,8 +573,7 @@ class KookaAPIHandler(APIHandler):
                 text=clean_text,
                 finish_reason=finish_reason,
                 tool_calls=tool_calls,
-                input_tokens=len(ctx.prompt),
-                output_tokens=len(tokens),
+                usage=usage,
                 tools=tools,
             )
             return
@@ -525,7 +637,7 @@ class KookaAPIHandler(APIHandler):
             "content": content,
             "stop_reason": stop_reason,
             "stop_sequence": None,
-            "usage": {"input_tokens": len(ctx.prompt), "output_tokens": len(tokens)},
+            "usage": usage,
         }
 
         response_json = json.dumps(response, ensure_ascii=False).encode("utf-8")
@@ -688,8 +800,10 @@ class KookaAPIHandler(APIHandler):
 
 def serve(args: argparse.Namespace) -> None:
     """Run a single-machine server."""
+    if getattr(args, "pin_template_vars", None):
+        args.chat_template_args = {**(args.chat_template_args or {}), **pinned_template_vars(args.pin_template_vars)}
     model_provider = KookaModelProvider(args)
-    response_generator = ResponseGenerator(model_provider, LRUPromptCache())
+    response_generator = ResponseGenerator(model_provider, KookaPromptCache())
     server_address = (args.host, args.port)
 
     infos = socket.getaddrinfo(*server_address, type=socket.SOCK_STREAM, flags=socket.AI_PASSIVE)
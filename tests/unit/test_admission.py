@@ -0,0 +1,83 @@
+from __future__ import annotations
+
+import pytest
+
+
+@pytest.mark.unit
+def test_admission_is_weighted_fair_across_classes_and_clients() -> None:
+    from kooka_server.distributed_server.admission import AdmissionQueue
+
+    queue = AdmissionQueue({"interactive": 3, "batch": 1}, max_wait=60.0)
+    for i in range(6):
+        queue.put({"id": f"b{i}", "priority": "batch", "client": "summarizer"})
+    for i in range(3):
+        queue.put({"id": f"a{i}", "client": "alice"})
+        queue.put({"id": f"z{i}", "client": "zoe"})
+
+    order = [queue.get_nowait()["id"] for _ in range(12)]
+    # Three interactive admissions per batch one; the two chat clients alternate.
+    assert order[:8] == ["a0", "b0", "z0", "a1", "z1", "b1", "a2", "z2"]
+    assert order[8:] == ["b2", "b3", "b4", "b5"]
+
+    stats = queue.stats()
+    assert stats["default_priority"] == "interactive"
+    assert stats["classes"]["batch"]["admitted"] == 6 and stats["classes"]["batch"]["queued"] == 0
+
+
+@pytest.mark.unit
+def test_starved_requests_are_admitted_first() -> None:
+    import time
+    from queue import Empty
+
+    from kooka_server.distributed_server.admission import AdmissionQueue
+
+    queue = AdmissionQueue({"interactive": 100, "batch": 1}, max_wait=0.05)
+    queue.put({"id": "old", "priority": "batch", "enqueued_at": time.perf_counter() - 1.0})
+    queue.put({"id": "chat"})
+    queue.put({"id": "chat2"})
+    assert [queue.get()["id"] for _ in range(3)] == ["old", "chat", "chat2"]
+    assert queue.stats()["classes"]["batch"]["promoted"] == 1
+    assert queue.stats()["classes"]["batch"]["wait_max_ms"] >= 1000.0
+
+    with pytest.raises(Empty):
+        queue.get(timeout=0.01)
+
+
+@pytest.mark.unit
+def test_queue_wait_estimate_counts_the_prefill_ahead() -> None:
+    import mlx.core as mx
+
+    from kooka_server.distributed_server.state import DistributedState
+
+    state = DistributedState(mx.distributed.init())
+    assert state.estimate_queue_wait("interactive") == 0.0
+
+    state.record_prefill(1000, 4000, 1.0)  # 1000 tok/s, 4000 tokens still to prefill
+    for _ in range(2):
+        state.request_queue.put({"prompt_tokens": [1] * 500, "priority": "interactive"})
+    state.request_queue.put({"prompt_tokens": [1] * 500, "priority": "batch"})
+    # The queued interactive prompts count scaled by the class's 16/17 share.
+    assert state.estimate_queue_wait("interactive") == pytest.approx((4000 + 1000 * 17 / 16) / 1000)
+
+
+@pytest.mark.unit
+def test_requests_past_their_deadline_are_answered_from_the_queue() -> None:
+    import time
+    from queue import Queue
+
+    import mlx.core as mx
+
+    from kooka_server.distributed_server.state import DistributedState
+
+    state = DistributedState(mx.distributed.init())
+    expired, live = Queue(), Queue()
+    state.request_queue.put(
+        {"prompt_tokens": [1], "max_tokens": 1, "response_queue": expired, "deadline": time.perf_counter() - 1}
+    )
+    state.request_queue.put({"prompt_tokens": [2], "max_tokens": 1, "response_queue": live})
+
+    frame = state.sync_control(max_requests=2)
+    assert [r.prompt_tokens for r in frame.requests] == [[2]]
+    error = expired.get_nowait()
+    assert error["status"] == 503 and error["retry_after"] >= 1 and expired.get_nowait() is None
+    assert state.admission_stats()["shed"]["expired_in_queue"] == 1
@@ -55,3 +55,48 @@ def test_process_message_content_normalizes_tool_call_arguments() -> None:
     args = messages[0]["tool_calls"][0]["function"]["arguments"]
     assert isinstance(args, str)
     assert json.loads(args) == {"text": "ok"}
+
+
+def _render_chars(messages, tools):
+    """Toy chat template: one token per character, no generation prompt."""
+    text = "".join(f"[tool:{t['function']['name']}]" for t in tools or [])
+    text += "".join(f"<{m['role']}>{m['content']}</{m['role']}>" for m in messages)
+    return [ord(c) for c in text]
+
+
+@pytest.mark.unit
+def test_cache_control_breakpoints_map_to_prompt_offsets() -> None:
+    from kooka_server.api.anthropic.messages import anthropic_usage, cache_control_offsets
+
+    marker = {"type": "ephemeral"}
+    body = {
+        "tools": [{"name": "echo", "input_schema": {}, "cache_control": marker}],
+        "system": [{"type": "text", "text": "be brief", "cache_control": {"type": "ephemeral", "ttl": "1h"}}],
+        "messages": [
+            {"role": "user", "content": [{"type": "text", "text": "hi", "cache_control": marker}]},
+            {"role": "assistant", "content": "hello"},
+            {"role": "user", "content": "again"},
+        ],
+    }
+    messages = [
+        {"role": "system", "content": "be brief"},
+        {"role": "user", "content": "hi"},
+        {"role": "assistant", "content": "hello"},
+        {"role": "user", "content": "again"},
+    ]
+    tools = [{"function": {"name": "echo"}}]
+    prompt = _render_chars(messages, tools) + [ord(">")]
+
+    tools_end = len("[tool:echo]")
+    system_end = tools_end + len("<system>be brief</system>")
+    user_end = system_end + len("<user>hi</user>")
+    assert cache_control_offsets(body, prompt, _render_chars) == [
+        (tools_end, 300),
+        (system_end, 3600),
+        (user_end, 300),
+    ]
+
+    usage = anthropic_usage(len(prompt), 7, cache_read_tokens=system_end, cache_creation_tokens=user_end - system_end)
+    assert usage["input_tokens"] == len(prompt) - user_end
+    assert usage["cache_read_input_tokens"] == system_end
+    assert usage["cache_creation_input_tokens"] == user_end - system_end
@@ -0,0 +1,46 @@
+from __future__ import annotations
+
+import json
+
+import pytest
+
+from kooka_server.api.canonicalize import canonicalize_request, pinned_template_vars
+
+
+def _tool(name: str, properties: dict) -> dict:
+    return {"type": "function", "function": {"name": name, "parameters": {"type": "object", "properties": properties}}}
+
+
+@pytest.mark.unit
+def test_equivalent_requests_canonicalize_identically() -> None:
+    a_tools = [_tool("search", {"q": {"type": "string"}, "limit": {"type": "integer"}}), _tool("echo", {})]
+    b_tools = [_tool("echo", {}), _tool("search", {"limit": {"type": "integer"}, "q": {"type": "string"}})]
+    a_messages = [{"role": "system", "content": "Be brief.\r\n"}, {"role": "user", "content": "hi  "}]
+    b_messages = [{"role": "system", "content": "Be brief."}, {"role": "user", "content": [{"type": "text", "text": "hi"}]}]
+
+    a = canonicalize_request(a_messages, a_tools)
+    b = canonicalize_request(b_messages, b_tools)
+
+    assert json.dumps(a[1]) == json.dumps(b[1])
+    assert [t["function"]["name"] for t in a[1]] == ["echo", "search"]
+    assert a[0][0]["content"] == "Be brief." and a[0][1]["content"] == "hi"
+    assert a[2] == ["tool_order", "schema_keys", "whitespace"]
+    assert b[2] == ["schema_keys"]
+    # Inputs are not mutated.
+    assert a_messages[0]["content"] == "Be brief.\r\n"
+
+
+@pytest.mark.unit
+def test_assistant_turns_and_canonical_requests_are_left_alone() -> None:
+    messages = [{"role": "user", "content": "hi"}, {"role": "assistant", "content": "hello\n"}]
+    tools = [{"function": {"name": "a", "parameters": {"properties": {}, "type": "object"}}, "type": "function"}]
+
+    out_messages, out_tools, changes = canonicalize_request(messages, tools)
+    assert changes == [] and out_messages == messages and out_tools == tools
+
+
+@pytest.mark.unit
+def test_pinned_strftime_now_formats_a_fixed_date() -> None:
+    pinned = pinned_template_vars({"strftime_now": "2026-01-02", "date_string": "02 Jan 2026"})
+    assert pinned["strftime_now"]("%d %b %Y") == "02 Jan 2026"
+    assert pinned["date_string"] == "02 Jan 2026"
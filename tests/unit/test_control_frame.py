@@ -0,0 +1,124 @@
+from __future__ import annotations
+
+import pytest
+
+
+@pytest.mark.unit
+def test_control_frame_round_trips_requests_and_cancellations() -> None:
+    from kooka_server.distributed_server.constants import MAX_PROMPT_LENGTH, REQUEST_OP_PIN_PREFIX
+    from kooka_server.distributed_server.control import (
+        CONTROL_FRAME_WORDS,
+        ControlFrame,
+        decode_frame,
+        encode_frame,
+        frame_length,
+        request_from_dict,
+    )
+
+    clock = 100
+    generate = request_from_dict(
+        {
+            "prompt_tokens": list(range(MAX_PROMPT_LENGTH + 5)),
+            "max_tokens": 32,
+            "temperature": 0.7,
+            "top_p": 0.9,
+            "top_k": 40,
+            "stop_token_sequences": [[7, 8], []],
+            "cache_breakpoints": [(0, 60), (10, 300), (MAX_PROMPT_LENGTH + 5, 60)],
+            "request_id": "r1",
+        },
+        seq=5,
+        clock=clock,
+        seed=1234,
+    )
+    pin = request_from_dict(
+        {"prompt_tokens": [1, 2, 3], "max_tokens": 0, "op": REQUEST_OP_PIN_PREFIX, "seed": 9, "seed_is_user": True},
+        seq=6,
+        clock=clock,
+        seed=1234,
+    )
+    assert len(generate.prompt_tokens) == MAX_PROMPT_LENGTH + 5
+    assert generate.stop_token_sequences == [[7, 8]]
+    assert generate.cache_breakpoints == [(10, clock + 300)]
+
+    frame = ControlFrame(requests=[generate, pin], canceled=[2, 3], clock=clock)
+    words = encode_frame(frame)
+    assert frame_length(words, 1) == len(words) > CONTROL_FRAME_WORDS
+
+    decoded = decode_frame(words, 1)
+    assert decoded.canceled == [2, 3] and decoded.clock == clock and not decoded.shutdown
+    for got, want in zip(decoded.requests, frame.requests):
+        want.request = None
+        assert got == want
+    assert decoded.requests[1].seed == 9 and decoded.requests[1].seed_is_user
+
+
+@pytest.mark.unit
+def test_control_frame_sends_prompts_as_a_delta_on_the_shared_history() -> None:
+    from kooka_server.distributed_server.control import (
+        ControlFrame,
+        PromptHistory,
+        decode_frame,
+        encode_frame,
+        request_from_dict,
+    )
+
+    sender, receiver = PromptHistory(), PromptHistory()
+    turn1 = list(range(1000, 1500))
+    # Turn 1 finished: both ranks recorded its prompt + completion.
+    for history in (sender, receiver):
+        history.remember(turn1)
+        history.remember(turn1 + [7] * 20)
+
+    turn2 = turn1 + [7] * 20 + [8, 9, 10]
+    frame = ControlFrame(requests=[request_from_dict({"prompt_tokens": turn2}, seq=3, clock=0, seed=1)])
+    full = encode_frame(frame)
+    delta = encode_frame(frame, sender)
+    assert len(full) - len(delta) == 520
+    assert sender.stats()["reused_tokens"] == 520 and sender.stats()["sent_tokens"] == 3
+    assert decode_frame(delta, 1, receiver).requests[0].prompt_tokens == turn2
+
+    with pytest.raises(RuntimeError, match="diverged"):
+        decode_frame(delta, 1, PromptHistory())
+
+
+@pytest.mark.unit
+def test_control_frame_rejects_mismatched_versions() -> None:
+    from kooka_server.distributed_server.control import ControlFrame, decode_frame, encode_frame
+
+    words = encode_frame(ControlFrame(shutdown=True))
+    # The other rank contributes its own version and shutdown flag.
+    summed = [words[0] + 1, words[1] + 0] + words[2:]
+    assert decode_frame(summed, 2).shutdown
+
+    summed[0] = words[0] + 2
+    with pytest.raises(RuntimeError, match="version mismatch"):
+        decode_frame(summed, 2)
+
+
+@pytest.mark.unit
+def test_idle_control_frame_goes_out_as_soon_as_a_request_arrives() -> None:
+    import threading
+    import time
+
+    import mlx.core as mx
+
+    from kooka_server.distributed_server.control import IdleBackoff
+    from kooka_server.distributed_server.state import DistributedState
+
+    backoff = IdleBackoff(max_wait=0.04, min_wait=0.01)
+    assert [backoff.next() for _ in range(4)] == [0.01, 0.02, 0.04, 0.04]
+    backoff.reset()
+    assert backoff.next() == 0.01
+
+    state = DistributedState(mx.distributed.init())
+    t0 = time.perf_counter()
+    assert not state.sync_control(idle_wait=0.05).requests
+    assert time.perf_counter() - t0 >= 0.05
+
+    threading.Timer(0.05, state.request_queue.put, args=({"prompt_tokens": [1], "max_tokens": 1},)).start()
+    t0 = time.perf_counter()
+    frame = state.sync_control(idle_wait=5.0)
+    assert len(frame.requests) == 1 and time.perf_counter() - t0 < 1.0
+    stats = state.control_plane_stats()
+    assert stats["idle_frames"] == 1 and stats["pickup_max_ms"] < 1000.0
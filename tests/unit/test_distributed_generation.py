@@ -0,0 +1,506 @@
+from __future__ import annotations
+
+import pytest
+
+
+class _RunningSumModel:
+    """Toy recurrent model: the (non-trimmable) cache holds a running token sum."""
+
+    def __call__(self, inputs, cache):
+        import mlx.core as mx
+
+        total = inputs.astype(mx.float32).sum()
+        cache[0][0] = total if cache[0][0] is None else cache[0][0] + total
+        return mx.zeros((1, inputs.shape[1], 4))
+
+
+def _make_cache():
+    from mlx_lm.models.cache import ArraysCache
+
+    return [ArraysCache(size=1)]
+
+
+@pytest.mark.unit
+def test_checkpoint_offsets_cover_turn_starts_and_prompt_end() -> None:
+    from kooka_server.distributed_server.generation import _CheckpointPolicy, _checkpoint_offsets
+
+    marker = (9, 8)
+    prompt = [1, 2, 9, 8, 3, 4, 9, 8, 5, 9, 8, 6, 9, 8]
+    policy = _CheckpointPolicy(turns=2, turn_marker=marker)
+
+    assert _checkpoint_offsets(prompt, 0, policy) == [6, 9, 13]
+    # Offsets at or before the reused prefix are skipped.
+    assert _checkpoint_offsets(prompt, 9, policy) == [13]
+    assert _checkpoint_offsets(prompt, 0, _CheckpointPolicy()) == [13]
+    assert _checkpoint_offsets([5], 0, policy) == []
+
+
+@pytest.mark.unit
+def test_checkpoint_offsets_keep_the_last_periodic_snapshots() -> None:
+    from kooka_server.distributed_server.generation import _CheckpointPolicy, _checkpoint_offsets
+
+    policy = _CheckpointPolicy(interval=100, max_periodic=3)
+    prompt = list(range(1000))
+
+    assert _checkpoint_offsets(prompt, 0, policy) == [700, 800, 900, 999]
+    assert _checkpoint_offsets(prompt, 850, policy) == [900, 999]
+    assert _checkpoint_offsets(prompt[:901], 0, policy) == [600, 700, 800, 900]
+
+
+@pytest.mark.unit
+def test_prefill_checkpoints_let_the_next_turn_resume_after_divergence() -> None:
+    import mlx.core as mx
+
+    from kooka_server.distributed_server.generation import _advance_prefill, _CheckpointPolicy, _plan_prefill
+    from kooka_server.distributed_server.prompt_cache import LRUPromptCache
+
+    model = _RunningSumModel()
+    store = LRUPromptCache(max_size=4)
+    prompt = [1, 2, 3, 4, 5]
+    prompt_cache = _make_cache()
+
+    job = _plan_prefill(
+        prompt_cache=prompt_cache,
+        prompt_cache_store=store,
+        model_key="m",
+        prompt_tokens=prompt,
+        pos=0,
+        policy=_CheckpointPolicy(),
+        breakpoints=(),
+        repetition_penalty=0.0,
+        repetition_context_size=20,
+    )
+    _advance_prefill(job=job, model=model, prompt_cache_store=store, model_key="m", budget=100, prefill_step_size=2)
+    assert prompt[job.pos :] == [5]
+    assert store.stats()["checkpoints"] == 1 and store.checkpoint_bytes == 4
+
+    # Decoding continues on the working cache; the checkpoint is unaffected.
+    model(mx.array([[5, 100]]), cache=prompt_cache)
+    store.insert_cache("m", prompt + [100], prompt_cache)
+
+    # Next turn drops the generated token (e.g. stripped reasoning).
+    cached, rest = store.fetch_nearest_cache("m", prompt + [7, 8])
+    assert rest == [5, 7, 8]
+    assert cached[0][0].item() == 10
+    assert store.stats()["checkpoints"] == 0 and store.checkpoint_bytes == 0
+
+
+@pytest.mark.unit
+def test_chunked_prefill_respects_the_budget_and_stores_checkpoints() -> None:
+    from kooka_server.distributed_server.control import request_from_dict
+    from kooka_server.distributed_server.generation import (
+        _advance_prefill,
+        _CheckpointPolicy,
+        _pending_request,
+        _start_prefill,
+    )
+    from kooka_server.distributed_server.prompt_cache import LRUPromptCache
+
+    model = _RunningSumModel()
+    model.make_cache = _make_cache
+    store = LRUPromptCache(max_size=4)
+    prompt = list(range(1, 11))
+    req = _pending_request(request_from_dict({"prompt_tokens": prompt}, seq=1, clock=0, seed=0))
+    job = _start_prefill(
+        model=model,
+        prompt_cache_store=store,
+        model_key="m",
+        req=req,
+        policy=_CheckpointPolicy(interval=4, max_periodic=2),
+        rank=0,
+    )
+    # The last token is left for BatchGenerator; snapshots at 4, 8 and the prompt end.
+    assert (job.pos, job.end, job.checkpoints) == (0, 9, [4, 8, 9])
+
+    def advance(budget):
+        return _advance_prefill(
+            job=job, model=model, prompt_cache_store=store, model_key="m", budget=budget, prefill_step_size=3
+        )
+
+    assert advance(5) == 5 and job.pos == 5
+    assert store.stats()["checkpoints"] == 1
+    assert advance(100) == 4 and job.remaining == 0
+    assert job.prompt_cache[0][0].item() == sum(prompt[:9])
+    assert store.stats()["checkpoints"] == 3
+
+    # A fully cached prompt needs no prefill.
+    again = _start_prefill(
+        model=model, prompt_cache_store=store, model_key="m", req=req, policy=_CheckpointPolicy(), rank=0
+    )
+    assert again.reused_len == 9 and again.remaining == 0
+
+
+@pytest.mark.unit
+def test_canceled_prefill_keeps_its_partial_cache() -> None:
+    from kooka_server.distributed_server.control import request_from_dict
+    from kooka_server.distributed_server.generation import (
+        _advance_prefill,
+        _CheckpointPolicy,
+        _keep_partial_prefill,
+        _pending_request,
+        _start_prefill,
+    )
+    from kooka_server.distributed_server.prompt_cache import LRUPromptCache
+
+    model = _RunningSumModel()
+    model.make_cache = _make_cache
+    store = LRUPromptCache(max_size=4)
+    prompt = list(range(1, 101))
+    req = _pending_request(request_from_dict({"prompt_tokens": prompt}, seq=1, clock=0, seed=0))
+
+    def start():
+        return _start_prefill(
+            model=model, prompt_cache_store=store, model_key="m", req=req, policy=_CheckpointPolicy(), rank=0
+        )
+
+    job = start()
+    _advance_prefill(job=job, model=model, prompt_cache_store=store, model_key="m", budget=30, prefill_step_size=16)
+    assert job.pos == 30
+    _keep_partial_prefill(job=job, prompt_cache_store=store, model_key="m")
+
+    # The client retries: prefill resumes where the canceled one stopped.
+    retry = start()
+    assert retry.reused_len == 30 and retry.prompt_cache[0][0].item() == sum(prompt[:30])
+
+
+@pytest.mark.unit
+def test_requests_that_cannot_start_in_time_are_dropped_before_prefill() -> None:
+    import dataclasses
+    import time
+    from queue import Queue
+
+    import mlx.core as mx
+
+    from kooka_server.distributed_server.control import request_from_dict
+    from kooka_server.distributed_server.generation import (
+        _CheckpointPolicy,
+        _pending_request,
+        _shed_missed_deadlines,
+        _start_prefill,
+    )
+    from kooka_server.distributed_server.prompt_cache import LRUPromptCache
+    from kooka_server.distributed_server.state import DistributedState
+
+    model = _RunningSumModel()
+    model.make_cache = _make_cache
+    store = LRUPromptCache(max_size=4)
+    state = DistributedState(mx.distributed.init())
+    state.prefill_tps = 100.0
+    now = time.perf_counter()
+
+    def job(request_id, first_token, deadline):
+        req = _pending_request(
+            request_from_dict(
+                {"prompt_tokens": list(range(first_token, first_token + 101)), "request_id": request_id},
+                seq=1,
+                clock=0,
+                seed=0,
+            )
+        )
+        req = dataclasses.replace(req, response_queue=Queue(), deadline=deadline)
+        return _start_prefill(
+            model=model, prompt_cache_store=store, model_key="m", req=req, policy=_CheckpointPolicy(), rank=0
+        )
+
+    # 100 tokens each at 100 tok/s: the second job can't start generating before 2s.
+    jobs = [job("first", 1, None), job("tight", 200, now + 1.0), job("loose", 400, now + 60.0)]
+    _shed_missed_deadlines(dist_state=state, pending=[], prefilling=jobs)
+
+    assert [state.is_request_canceled(j.req.request_id) for j in jobs] == [False, True, False]
+    assert jobs[1].req.response_queue.get_nowait()["status"] == 503
+    assert state.shed_stats["missed_before_prefill"] == 1
+
+
+@pytest.mark.unit
+def test_seeded_sampling_does_not_depend_on_batch_companions() -> None:
+    import mlx.core as mx
+    from mlx_lm.generate import BatchGenerator
+    from mlx_lm.models.cache import KVCache
+
+    from kooka_server.distributed_server.generation import _request_sampler
+
+    class BigramModel:
+        """Logits depend only on the last token, so every row is exact whatever the batch."""
+
+        table = mx.random.normal((32, 32), key=mx.random.key(0))
+
+        def __call__(self, inputs, cache=None):
+            kv = mx.zeros((inputs.shape[0], 1, inputs.shape[1], 1))
+            cache[0].update_and_fetch(kv, kv)
+            return self.table[inputs]
+
+        def make_cache(self):
+            return [KVCache()]
+
+    def generate(requests):
+        batch = BatchGenerator(BigramModel(), stop_tokens=set())
+        uids = batch.insert(
+            [prompt for prompt, _ in requests],
+            12,
+            samplers=[_request_sampler(seed=seed, temperature=1.0, top_p=0.9, top_k=20) for _, seed in requests],
+        )
+        tokens = {uid: [] for uid in uids}
+        while responses := batch.next():
+            for r in responses:
+                tokens[r.uid].append(r.token)
+        return [tokens[uid] for uid in uids]
+
+    (alone,) = generate([([1, 2, 3], 7)])
+    assert len(alone) == 12
+    assert generate([([5, 6, 7, 8, 9], 11), ([1, 2, 3], 7), ([4], 3)])[1] == alone
+    assert generate([([1, 2, 3], 8)])[0] != alone
+
+
+@pytest.mark.unit
+def test_prefix_op_prefills_pins_and_unpins() -> None:
+    from queue import Queue
+    from types import SimpleNamespace
+
+    from mlx_lm.models.cache import ArraysCache
+
+    from kooka_server.distributed_server.constants import REQUEST_OP_PIN_PREFIX, REQUEST_OP_UNPIN_PREFIX
+    from kooka_server.distributed_server.generation import _run_prefix_op
+    from kooka_server.distributed_server.prompt_cache import LRUPromptCache
+
+    model = _RunningSumModel()
+    model.make_cache = _make_cache
+    store = LRUPromptCache(max_size=1)
+    prefix = [1, 2, 3, 4]
+    responses = Queue()
+
+    def run(op, tokens):
+        _run_prefix_op(
+            dist_state=SimpleNamespace(rank=0),
+            model=model,
+            prompt_cache_store=store,
+            model_key="m",
+            op=op,
+            prompt_tokens=tokens,
+            response_queue=responses,
+            prefill_step_size=3,
+        )
+        return responses.get_nowait()
+
+    result = run(REQUEST_OP_PIN_PREFIX, prefix)
+    assert result["tokens"] == 4 and result["prefilled_tokens"] == 4
+    assert run(REQUEST_OP_PIN_PREFIX, prefix)["prefilled_tokens"] == 0
+
+    (layer,), rest = store.fetch_nearest_cache("m", prefix + [9])
+    assert isinstance(layer, ArraysCache) and layer[0].item() == 10 and rest == [9]
+
+    assert run(REQUEST_OP_UNPIN_PREFIX, prefix) == {"id": result["id"], "deleted": True}
+    assert store.stats()["pinned"]["entries"] == 0
+
+
+@pytest.mark.unit
+def test_breakpoint_entries_copy_the_prefix_of_a_finished_cache() -> None:
+    import mlx.core as mx
+    from mlx_lm.models.cache import KVCache
+
+    from kooka_server.distributed_server.generation import _cache_creation_tokens, _insert_breakpoint_entries
+    from kooka_server.distributed_server.prompt_cache import LRUPromptCache
+
+    layer = KVCache()
+    kv = mx.arange(10, dtype=mx.float16).reshape(1, 1, 10, 1)
+    layer.update_and_fetch(kv, kv)
+    store = LRUPromptCache(max_size=4)
+    tokens = list(range(100, 110))
+
+    _insert_breakpoint_entries(
+        prompt_cache_store=store,
+        model_key="m",
+        prompt_tokens=tokens,
+        prompt_cache=[layer],
+        breakpoints=[(4, 300)],
+    )
+    assert layer.offset == 10
+    assert store.stats()["retained"] == 1
+
+    (hit,), rest = store.fetch_nearest_cache("m", tokens[:4] + [7])
+    assert rest == [7] and hit.offset == 4 and hit.keys.shape[2] == 4
+    assert hit.keys[0, 0, :, 0].tolist() == [0, 1, 2, 3]
+    assert _cache_creation_tokens([(4, 300), (8, 300)], 5) == 3
+    assert _cache_creation_tokens([(4, 300)], 5) == 0
+
+
+@pytest.mark.unit
+def test_breakpoint_entries_do_not_cap_reuse_of_the_full_conversation() -> None:
+    import mlx.core as mx
+    from mlx_lm.models.cache import KVCache
+
+    from kooka_server.distributed_server.generation import _insert_breakpoint_entries
+    from kooka_server.distributed_server.prompt_cache import LRUPromptCache
+
+    layer = KVCache()
+    kv = mx.arange(10, dtype=mx.float16).reshape(1, 1, 10, 1)
+    layer.update_and_fetch(kv, kv)
+    store = LRUPromptCache(max_size=4)
+    tokens = list(range(100, 110))
+    _insert_breakpoint_entries(
+        prompt_cache_store=store,
+        model_key="m",
+        prompt_tokens=tokens,
+        prompt_cache=[layer],
+        breakpoints=[(4, 300)],
+    )
+    store.insert_cache("m", tokens, [layer])
+
+    # The follow-up diverges after the breakpoint: reuse runs up to the divergence.
+    (hit,), rest = store.fetch_nearest_cache("m", tokens[:8] + [7])
+    assert rest == [7] and hit.offset == 8
+    assert hit.keys[0, 0, :, 0].tolist() == list(range(8))
+
+
+@pytest.mark.unit
+def test_trimmability_is_agreed_across_pipeline_ranks() -> None:
+    from types import SimpleNamespace
+
+    import mlx.core as mx
+    from mlx_lm.models.cache import ArraysCache, KVCache, RotatingKVCache
+
+    from kooka_server.distributed_server.generation import (
+        _CheckpointPolicy,
+        _checkpoint_plan,
+        _insert_breakpoint_entries,
+        _prompt_cache_trim_limit,
+    )
+    from kooka_server.distributed_server.prompt_cache import LRUPromptCache
+
+    def rank(layers, other_rank_limit):
+        state = SimpleNamespace(sync_max=lambda v: max(v, -other_rank_limit))
+        return _prompt_cache_trim_limit(state, SimpleNamespace(make_cache=lambda: layers))
+
+    # Sliding-window layers are trimmable until the window wraps.
+    assert rank([KVCache(), RotatingKVCache(max_size=64)], 2**31 - 1) == 64
+    # This rank's attention slice is trimmable, another rank's recurrent one is not.
+    assert rank([KVCache()], 0) == 0 and rank([ArraysCache(size=1)], 2**31 - 1) == 0
+
+    layer = KVCache()
+    kv = mx.zeros((1, 1, 10, 1), dtype=mx.float16)
+    layer.update_and_fetch(kv, kv)
+    store = LRUPromptCache(max_size=4, trim_limit=0)
+    tokens = list(range(10))
+    offsets, _ = _checkpoint_plan(
+        prompt_cache=[layer],
+        prompt_cache_store=store,
+        model_key="m",
+        prompt_tokens=tokens,
+        start=0,
+        policy=_CheckpointPolicy(),
+    )
+    assert offsets == [9]
+    _insert_breakpoint_entries(
+        prompt_cache_store=store, model_key="m", prompt_tokens=tokens, prompt_cache=[layer], breakpoints=[(4, 300)]
+    )
+    store.insert_cache("m", tokens, [layer])
+    assert len(store) == 1 and store.fetch_nearest_cache("m", tokens[:8] + [7])[0] is None
+
+
+@pytest.mark.unit
+def test_session_export_import_round_trip(tmp_path) -> None:
+    from queue import Queue
+    from types import SimpleNamespace
+
+    import mlx.core as mx
+    from mlx_lm.models.cache import KVCache
+
+    from kooka_server.distributed_server.constants import REQUEST_OP_EXPORT_SESSION, REQUEST_OP_IMPORT_SESSION
+    from kooka_server.distributed_server.generation import _run_prefix_op
+    from kooka_server.distributed_server.prompt_cache import LRUPromptCache
+    from kooka_server.distributed_server.session_snapshot import read_session_metadata
+
+    layer = KVCache()
+    kv = mx.arange(6, dtype=mx.float16).reshape(1, 1, 6, 1)
+    layer.update_and_fetch(kv, kv)
+    source = LRUPromptCache(max_size=2)
+    tokens = [5, 6, 7, 8, 9, 10]
+    source.insert_cache("m", tokens, [layer])
+    model = SimpleNamespace(layers=[None], make_cache=lambda: [KVCache()])
+    dist_state = SimpleNamespace(rank=0, world_size=1, sync_max=lambda v: v)
+    path = str(tmp_path / "session.safetensors")
+    responses = Queue()
+
+    def run(store, op, prompt):
+        _run_prefix_op(
+            dist_state=dist_state,
+            model=model,
+            prompt_cache_store=store,
+            model_key="m",
+            op=op,
+            prompt_tokens=prompt,
+            response_queue=responses,
+            prefill_step_size=4,
+            request={"path": path},
+        )
+        return responses.get_nowait()
+
+    exported = run(source, REQUEST_OP_EXPORT_SESSION, tokens + [11, 12])
+    assert exported["tokens"] == 6
+    assert read_session_metadata(path)["tokens"] == tokens
+    # Exporting leaves the source entry in place.
+    assert source.stats()["entries"] == 1
+
+    target = LRUPromptCache(max_size=2)
+    imported = run(target, REQUEST_OP_IMPORT_SESSION, tokens)
+    assert imported == {"id": exported["id"], "tokens": 6}
+
+    (hit,), rest = target.fetch_nearest_cache("m", tokens + [11])
+    assert rest == [11] and hit.offset == 6
+    assert hit.keys[0, 0, :6, 0].tolist() == list(range(6))
+
+    assert run(LRUPromptCache(max_size=2), REQUEST_OP_EXPORT_SESSION, [1, 2])["tokens"] == 0
+
+
+@pytest.mark.unit
+def test_session_import_rejects_snapshots_that_do_not_match_their_manifest(tmp_path) -> None:
+    from queue import Queue
+    from types import SimpleNamespace
+
+    import mlx.core as mx
+    from mlx_lm.models.cache import KVCache
+
+    from kooka_server.distributed_server.constants import REQUEST_OP_EXPORT_SESSION, REQUEST_OP_IMPORT_SESSION
+    from kooka_server.distributed_server.generation import _run_prefix_op
+    from kooka_server.distributed_server.prompt_cache import LRUPromptCache
+    from kooka_server.distributed_server.session_snapshot import read_session_metadata
+
+    layer = KVCache()
+    kv = mx.arange(6, dtype=mx.float16).reshape(1, 1, 6, 1)
+    layer.update_and_fetch(kv, kv)
+    source = LRUPromptCache(max_size=2)
+    tokens = [5, 6, 7, 8, 9, 10]
+    source.insert_cache("m", tokens, [layer])
+    model = SimpleNamespace(layers=[None], make_cache=lambda: [KVCache()])
+    dist_state = SimpleNamespace(rank=0, world_size=1, sync_max=lambda v: v)
+    responses = Queue()
+
+    def run(store, op, path):
+        _run_prefix_op(
+            dist_state=dist_state,
+            model=model,
+            prompt_cache_store=store,
+            model_key="m",
+            op=op,
+            prompt_tokens=tokens,
+            response_queue=responses,
+            prefill_step_size=4,
+            request={"path": path},
+        )
+        return responses.get_nowait()
+
+    path = str(tmp_path / "session.safetensors")
+    run(source, REQUEST_OP_EXPORT_SESSION, path)
+    arrays, metadata = mx.load(path, return_metadata=True)
+    first = sorted(arrays)[0]
+
+    missing = str(tmp_path / "missing.safetensors")
+    mx.save_safetensors(missing, {k: v for k, v in arrays.items() if k != first}, metadata)
+    reshaped = str(tmp_path / "reshaped.safetensors")
+    mx.save_safetensors(reshaped, {**arrays, first: arrays[first][..., :3, :]}, metadata)
+
+    for bad, reason in ((missing, "missing array"), (reshaped, "manifest declares")):
+        with pytest.raises(ValueError, match=reason):
+            read_session_metadata(bad)
+        target = LRUPromptCache(max_size=2)
+        result = run(target, REQUEST_OP_IMPORT_SESSION, bad)
+        assert reason in result["error"] and target.stats()["entries"] == 0
@@ -0,0 +1,392 @@
+from __future__ import annotations
+
+import random
+
+import pytest
+
+
+class _FakeLayerCache:
+    def __init__(self, offset: int, tag: tuple = ()):
+        self.offset = offset
+        self.tag = tag
+
+    def is_trimmable(self) -> bool:
+        return True
+
+    def trim(self, n: int) -> int:
+        n = min(self.offset, n)
+        self.offset -= n
+        return n
+
+
+class _FixedLayerCache(_FakeLayerCache):
+    def is_trimmable(self) -> bool:
+        return False
+
+
+def _fake_prompt_cache(tokens, layer_cls=_FakeLayerCache):
+    return [layer_cls(len(tokens), tuple(tokens))]
+
+
+def _summarize(fetched):
+    prompt_cache, rest = fetched
+    if prompt_cache is None:
+        return None, list(rest)
+    return prompt_cache[0].offset, list(rest)
+
+
+@pytest.mark.unit
+def test_prompt_cache_matches_reference_trie_semantics() -> None:
+    from mlx_lm.server import LRUPromptCache as ReferencePromptCache
+
+    from kooka_server.distributed_server.prompt_cache import LRUPromptCache
+
+    rng = random.Random(0)
+    stems = [[rng.randrange(4) for _ in range(rng.randrange(1, 12))] for _ in range(6)]
+
+    def make_tokens():
+        out = list(rng.choice(stems))
+        out += [rng.randrange(4) for _ in range(rng.randrange(0, 6))]
+        return out
+
+    # Without trimming only exact and shorter matches apply, as in the reference.
+    for max_size in (1, 2, 5):
+        ours = LRUPromptCache(max_size=max_size)
+        ref = ReferencePromptCache(max_size=max_size)
+        for _ in range(400):
+            tokens = make_tokens()
+            if rng.random() < 0.5:
+                ours.insert_cache("m", tokens, _fake_prompt_cache(tokens, _FixedLayerCache))
+                ref.insert_cache("m", tokens, _fake_prompt_cache(tokens, _FixedLayerCache))
+            else:
+                assert _summarize(ours.fetch_nearest_cache("m", tokens)) == _summarize(
+                    ref.fetch_nearest_cache("m", tokens)
+                ), tokens
+            assert len(ours) == len(ref._lru)
+
+    # With trimming, a hit reuses the longest prefix shared with any entry.
+    def common(a, b):
+        n = 0
+        while n < min(len(a), len(b)) and a[n] == b[n]:
+            n += 1
+        return n
+
+    for max_size in (1, 2, 5):
+        ours = LRUPromptCache(max_size=max_size)
+        for _ in range(400):
+            tokens = make_tokens()
+            if rng.random() < 0.5:
+                ours.insert_cache("m", tokens, _fake_prompt_cache(tokens))
+                continue
+            keys = [ours._node_tokens(node) for node in ours._lru]
+            if tokens in keys:
+                expected = len(tokens)
+            else:
+                expected = max([min(len(tokens) - 1, common(key, tokens)) for key in keys] + [0])
+            prompt_cache, rest = ours.fetch_nearest_cache("m", tokens)
+            assert (prompt_cache[0].offset if prompt_cache else 0) == expected == len(tokens) - len(rest), tokens
+
+
+@pytest.mark.unit
+def test_prompt_cache_recompresses_edges_after_eviction() -> None:
+    from kooka_server.distributed_server.prompt_cache import LRUPromptCache
+
+    store = LRUPromptCache(max_size=2)
+    a = list(range(100))
+    b = list(range(50)) + [999, 1000]
+    store.insert_cache("m", a, _fake_prompt_cache(a))
+    store.insert_cache("m", b, _fake_prompt_cache(b))
+
+    root = store._roots["m"]
+    (mid,) = root.children.values()
+    assert len(mid.label) == 50 and len(mid.children) == 2
+
+    # Evicting `a` leaves a single pass-through path that is merged back.
+    store.insert_cache("m", b, None)
+    c = [7, 8, 9]
+    store.insert_cache("m", c, _fake_prompt_cache(c))
+    assert len(store) == 2
+    assert sorted(len(child.label) for child in root.children.values()) == [3, 52]
+
+
+@pytest.mark.unit
+def test_prompt_cache_longer_match_uses_shortest_descendant() -> None:
+    from kooka_server.distributed_server.prompt_cache import LRUPromptCache
+
+    store = LRUPromptCache(max_size=4)
+    long_key = [1, 2, 3] + list(range(10, 40))
+    short_key = [1, 2, 3, 4, 5]
+    store.insert_cache("m", long_key, _fake_prompt_cache(long_key))
+    store.insert_cache("m", short_key, _fake_prompt_cache(short_key))
+
+    prompt_cache, rest = store.fetch_nearest_cache("m", [1, 2, 3, 99])
+    assert prompt_cache[0].tag == tuple(short_key)
+    assert prompt_cache[0].offset == 3
+    assert rest == [99]
+    # Longer matches are copied, never extracted.
+    assert len(store) == 2
+
+
+class _ArrayLayerCache(_FakeLayerCache):
+    def __init__(self, tokens):
+        import mlx.core as mx
+
+        super().__init__(len(tokens), tuple(tokens))
+        self.keys = mx.zeros((1, 1, len(tokens), 4), dtype=mx.float16)
+        self.values = mx.zeros((1, 1, len(tokens), 4), dtype=mx.float16)
+
+    @property
+    def state(self):
+        return self.keys, self.values
+
+
+@pytest.mark.unit
+def test_prompt_cache_byte_budget_prefers_evicting_cheap_stale_entries() -> None:
+    from kooka_server.distributed_server.prompt_cache import LRUPromptCache
+
+    # 16 bytes per token per layer (keys + values, float16, head_dim 4).
+    store = LRUPromptCache(max_size=10, max_bytes=16 * 1100)
+    small = [1] * 100
+    large = [2] * 900
+    store.insert_cache("m", small, [_ArrayLayerCache(small)])
+    store.insert_cache("m", large, [_ArrayLayerCache(large)])
+    assert store.nbytes == 16 * 1000
+
+    newer = [3] * 150
+    store.insert_cache("m", newer, [_ArrayLayerCache(newer)])
+
+    # The stale short prompt is cheapest to recompute and goes first, even
+    # though the large entry is older in insertion order.
+    assert store.nbytes == 16 * 1050
+    assert store.fetch_nearest_cache("m", small + [9])[0] is None
+    assert store.stats()["evictions"] == 1
+
+
+@pytest.mark.unit
+def test_prompt_cache_eviction_count_is_agreed_across_ranks() -> None:
+    from kooka_server.distributed_server.prompt_cache import LRUPromptCache
+
+    requested = []
+
+    def sync_evictions(count: int) -> int:
+        requested.append(count)
+        # Another rank (holding a bigger layer slice) needs two evictions.
+        return 2 if len(requested) == 3 else count
+
+    store = LRUPromptCache(max_size=10, max_bytes=1 << 30, sync_evictions=sync_evictions)
+    for tok in (1, 2, 3):
+        key = [tok] * 10
+        store.insert_cache("m", key, [_ArrayLayerCache(key)])
+
+    assert requested == [0, 0, 0]
+    assert len(store) == 1
+
+
+@pytest.mark.unit
+def test_prompt_cache_hits_share_arrays_without_mutating_the_stored_entry() -> None:
+    import mlx.core as mx
+    from mlx_lm.models.cache import KVCache
+
+    from kooka_server.distributed_server.prompt_cache import LRUPromptCache
+
+    tokens = list(range(10))
+    layer = KVCache()
+    kv = mx.arange(10, dtype=mx.float16).reshape(1, 1, 10, 1)
+    layer.update_and_fetch(kv, kv)
+    store = LRUPromptCache(max_size=4)
+    store.insert_cache("m", tokens, [layer])
+    store.insert_cache("m", tokens, [layer])
+
+    # Exact hit with another holder: a view over the stored arrays.
+    (shared,), rest = store.fetch_nearest_cache("m", tokens)
+    assert rest == [] and shared is not layer and shared.offset == 10
+    one = mx.full((1, 1, 1, 1), -1, dtype=mx.float16)
+    shared.update_and_fetch(one, one)
+
+    # Longer match: trimmed by slicing, so only the kept prefix is visible.
+    (trimmed,), rest = store.fetch_nearest_cache("m", tokens[:4] + [99])
+    assert rest == [99] and trimmed.offset == 4 and trimmed.keys.shape[2] == 4
+    trimmed.update_and_fetch(one, one)
+
+    assert layer.offset == 10
+    assert layer.keys[0, 0, :10, 0].tolist() == list(range(10))
+    assert trimmed.keys[0, 0, :5, 0].tolist() == [0, 1, 2, 3, -1]
+
+
+@pytest.mark.unit
+def test_prompt_cache_disk_tier_survives_restart(tmp_path) -> None:
+    import mlx.core as mx
+    from mlx_lm.models.cache import KVCache
+
+    from kooka_server.distributed_server.prompt_cache import LRUPromptCache
+    from kooka_server.distributed_server.prompt_cache_disk import DiskPromptCache
+
+    def make_cache():
+        # Layer 0 belongs to another pipeline rank and stays empty.
+        return [KVCache(), KVCache()]
+
+    def filled(tokens):
+        prompt_cache = make_cache()
+        kv = mx.arange(len(tokens), dtype=mx.float16).reshape(1, 1, len(tokens), 1)
+        prompt_cache[1].update_and_fetch(kv, kv)
+        return prompt_cache
+
+    a = list(range(20))
+    b = [7] * 8
+    disk = DiskPromptCache(str(tmp_path), "m/rank0", make_cache)
+    store = LRUPromptCache(max_size=1, disk=disk)
+    store.insert_cache("m", a, filled(a))
+    store.insert_cache("m", b, filled(b))  # evicts `a` to disk
+    assert disk.stats()["entries"] == 1
+    store.close()
+    assert disk.stats()["writes"] == 2
+
+    disk = DiskPromptCache(str(tmp_path), "m/rank0", make_cache)
+    store = LRUPromptCache(max_size=1, disk=disk)
+    assert len(disk) == 2 and len(store) == 0
+
+    prompt_cache, rest = store.fetch_nearest_cache("m", a + [99])
+    assert rest == [99]
+    assert prompt_cache[0].empty()
+    assert prompt_cache[1].offset == 20
+    assert prompt_cache[1].keys[0, 0, :, 0].tolist() == list(range(20))
+
+    # A longer on-disk entry is trimmed to the shared prefix.
+    prompt_cache, rest = store.fetch_nearest_cache("m", a[:5] + [42])
+    assert rest == [42] and prompt_cache[1].offset == 5
+    assert disk.stats()["hits"] == 2
+    store.close()
+
+
+@pytest.mark.unit
+def test_prompt_cache_quantizes_idle_entries_and_restores_them_on_hit() -> None:
+    import mlx.core as mx
+    from mlx_lm.models.cache import KVCache, QuantizedKVCache
+
+    from kooka_server.distributed_server.prompt_cache import LRUPromptCache, prompt_cache_nbytes
+
+    def filled(n):
+        layer = KVCache()
+        kv = mx.random.normal((1, 2, n, 64), key=mx.random.key(n)).astype(mx.float16)
+        layer.update_and_fetch(kv, kv)
+        return [layer], kv
+
+    store = LRUPromptCache(max_size=4, cold_after=0.0, cold_bits=8)
+    a, a_kv = filled(100)
+    full_bytes = prompt_cache_nbytes(a)
+    store.insert_cache("m", list(range(100)), a)
+    assert store.nbytes < full_bytes / 1.5
+    (node,) = store._lru
+    assert isinstance(node.entry.prompt_cache[0], QuantizedKVCache)
+    assert store.stats()["cold"]["saved_bytes"] == full_bytes - store.nbytes
+
+    (layer,), rest = store.fetch_nearest_cache("m", list(range(100)) + [1])
+    assert type(layer) is KVCache and rest == [1] and layer.offset == 100
+    assert mx.abs(layer.keys[..., :100, :] - a_kv).max().item() < 0.05
+    stats = store.stats()["cold"]
+    assert stats["thaws"] == 1 and stats["saved_bytes"] == 0
+
+
+@pytest.mark.unit
+def test_prompt_cache_accounts_and_compacts_step_slack() -> None:
+    import mlx.core as mx
+    from mlx_lm.models.cache import KVCache
+
+    from kooka_server.distributed_server.prompt_cache import LRUPromptCache
+
+    def filled():
+        layer = KVCache()  # grows in 256-token steps
+        kv = mx.ones((1, 1, 100, 4), dtype=mx.float16)
+        layer.update_and_fetch(kv, kv)
+        return [layer]
+
+    used = 2 * 100 * 4 * 2
+    loose = LRUPromptCache(max_size=2)
+    loose.insert_cache("m", list(range(100)), filled())
+    assert loose.nbytes == 2 * 256 * 4 * 2
+    assert loose.stats()["slack_bytes"] == loose.nbytes - used
+
+    compact = LRUPromptCache(max_size=2, compact=True)
+    compact.insert_cache("m", list(range(100)), filled())
+    assert compact.nbytes == used and compact.slack_bytes == 0
+
+    (layer,), rest = compact.fetch_nearest_cache("m", list(range(100)) + [5])
+    assert layer.offset == 100 and layer.keys.shape[2] == 100 and rest == [5]
+
+
+@pytest.mark.unit
+def test_prompt_cache_pinned_prefixes_are_shared_and_never_evicted() -> None:
+    from kooka_server.distributed_server.prompt_cache import LRUPromptCache, prefix_id
+
+    # Room for 1000 tokens; the pinned prefix takes 400 of it.
+    store = LRUPromptCache(max_size=1, max_bytes=16 * 1000)
+    system = [5] * 400
+    store.insert_cache("m", system, [_ArrayLayerCache(system)], pinned=True)
+    assert store.stats()["pinned"] == {"entries": 1, "bytes": 16 * 400}
+
+    for tok in (1, 2):
+        key = system + [tok] * 500
+        store.insert_cache("m", key, [_ArrayLayerCache(key)])
+    # Neither 900-token entry fits next to the pinned one.
+    assert len(store) == 0 and store.nbytes == 16 * 400
+
+    for tok in (3, 4):
+        prompt_cache, rest = store.fetch_nearest_cache("m", system + [tok])
+        assert prompt_cache[0].offset == 400 and rest == [tok]
+    assert store.pinned_prefixes() == [
+        {"id": prefix_id("m", system), "model": "m", "tokens": 400, "bytes": 16 * 400}
+    ]
+    assert store.pinned_tokens(prefix_id("m", system)) == ("m", system)
+
+    assert store.unpin("m", system) and not store.unpin("m", system)
+    assert store.nbytes == 0 and store.pinned_bytes == 0
+    assert store.fetch_nearest_cache("m", system + [3])[0] is None
+
+    # Pinning an entry that is already cached moves it out of the LRU.
+    store.insert_cache("m", system, [_ArrayLayerCache(system)])
+    assert store.pin("m", system) == prefix_id("m", system) and len(store) == 0
+    assert store.pin("m", [1, 2]) is None
+
+
+@pytest.mark.unit
+def test_prompt_cache_pinned_prefix_does_not_hide_a_longer_trimmable_entry() -> None:
+    from kooka_server.distributed_server.prompt_cache import LRUPromptCache
+
+    store = LRUPromptCache(max_size=4)
+    system = [5] * 100
+    store.insert_cache("m", system, _fake_prompt_cache(system), pinned=True)
+    conversation = system + [6] * 400 + [7, 8, 9, 10]
+    store.insert_cache("m", conversation, _fake_prompt_cache(conversation))
+
+    # The follow-up diverges two tokens before the end of the stored turn.
+    prompt_cache, rest = store.fetch_nearest_cache("m", conversation[:502] + [11])
+    assert prompt_cache[0].tag == tuple(conversation) and prompt_cache[0].offset == 502
+    assert rest == [11]
+    # Both entries stay in place for the next request.
+    assert len(store) == 1 and store.stats()["pinned"]["entries"] == 1
+
+
+@pytest.mark.unit
+def test_prompt_cache_retained_entries_are_shared_and_evicted_last() -> None:
+    from kooka_server.distributed_server.prompt_cache import LRUPromptCache
+
+    store = LRUPromptCache(max_size=2)
+    prefix = [1, 2, 3]
+    store.insert_cache("m", prefix, _fake_prompt_cache(prefix), retain_until=300)
+    for tok in (4, 5):
+        key = [tok] * 3
+        store.insert_cache("m", key, _fake_prompt_cache(key))
+    # The retained entry is the oldest, but the plain one goes first.
+    assert store.fetch_nearest_cache("m", [4, 4, 4, 9])[0] is None
+    assert store.stats()["retained"] == 1
+
+    # Hits share it instead of handing it out.
+    assert store.fetch_nearest_cache("m", prefix + [9])[1] == [9]
+    assert len(store) == 2
+
+    assert store.retain("m", prefix, 600) and not store.retain("m", [7], 600)
+    store.retention_clock = 600
+    assert store.stats()["retained"] == 0
+    key = [6] * 3
+    store.insert_cache("m", key, _fake_prompt_cache(key))
+    assert store.fetch_nearest_cache("m", prefix + [9])[0] is None
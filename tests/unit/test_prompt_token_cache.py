@@ -0,0 +1,108 @@
+from __future__ import annotations
+
+import re
+
+import pytest
+
+_SPECIALS = {"<s>": 1, "<|im_start|>": 2, "<|im_end|>": 3}
+
+
+class _ToyTokenizer:
+    """Splits on special tokens first, then merges "\\n\\n" (so boundaries matter)."""
+
+    chat_template = "toy"
+    added_tokens_decoder = {i: s for s, i in _SPECIALS.items()}
+
+    def __init__(self) -> None:
+        self.encoded_chars = 0
+
+    def encode(self, text: str, add_special_tokens: bool = True) -> list[int]:
+        self.encoded_chars += len(text)
+        tokens = [1] if add_special_tokens else []
+        for piece in re.split("(<s>|<\\|im_start\\|>|<\\|im_end\\|>)", text):
+            if piece in _SPECIALS:
+                tokens.append(_SPECIALS[piece])
+                continue
+            for chunk in re.findall("\n\n|.", piece, flags=re.S):
+                tokens.append(50 if chunk == "\n\n" else 100 + ord(chunk))
+        return tokens
+
+
+def _render(messages: list[dict]) -> str:
+    turns = "".join(f"<|im_start|>{m['role']}\n{m['content']}<|im_end|>\n" for m in messages)
+    return "<s>" + turns + "<|im_start|>assistant\n"
+
+
+@pytest.mark.unit
+def test_next_turn_only_encodes_the_new_tail() -> None:
+    from kooka_server.distributed_server.template_cache import PromptTokenCache
+
+    tokenizer = _ToyTokenizer()
+    cache = PromptTokenCache(tokenizer, max_entries=4)
+    history = [{"role": "system", "content": "be terse\n\n" * 50}, {"role": "user", "content": "hi"}]
+
+    first = _render(history)
+    assert cache.encode(first, history) == tokenizer.encode(first)
+
+    history += [{"role": "assistant", "content": "hello"}, {"role": "user", "content": "\n\nmore"}]
+    second = _render(history)
+    tokenizer.encoded_chars = 0
+    tokens = cache.encode(second, history)
+    tail_chars = tokenizer.encoded_chars
+    assert tokens == tokenizer.encode(second)
+    # The full-encode check runs on early hits; the tail itself is short.
+    assert tail_chars - len(second) < len(second) // 2
+
+    stats = cache.stats()
+    assert stats["hits"] == 1 and stats["misses"] == 1 and not stats["disabled"]
+    assert stats["reused_tokens"] > 0
+
+
+@pytest.mark.unit
+def test_rewritten_history_falls_back_to_a_full_encode() -> None:
+    from kooka_server.distributed_server.template_cache import PromptTokenCache
+
+    tokenizer = _ToyTokenizer()
+    cache = PromptTokenCache(tokenizer, max_entries=4)
+    history = [{"role": "user", "content": "a"}]
+    cache.encode(_render(history), history)
+
+    # Same message prefix key, but a template that renders it differently.
+    prompt = "<s>changed" + _render(history)[3:]
+    assert cache.encode(prompt, history) == tokenizer.encode(prompt)
+    assert cache.stats()["hits"] == 0
+
+
+@pytest.mark.unit
+def test_pinned_strftime_now_keeps_hitting_across_handlers() -> None:
+    import io
+    from types import SimpleNamespace
+
+    from kooka_server.distributed_server.http import DistributedHandler
+    from kooka_server.distributed_server.template_cache import PromptTokenCache
+
+    class _TemplateTokenizer(_ToyTokenizer):
+        def apply_chat_template(self, messages, *, tools, add_generation_prompt, tokenize, strftime_now):
+            return strftime_now("%d %b %Y") + _render(messages)
+
+    class _Connection:
+        """Closed client connection: the handler returns without serving a request."""
+
+        def makefile(self, *args, **kwargs):
+            return io.BytesIO()
+
+    tokenizer = _TemplateTokenizer()
+    state = SimpleNamespace(prompt_token_cache=PromptTokenCache(tokenizer, max_entries=4))
+    args = SimpleNamespace(pin_template_vars={"strftime_now": "2026-01-02"}, canonicalize_prompts=False)
+    history = [{"role": "system", "content": "be terse"}, {"role": "user", "content": "hi"}]
+
+    prompts = []
+    for _ in range(2):
+        # Each connection gets its own handler, which builds its own template args.
+        handler = DistributedHandler(state, tokenizer, args, _Connection(), ("127.0.0.1", 0), None)
+        prompt, tokens, _ = handler._render_chat_prompt(history, None)
+        assert tokens == tokenizer.encode(prompt)
+        prompts.append(prompt)
+
+    assert prompts[0] == prompts[1] and prompts[0].startswith("02 Jan 2026<s>")
+    assert state.prompt_token_cache.stats()["hits"] == 1
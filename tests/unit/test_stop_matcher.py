@@ -0,0 +1,64 @@
+from __future__ import annotations
+
+import random
+
+import pytest
+
+
+def _reference(stop_sequences: list[list[int]], tokens: list[int]) -> list[tuple[int, int]]:
+    """(holdback, trim) after each token, by checking every suffix directly."""
+    out = []
+    for n in range(1, len(tokens) + 1):
+        text = tokens[:n]
+        holdback = max(
+            (k for s in stop_sequences for k in range(1, len(s) + 1) if text[-k:] == s[:k]),
+            default=0,
+        )
+        trim = max((len(s) for s in stop_sequences if text[-len(s):] == s), default=0)
+        out.append((holdback, trim))
+        if trim:
+            break
+    return out
+
+
+@pytest.mark.unit
+def test_stop_automaton_matches_overlapping_sequences() -> None:
+    from kooka_server.distributed_server.stop_matcher import compile_stop_sequences
+
+    assert compile_stop_sequences([[], []]) is None
+    stops = [[1, 2, 1, 3], [2, 1], [5]]
+    automaton = compile_stop_sequences(stops)
+    assert compile_stop_sequences([[5], [2, 1], [1, 2, 1, 3]]) is automaton
+
+    rng = random.Random(0)
+    for _ in range(200):
+        tokens = [rng.choice([1, 2, 3, 5, 9000]) for _ in range(12)]
+        state, got = 0, []
+        for token in tokens:
+            state, holdback, trim = automaton.step(state, token)
+            got.append((holdback, trim))
+            if trim:
+                break
+        assert got == _reference(stops, tokens)
+
+
+@pytest.mark.unit
+def test_batch_stop_matcher_tracks_each_request() -> None:
+    from kooka_server.distributed_server.stop_matcher import BatchStopMatcher, compile_stop_sequences
+
+    rng = random.Random(1)
+    stop_sets = {uid: [[rng.randint(0, 3) for _ in range(rng.randint(1, 4))] for _ in range(uid % 3)] for uid in range(8)}
+    streams = {uid: [rng.randint(0, 4) for _ in range(16)] for uid in stop_sets}
+    expected = {uid: _reference(stop_sets[uid], streams[uid]) for uid in stop_sets}
+
+    matcher = BatchStopMatcher()
+    for uid, stops in stop_sets.items():
+        matcher.add(uid, compile_stop_sequences(stops))
+    alive = sorted(stop_sets)
+    for step in range(16):
+        holdback, trim = matcher.step(alive, [streams[uid][step] for uid in alive])
+        for uid, h, t in zip(alive, holdback, trim):
+            assert (h, t) == expected[uid][step]
+            if t:
+                matcher.remove(uid)
+        alive = [uid for uid, t in zip(alive, trim) if not t]
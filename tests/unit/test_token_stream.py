@@ -0,0 +1,139 @@
+from __future__ import annotations
+
+from queue import Empty
+
+import pytest
+
+
+class _CharDetokenizer:
+    """Like mlx-lm's streaming detokenizers: last_segment is the text since the last read."""
+
+    def __init__(self) -> None:
+        self._text = ""
+
+    @property
+    def last_segment(self) -> str:
+        segment, self._text = self._text, ""
+        return segment
+
+    def add_token(self, token: int) -> None:
+        self._text += chr(token)
+
+    def finalize(self) -> None:
+        pass
+
+
+class _Tokenizer:
+    @property
+    def detokenizer(self) -> _CharDetokenizer:
+        return _CharDetokenizer()
+
+
+@pytest.mark.unit
+def test_token_stream_detokenizes_and_holds_back_stop_text() -> None:
+    from kooka_server.distributed_server.token_stream import RequestUsage, TokenChannel, TokenStream
+
+    raw = TokenChannel()
+    stream = TokenStream(raw, _Tokenizer(), [[ord("X"), ord("Y")]])
+    raw.put(RequestUsage(prompt_tokens=10, cached_tokens=4, cache_creation_tokens=0))
+    for ch in "aXb":
+        raw.put((ord(ch), None))
+
+    assert stream.get()["text"] == "a"
+    # "X" may start the stop sequence, so it waits for the next token.
+    item = stream.get()
+    assert item["text"] == "X" and item["generation_tokens"] == 2 and item["prompt_tokens"] == 10
+    assert item["cached_tokens"] == 4 and stream.get()["text"] == "b"
+    with pytest.raises(Empty):
+        stream.get(timeout=0.01)
+
+    # "XY" matches: both are dropped and later tokens are ignored.
+    for ch in "cXYd":
+        raw.put((ord(ch), None))
+    raw.put(None)
+    assert stream.get()["text"] == "c"
+    assert stream.get() is None
+
+
+@pytest.mark.unit
+def test_token_stream_passes_errors_and_skips_eos_text() -> None:
+    from kooka_server.distributed_server.token_stream import TokenChannel, TokenStream
+
+    raw = TokenChannel()
+    stream = TokenStream(raw, _Tokenizer())
+    raw.put((ord("a"), None))
+    raw.put((0, "stop"))
+    raw.put({"text": "Error: boom", "finish_reason": "error"})
+    raw.put(None)
+
+    assert stream.get()["text"] == "a"
+    eos = stream.get()
+    assert eos["finish_reason"] == "stop" and eos["text"] == "" and eos["token"] == 0
+    assert stream.get() == {"text": "Error: boom", "finish_reason": "error"}
+    assert stream.get() is None
+
+    # Prefill progress only reaches handlers that asked for it.
+    from kooka_server.distributed_server.token_stream import PrefillProgress
+
+    for progress, expected in ((False, ["a"]), (True, [PrefillProgress(2048, 6000), "a"])):
+        raw = TokenChannel()
+        stream = TokenStream(raw, _Tokenizer(), progress=progress)
+        raw.put(PrefillProgress(2048, 6000))
+        raw.put((ord("a"), None))
+        raw.put(None)
+        items = []
+        while (item := stream.get(timeout=1)) is not None:
+            items.append(item if isinstance(item, PrefillProgress) else item["text"])
+        assert items == expected
+
+
+@pytest.mark.unit
+def test_token_channel_wakes_per_batch_under_the_flush_policy() -> None:
+    import time
+
+    from kooka_server.distributed_server.token_stream import (
+        RequestUsage,
+        TokenChannel,
+        TokenDeliveryStats,
+        TokenStream,
+    )
+
+    channel = TokenChannel(flush_tokens=3, flush_ms=30)
+    channel.put(RequestUsage(5, 0, 0))
+    channel.put((ord("a"), None))
+    # The first token goes out at once.
+    t0 = time.monotonic()
+    assert channel.drain(timeout=5) == [RequestUsage(5, 0, 0), (ord("a"), None)]
+    assert time.monotonic() - t0 < 0.02
+
+    # A lone token waits for the flush interval, not the caller's timeout.
+    channel.put((ord("b"), None))
+    t0 = time.monotonic()
+    assert channel.drain(timeout=5) == [(ord("b"), None)]
+    assert 0.025 <= time.monotonic() - t0 < 1.0
+
+    # Every third token, and the end of the stream, wake it right away.
+    for ch in "cde":
+        channel.put((ord(ch), None))
+    t0 = time.monotonic()
+    assert len(channel.drain(timeout=5)) == 3
+    channel.put((ord("f"), "length"))
+    channel.put(None)
+    assert channel.drain(timeout=5) == [(ord("f"), "length"), None]
+    assert time.monotonic() - t0 < 0.02
+    with pytest.raises(Empty):
+        channel.drain(timeout=0.01)
+
+    stats = TokenDeliveryStats()
+    channel = TokenChannel(flush_tokens=8, flush_ms=1000)
+    stream = TokenStream(channel, _Tokenizer(), stats=stats)
+    for ch in "ghijkl":
+        channel.put((ord(ch), None))
+    channel.put(None)
+    texts = []
+    while (item := stream.get(timeout=5)) is not None:
+        texts.append(item["text"])
+        assert stream.ready() == 7 - len(texts)  # The rest, then the end
+    assert texts == list("ghijkl")
+    snapshot = stats.snapshot()
+    assert snapshot["tokens"] == 6 and snapshot["wakeups_per_token"] <= 2 / 6